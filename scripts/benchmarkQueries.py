@@ -0,0 +1,390 @@
+"""
+Runs the pipeline's queries and updates against a local SPARQL endpoint loaded with a fixture subset
+of the data, measures their duration and number of results and compares them to a baseline.
+This allows measuring the effect of changes to the queries without a running Blazegraph instance.
+
+The fixture is created from the RDF files given via --inputs, if it does not exist yet: a sample of
+the subjects of the main graph is taken, together with the triples of the resources they link to
+over the given number of hops. The graphs given via --completeGraphs (e.g. the ontologies) are
+copied completely.
+
+A local endpoint backed by rdflib (see lib/sparqlEndpoint.py) is started and the steps of the
+pipeline that run against the triple store are executed in the order of the pipeline:
+- ingest: Loading the fixture via the REST API, as done by the ingest tasks
+- materialise-network: The relation, relink and reverse queries of materialiseRelations.py
+- the statements of the update files (addRelations.sparql and cleanup.sparql)
+- cache-thumbnails: The thumbnail query of cacheThumbnails.py, if a props file is given
+Finally, the number of statements per named graph is counted.
+
+The number of results of every step (the numbers of removed and added statements for updates,
+as '-<removed> +<added>') must match the baseline exactly, while the duration may exceed the baseline by the given factor. Use
+--updateBaseline true to store the current results as baseline.
+
+Usage:
+
+python benchmarkQueries.py --inputs <graph IRI>=<glob pattern>,... --fixtureFile <N-Quads file> --baseline <JSON file>
+
+Parameters:
+    --inputs            Comma-separated list of <graph IRI>=<glob pattern> entries of the files the fixture is created from
+    --fixtureFile       The N-Quads file containing the fixture (optional, default: /data/benchmark/fixture.nq)
+    --sampleGraph       The named graph from which the subjects are sampled (optional, default: https://resource.jila.zb.uzh.ch/graph/main)
+    --sampleSize        The number of sampled subjects (optional, default: 200)
+    --hops              The number of hops over which linked resources are added to the fixture (optional, default: 2)
+    --completeGraphs    Comma-separated list of named graphs that are added to the fixture completely (optional)
+    --refreshFixture    If set to true, the fixture is created again (optional, default: false)
+    --definitions       The relation definitions (optional, default: /scripts/definitions/network.yml)
+    --graph             The named graph of the materialised relations (optional, default: https://resource.jila.zb.uzh.ch/graph/network)
+    --schemas           Comma-separated list of RDFS schemas used for the subclass closure of the relation queries (optional)
+    --schemaCacheFile   The JSON file in which the subclass closure is cached (optional)
+    --updateFiles       Comma-separated list of SPARQL update files (optional, default: /scripts/queries/addRelations.sparql,/scripts/queries/cleanup.sparql)
+    --propsFile         The ui.prop file containing the thumbnail queries (optional)
+    --baseline          The JSON file with the baseline (optional, default: /data/benchmark/baseline.json)
+    --report            Path to a JSON file to which the results are written (optional)
+    --repeat            The number of runs, the median duration is compared (optional, default: 1)
+    --tolerance         The factor by which the duration of a step may exceed the baseline (optional, default: 1.5)
+    --updateBaseline    If set to true, the results are stored as baseline (optional, default: false)
+    --serve             If set to true, the endpoint is only loaded with the fixture and serves requests until interrupted (optional, default: false)
+    --port              The port of the endpoint (optional, default: a free port)
+"""
+
+import json
+import os
+import re
+import requests
+import sys
+import time
+import yaml
+
+from glob import glob
+from hashlib import blake2b
+from statistics import median
+
+from cacheThumbnails import getThumbnailQueries, queryThumbnails
+from lib.sparqlEndpoint import SparqlEndpoint
+from lib.tripleStore import TripleStore
+from materialiseRelations import executeStep, generateRelationQueries, generateRelinkQuery, generateReverseQuery, loadSubclasses
+from runSparqlUpdates import executeUpdate, splitStatements
+
+# Durations below this number of seconds are not compared, as they are dominated by noise
+MIN_COMPARED_DURATION = 0.05
+
+def performBenchmark(options):
+    if options['refreshFixture'] or not os.path.isfile(options['fixtureFile']):
+        if not options['inputs']:
+            print("No fixture found at %s, please provide the input files via the --inputs argument" % options['fixtureFile'])
+            sys.exit(1)
+        createFixture(options)
+    with open(options['fixtureFile'], 'rb') as f:
+        fixtureHash = blake2b(f.read(), digest_size=16).hexdigest()
+
+    if options['serve']:
+        serveFixture(options)
+        return
+
+    runs = []
+    for i in range(options['repeat']):
+        if options['repeat'] > 1:
+            print("Run %d of %d" % (i + 1, options['repeat']))
+        runs.append(runPipeline(options))
+
+    results = {}
+    for run in runs:
+        for entry in run:
+            result = results.setdefault(entry['id'], {"id": entry['id'], "durations": [], "counts": [], "error": None})
+            result['durations'].append(entry['duration'])
+            result['counts'].append(entry['count'])
+            result['error'] = result['error'] or entry['error']
+    for result in results.values():
+        result['duration'] = round(median(result['durations']), 3)
+        result['count'] = result['counts'][0]
+        if len(set(result['counts'])) > 1:
+            result['error'] = result['error'] or "The number of results differs between runs: %s" % result['counts']
+
+    if options['updateBaseline']:
+        failed = [d for d in results.values() if d['error']]
+        for result in failed:
+            print("%s failed: %s" % (result['id'], result['error']))
+        if failed:
+            print("Not updating the baseline, as %d steps failed" % len(failed))
+            sys.exit(1)
+        writeJson(options['baseline'], {
+            "fixture": fixtureHash,
+            "steps": {d['id']: {"duration": d['duration'], "count": d['count']} for d in results.values()}
+        })
+        print("Stored the results of %d steps as baseline in %s" % (len(results), options['baseline']))
+        return
+
+    baseline = None
+    if os.path.isfile(options['baseline']):
+        with open(options['baseline'], 'r') as f:
+            baseline = json.load(f)
+        if baseline['fixture'] != fixtureHash:
+            print("The fixture changed since the baseline was recorded, use --updateBaseline true to record a new baseline")
+            sys.exit(1)
+    else:
+        print("No baseline found at %s, use --updateBaseline true to record one" % options['baseline'])
+
+    failures = compareResults(list(results.values()), baseline['steps'] if baseline else {}, tolerance=options['tolerance'])
+
+    if options['report']:
+        writeJson(options['report'], {
+            "started": time.strftime('%Y-%m-%dT%H:%M:%S'),
+            "fixture": fixtureHash,
+            "steps": [{k: d[k] for k in ['id', 'duration', 'count', 'error', 'status']} for d in results.values()]
+        })
+
+    slowest = sorted(results.values(), key=lambda d: d['duration'], reverse=True)[:10]
+    print("")
+    for result in slowest:
+        print("%8.3fs %10s  %s" % (result['duration'], result['count'] if result['count'] is not None else '?', result['id']))
+    print("Benchmarked %d steps: %d failures" % (len(results), len(failures)))
+    if failures:
+        sys.exit(1)
+
+def compareResults(results, baseline, *, tolerance=1.5):
+    """
+    Compare the results to the baseline and print the differences.
+    :param results: List of results with id, duration, count and error
+    :param baseline: Dictionary of step ids and their duration and count
+    :param tolerance: The factor by which the duration may exceed the baseline
+    :return: List of the ids of the failed steps
+    """
+    failures = []
+    for result in results:
+        expected = baseline.get(result['id'])
+        if result['error']:
+            result['status'] = 'failed'
+            print("FAILED %s: %s" % (result['id'], result['error']))
+        elif expected is None:
+            result['status'] = 'new'
+            if baseline:
+                print("NEW %s: %.3fs, %s results" % (result['id'], result['duration'], result['count']))
+            continue
+        elif result['count'] != expected['count']:
+            result['status'] = 'changed'
+            print("CHANGED %s: %s results instead of %s" % (result['id'], result['count'], expected['count']))
+        elif result['duration'] > max(expected['duration'], MIN_COMPARED_DURATION) * tolerance:
+            result['status'] = 'slower'
+            print("SLOWER %s: %.3fs instead of %.3fs" % (result['id'], result['duration'], expected['duration']))
+        else:
+            result['status'] = 'ok'
+            continue
+        failures.append(result['id'])
+    for stepId in baseline:
+        if stepId not in set(d['id'] for d in results):
+            print("MISSING %s" % stepId)
+            failures.append(stepId)
+    return failures
+
+def runPipeline(options):
+    """
+    Start a local endpoint, load the fixture and run the steps of the pipeline against it.
+    :return: List of dictionaries with the id, duration, number of results and error (if any) of every step
+    """
+    endpoint = SparqlEndpoint()
+    url = endpoint.start()
+    results = []
+    try:
+        results.append(timeStep('ingest', lambda: ingestFile(url, options['fixtureFile'])))
+
+        with open(options['definitions'], 'r') as f:
+            model = yaml.safe_load(f)
+        namedGraph = options['graph']
+        steps = [('drop', "DROP SILENT GRAPH <%s>" % namedGraph)]
+        steps += generateRelationQueries(model, namedGraph=namedGraph, subclasses=loadSubclasses(options))
+        steps += [('relink', generateRelinkQuery(namedGraph=namedGraph)), ('reverse', generateReverseQuery(namedGraph=namedGraph))]
+        for stepId, query in steps:
+            results.append(timeStep('materialise-network#%s' % stepId, lambda: countMutations(endpoint, lambda: executeStep(stepId, url, query))))
+
+        for updateFile in options['updateFiles'].split(','):
+            with open(updateFile.strip(), 'r', encoding='utf-8') as f:
+                statements = splitStatements(f.read())
+            for statement in statements:
+                stepId = "%s#%d %s" % (os.path.basename(updateFile.strip()), statement['index'] + 1, statement['label'])
+                results.append(timeStep(stepId, lambda: countMutations(endpoint, lambda: executeUpdate(url, statement['query']))))
+
+        if options['propsFile']:
+            queries = getThumbnailQueries(options['propsFile'])
+            results.append(timeStep('cache-thumbnails#queryThumbnails', lambda: sum(1 for _ in queryThumbnails(endpoint=url, queries=queries))))
+
+        for graph, count in countGraphStatements(url).items():
+            results.append({"id": "statements in %s" % graph, "duration": 0, "count": count, "error": None})
+    finally:
+        endpoint.stop()
+    return results
+
+def timeStep(stepId, function):
+    """
+    Execute a step and measure its duration.
+    :param stepId: The identifier of the step
+    :param function: The function executing the step, returning the number of results
+    :return: A dictionary with the id, duration, number of results and error (if any)
+    """
+    startTime = time.time()
+    count = None
+    error = None
+    try:
+        count = function()
+    except Exception as e:
+        error = str(e)
+    duration = time.time() - startTime
+    print("%-70s %8.3fs %10s" % (stepId[:70], duration, count if count is not None else 'failed'))
+    return {"id": stepId, "duration": round(duration, 3), "count": count, "error": error}
+
+def countMutations(endpoint, function):
+    """
+    Execute an update step and read the numbers of removed and added statements from the local endpoint,
+    as the mutation count reported to the pipeline is their sum and does not reveal a rewrite.
+    :param endpoint: The local SparqlEndpoint
+    :param function: The function executing the update
+    :return: The numbers of removed and added statements as '-<removed> +<added>'
+    """
+    function()
+    removed, added = endpoint.lastMutations
+    return "-%d +%d" % (removed, added)
+
+def ingestFile(endpoint, filename, *, graph=None):
+    """
+    Load an N-Quads file via the REST API, as done by the ingest-data-from-file task
+    :return: The number of statements added
+    """
+    with open(filename, 'rb') as f:
+        response = requests.post(endpoint, params={'context-uri': graph} if graph else None, data=f, headers={'Content-Type': 'application/n-quads'})
+    response.raise_for_status()
+    modified = re.search(r'modified="(\d+)"', response.text)
+    return int(modified.group(1)) if modified else None
+
+def countGraphStatements(endpoint):
+    """
+    Count the statements per named graph
+    :return: Dictionary of graph IRIs and number of statements
+    """
+    response = requests.post(endpoint, data={'query': "SELECT ?g (COUNT(*) AS ?count) WHERE { GRAPH ?g { ?s ?p ?o } } GROUP BY ?g"}, headers={'Accept': 'application/sparql-results+json'})
+    response.raise_for_status()
+    counts = {d['g']['value']: int(d['count']['value']) for d in response.json()['results']['bindings']}
+    return dict(sorted(counts.items()))
+
+def createFixture(options):
+    """
+    Create the fixture from a sample of the subjects of the sample graph and the resources
+    they link to, and write it as N-Quads.
+    """
+    store = TripleStore()
+    for graph, pattern in options['inputs']:
+        filenames = sorted(glob(pattern))
+        if not filenames:
+            print("Warning: No files found for %s" % pattern)
+        for filename in filenames:
+            store.loadFile(filename, graph=graph)
+    print("Loaded %d triples" % store.size)
+
+    quadsBySubject = {}
+    for graphId, triples in store.graphs.items():
+        for s, p, o in triples:
+            quadsBySubject.setdefault(s, []).append((s, p, o, graphId))
+
+    sampleGraphId = store.termIds.get('<%s>' % options['sampleGraph'])
+    candidates = sorted(set(s for s, p, o in store.graphs.get(sampleGraphId, ()) if store.terms[s].startswith('<')), key=lambda d: store.terms[d])
+    if not candidates:
+        print("No subjects found in the graph %s" % options['sampleGraph'])
+        sys.exit(1)
+    # Take evenly spaced subjects, so that the sample covers the different kinds of records
+    sample = candidates[::max(len(candidates) // options['sampleSize'], 1)][:options['sampleSize']]
+
+    quads = set()
+    visited = set(sample)
+    frontier = set(sample)
+    for hop in range(options['hops'] + 1):
+        linked = set()
+        for s in frontier:
+            for quad in quadsBySubject.get(s, []):
+                quads.add(quad)
+                if quad[2] not in visited and not store.terms[quad[2]].startswith('"'):
+                    linked.add(quad[2])
+        visited |= linked
+        frontier = linked
+
+    for graph in options['completeGraphs']:
+        graphId = store.termIds.get('<%s>' % graph)
+        quads |= set((s, p, o, graphId) for s, p, o in store.graphs.get(graphId, ()))
+
+    if os.path.dirname(options['fixtureFile']):
+        os.makedirs(os.path.dirname(options['fixtureFile']), exist_ok=True)
+    tmpFilename = options['fixtureFile'] + ".tmp"
+    with open(tmpFilename, 'w', encoding='utf-8') as f:
+        for s, p, o, g in sorted(quads, key=lambda d: (store.terms[d[3]], store.terms[d[0]], store.terms[d[1]], store.terms[d[2]])):
+            f.write("%s %s %s %s .\n" % (store.terms[s], store.terms[p], store.terms[o], store.terms[g]))
+    os.replace(tmpFilename, options['fixtureFile'])
+    print("Wrote %d statements about %d sampled subjects to %s" % (len(quads), len(sample), options['fixtureFile']))
+
+def serveFixture(options):
+    endpoint = SparqlEndpoint(port=options['port'])
+    url = endpoint.start()
+    print("Loaded %d statements" % ingestFile(url, options['fixtureFile']))
+    print("Serving the fixture at %s, press Ctrl+C to stop" % url)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    endpoint.stop()
+
+def writeJson(filename, data):
+    if os.path.dirname(filename):
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmpFilename = filename + ".tmp"
+    with open(tmpFilename, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmpFilename, filename)
+
+if __name__ == "__main__":
+    options = {}
+
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            if not sys.argv[i + 2].startswith("--"):
+                options[arg[2:]] = sys.argv[i + 2]
+            else:
+                print("Malformed arguments")
+                sys.exit(1)
+
+    inputs = []
+    for entry in (options['inputs'].split(',') if 'inputs' in options else []):
+        if '=' in entry and not entry.startswith('/') and not entry.startswith('.'):
+            graph, pattern = entry.rsplit('=', 1)
+        else:
+            graph, pattern = None, entry
+        inputs.append((graph.strip() if graph else None, pattern.strip()))
+    options['inputs'] = inputs
+
+    if not 'fixtureFile' in options:
+        options['fixtureFile'] = '/data/benchmark/fixture.nq'
+    if not 'sampleGraph' in options:
+        options['sampleGraph'] = 'https://resource.jila.zb.uzh.ch/graph/main'
+    options['sampleSize'] = int(options['sampleSize']) if 'sampleSize' in options else 200
+    options['hops'] = int(options['hops']) if 'hops' in options else 2
+    options['completeGraphs'] = [d.strip() for d in options['completeGraphs'].split(',') if d.strip()] if 'completeGraphs' in options else []
+    options['refreshFixture'] = 'refreshFixture' in options and options['refreshFixture'].lower() == 'true'
+    if not 'definitions' in options:
+        options['definitions'] = '/scripts/definitions/network.yml'
+    if not 'graph' in options:
+        options['graph'] = 'https://resource.jila.zb.uzh.ch/graph/network'
+    if not 'schemas' in options:
+        options['schemas'] = None
+    if not 'schemaCacheFile' in options:
+        options['schemaCacheFile'] = None
+    if not 'updateFiles' in options:
+        options['updateFiles'] = '/scripts/queries/addRelations.sparql,/scripts/queries/cleanup.sparql'
+    if not 'propsFile' in options:
+        options['propsFile'] = None
+    if not 'baseline' in options:
+        options['baseline'] = '/data/benchmark/baseline.json'
+    if not 'report' in options:
+        options['report'] = None
+    options['repeat'] = int(options['repeat']) if 'repeat' in options else 1
+    options['tolerance'] = float(options['tolerance']) if 'tolerance' in options else 1.5
+    options['updateBaseline'] = 'updateBaseline' in options and options['updateBaseline'].lower() == 'true'
+    options['serve'] = 'serve' in options and options['serve'].lower() == 'true'
+    options['port'] = int(options['port']) if 'port' in options else 0
+
+    performBenchmark(options)
@@ -1,13 +1,22 @@
+import gzip
 import json
+import os
 import requests
-import threading
+import time
 import urllib
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from lxml import etree
 from os import listdir
 from os.path import isfile, join
 from tqdm import tqdm
 
+from lib.cache import getHttpCache, CacheMissError
+from lib.utils import RateLimiter
+
+# HTTP status codes after which a request is retried
+RETRY_STATUS_CODES = [429, 500, 502, 503, 504]
+
 def performCaching(options):
     oaiXMLFolder = options['oaiXMLFolder']
     outputFolder = options['outputFolder']
@@ -15,68 +24,182 @@ def performCaching(options):
     limit = options['limit']
 
     # Extract manifests from XML files from input folder
-    manifests = extractManifests(oaiXMLFolder)
-
-    messages = fetchManifests(manifests, outputFolder, offset=offset, limit=limit)
+    manifests = extractManifests(oaiXMLFolder, cacheFile=options['manifestUrlCacheFile'], maxWorkers=options['maxWorkers'],
+                                 reducedFolder=options['oaiReducedFolder'] if 'oaiReducedFolder' in options else None)
+
+    startTime = time.time()
+    messages = fetchManifests(manifests, outputFolder, offset=offset, limit=limit,
+                              refresh=options['refresh'], maxWorkers=options['maxRequests'],
+                              requestsPerSecond=options['requestsPerSecond'], timeout=options['timeout'],
+                              maxAttempts=options['maxAttempts'])
+    elapsed = max(time.time() - startTime, 0.001)
     errors = [m for m in messages if m['status'] == 'error']
     print("Found %d manifests" % len(manifests))
     print("Retrieved %d manifests" % len([m for m in messages if m['status'] == "success"]))
+    if options['refresh']:
+        print("Revalidated %d manifests, of which %d changed" % (len([m for m in messages if m['status'] in ["updated", "unchanged"]]), len([m for m in messages if m['status'] == "updated"])))
+    print("Served %d responses from the HTTP cache" % len([m for m in messages if m.get('fromCache')]))
+    print("Processed %d requests in %.1fs (%.1f requests/s, %.1f MB)" % (len(messages), elapsed, len(messages) / elapsed, sum(m.get('bytes', 0) for m in messages) / 1e6))
     print("Already cached %d manifests" % len([d for d in listdir(outputFolder) if d.endswith(".json")]))
     if len(errors):
         print("Encountered the following errors:")
         for m in errors:
             print("    " + str(m['error']) + ": " + m['url'])
 
-def extractManifests(inputFolder):
+def extractManifests(inputFolder, *, cacheFile=None, maxWorkers=None, reducedFolder=None):
     """
     Read the XML files in the given input folder and add the manifests contained in
-    the <dv:presentation> element to a list.
+    the <dv:iiif> element to a list. If a folder with reduced records is given, the
+    compressed records in it (ending in .xml.gz) are read instead of the full records.
+    The files are parsed in parallel. If a cache file is given, the manifests extracted from
+    every file are stored together with the modification time and size of the file, so that
+    unchanged files are not parsed again in subsequent runs.
 
     :param inputFolder: The folder containing the XML files.
+    :param cacheFile: The JSON file in which the extracted manifests are cached (optional).
+    :param maxWorkers: The number of processes used for parsing (optional, default: number of CPUs).
+    :param reducedFolder: The folder containing the reduced and compressed records (optional).
+    :return: A sorted list of manifests.
+    """
+    cache = {}
+    if cacheFile and isfile(cacheFile):
+        try:
+            with open(cacheFile, 'r') as f:
+                cache = json.load(f)
+        except ValueError:
+            print("Ignoring invalid manifest cache file %s" % cacheFile)
+
+    files = {}
+    paths = {}
+    for folder, extension in [(inputFolder, ".xml"), (reducedFolder, ".xml.gz")]:
+        if not folder:
+            continue
+        for filename in listdir(folder):
+            if filename.endswith(extension) and isfile(join(folder, filename)):
+                if folder == inputFolder and reducedFolder and isfile(join(reducedFolder, filename + ".gz")):
+                    continue
+                stat = os.stat(join(folder, filename))
+                files[filename] = [stat.st_mtime_ns, stat.st_size]
+                paths[filename] = join(folder, filename)
+
+    toParse = [d for d in files if d not in cache or cache[d]['stat'] != files[d]]
+    print("Extracting manifests from %d of %d files (%d unchanged)" % (len(toParse), len(files), len(files) - len(toParse)))
+
+    if len(toParse):
+        with ProcessPoolExecutor(max_workers=maxWorkers) as executor:
+            results = executor.map(extractManifestsFromFile, [paths[d] for d in toParse], chunksize=64)
+            for filename, urls in tqdm(zip(toParse, results), total=len(toParse)):
+                cache[filename] = {"stat": files[filename], "manifests": urls}
+
+    # Remove files that no longer exist from the cache
+    cache = {k: v for k, v in cache.items() if k in files}
+
+    if cacheFile and len(toParse):
+        tmpFilename = cacheFile + ".tmp"
+        with open(tmpFilename, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmpFilename, cacheFile)
+
+    return sorted(set(url for entry in cache.values() for url in entry['manifests']))
+
+def extractManifestsFromFile(filename):
+    """
+    Extract the manifests contained in the <dv:iiif> elements of an XML file.
+    The file is streamed, only the <dv:iiif> elements are built. Gzip compressed files (ending in .gz)
+    are decompressed. In reduced records, the element has no namespace.
+
+    :param filename: The path to the XML file.
     :return: A list of manifests.
     """
     manifests = []
-    for filename in tqdm(listdir(inputFolder)):
-        if isfile(join(inputFolder, filename)) and filename.endswith(".xml"):
-            with open(join(inputFolder, filename), 'r') as f:
-                xml = f.read()
-            root = etree.fromstring(xml)
-            for presentation in root.findall(".//dv:iiif", namespaces={"dv": "http://dfg-viewer.de/"}):
-                manifests.append(presentation.text)
-    return list(set(manifests))
-
-def fetchManifests(manifests, outputFolder, *, offset, limit):
+    with (gzip.open(filename, 'rb') if filename.endswith('.gz') else open(filename, 'rb')) as f:
+        for _, elem in etree.iterparse(f, events=('end',), tag=['{http://dfg-viewer.de/}iiif', 'iiif']):
+            if elem.text:
+                manifests.append(elem.text)
+            elem.clear()
+    return manifests
+
+def fetchManifests(manifests, outputFolder, *, offset, limit, refresh=False, maxWorkers=8, requestsPerSecond=5, timeout=30, maxAttempts=3):
     """
-    Fetch the manifests from the given list and write them to the given output folder.
+    Fetch the manifests from the given list concurrently and write them to the given output folder.
+    Manifests that are already present are skipped, unless refresh is set, in which case they are
+    revalidated with a conditional request and only rewritten if they have changed.
     Returns a list of messages indicating the status of the fetching.
+
+    :param manifests: List of manifest URLs
+    :param outputFolder: The folder to write the manifests to
+    :param offset: The index of the first manifest to fetch
+    :param limit: The maximum number of manifests to fetch
+    :param refresh: If True, manifests that are already present are revalidated
+    :param maxWorkers: The number of concurrent requests
+    :param requestsPerSecond: The maximum number of requests per second and host
+    :param timeout: Timeout of a request in seconds
+    :param maxAttempts: The number of attempts per manifest
     """
     urlsAndFilenames = [{
         "manifest": d,
         "filename": join(outputFolder, urllib.parse.quote(d, safe='')) + '.json'
         } for d in manifests]
 
+    rows = [d for d in urlsAndFilenames[offset:offset + limit] if d['manifest'] and (refresh or not isfile(d['filename']))]
+
+    # Allow as many pooled connections per host as there are workers
+    cache = getHttpCache()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=maxWorkers, pool_maxsize=maxWorkers)
+    cache.session.mount('http://', adapter)
+    cache.session.mount('https://', adapter)
+    rateLimiter = RateLimiter(requestsPerSecond=requestsPerSecond)
+
     messages = []
-    for row in tqdm(urlsAndFilenames[offset:offset + limit]):
-        if not isfile(row['filename']):
-            if row['manifest']:
-                messages.append(fetchJsonFile(row['manifest'], row['filename']))
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        futures = [executor.submit(fetchJsonFile, row['manifest'], row['filename'],
+                                   revalidate=refresh, rateLimiter=rateLimiter, timeout=timeout, maxAttempts=maxAttempts) for row in rows]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            messages.append(future.result())
     return messages
 
-def fetchJsonFile(url, filename):
+def fetchJsonFile(url, filename, *, revalidate=False, rateLimiter=None, timeout=30, maxAttempts=3):
     """
     Fetch the JSON file at the given URL and write it to the given filename.
+    The request is routed through the shared HTTP cache. If revalidate is set, the cached response
+    is revalidated with the server and the file is only rewritten if its content has changed.
+    Timeouts, connection errors and temporary server errors are retried with exponential backoff.
     Returns a message indicating the status of the fetching.
     """
-    try:
-        urlHandler = urllib.request.urlopen(url)
-        data = urlHandler.read()
-        content = json.loads(data.decode('utf-8'))
-        with open(filename, 'w') as f:
-            json.dump(content, f, indent=4)
-        return {"status": "success"}
-    except urllib.error.HTTPError as e:
-        return {"status": "error", "error": e, "url": url}
-        
+    for attempt in range(1, maxAttempts + 1):
+        try:
+            if rateLimiter:
+                rateLimiter.wait(url)
+            response = getHttpCache().get(url, timeout=timeout, ttl=0 if revalidate else None)
+            if response.status_code in RETRY_STATUS_CODES and attempt < maxAttempts:
+                time.sleep(2 ** attempt)
+                continue
+            if response.status_code != 200:
+                return {"status": "error", "error": "HTTP Error %d" % response.status_code, "url": url}
+            serialised = json.dumps(response.json(), indent=4)
+            break
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            if attempt == maxAttempts:
+                return {"status": "error", "error": e, "url": url}
+            time.sleep(2 ** attempt)
+        except (requests.exceptions.RequestException, CacheMissError, ValueError) as e:
+            return {"status": "error", "error": e, "url": url}
+
+    message = {"url": url, "fromCache": response.fromCache, "bytes": 0 if response.fromCache else len(response.content)}
+    if isfile(filename):
+        with open(filename, 'r') as f:
+            if f.read() == serialised:
+                message['status'] = "unchanged"
+                return message
+        message['status'] = "updated"
+    else:
+        message['status'] = "success"
+    tmpFilename = filename + ".tmp"
+    with open(tmpFilename, 'w') as f:
+        f.write(serialised)
+    os.replace(tmpFilename, filename)
+    return message
+
 
 
 
@@ -110,4 +233,19 @@ if __name__ == "__main__":
     else:
         options['limit'] = 999999
 
+    if 'maxWorkers' in options:
+        options['maxWorkers'] = int(options['maxWorkers'])
+    else:
+        options['maxWorkers'] = None
+
+    options['refresh'] = 'refresh' in options and options['refresh'].lower() == 'true'
+
+    options['maxRequests'] = int(options['maxRequests']) if 'maxRequests' in options else 8
+    options['requestsPerSecond'] = float(options['requestsPerSecond']) if 'requestsPerSecond' in options else 5
+    options['timeout'] = int(options['timeout']) if 'timeout' in options else 30
+    options['maxAttempts'] = int(options['maxAttempts']) if 'maxAttempts' in options else 3
+
+    if not 'manifestUrlCacheFile' in options:
+        options['manifestUrlCacheFile'] = join(options['oaiXMLFolder'], 'manifest-urls.json')
+
     performCaching(options)
\ No newline at end of file
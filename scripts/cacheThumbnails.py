@@ -18,22 +18,44 @@ Parameters
     --thumbnailPrefix       The prefix to use for the filenames of the thumbnails (optional, default: thumbnail-)
     --thumbnailPredicate    The predicate to use for the statements about the thumbnails (optional, default: http://schema.org.thumbnail)
     --filterCondition       A string that can be used to filter the thumbnail queries. Only queries containing the string are executed (optional)
+    --maxDownloads          The number of concurrent downloads (optional, default: 4)
+    --maxProcesses          The number of processes used for resizing the images (optional, default: number of CPUs)
+    --requestsPerSecond     The maximum number of requests per second and host (optional, default: 2)
+    --stateFile             Path to the SQLite file in which the state of the thumbnails is stored (optional, default: /data/cache/thumbnails.sqlite)
+    --pageSize              The number of results retrieved per page of the thumbnail query (optional, default: 10000)
+    --ingestChunkSize       The maximum number of thumbnails ingested per request (optional, default: 5000)
+    --forceIngest           If set to true, all thumbnails are ingested, including those that have been ingested before (optional, default: false)
+    --serverSideResize      Whether to request images that are already scaled down from Wikimedia Commons and IIIF image servers.
+                            The originals are only downloaded if this fails (optional, default: true)
 """
 
 
+import io
 import re
 import requests
+import sqlite3
 import sys
+import tempfile
 import time
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from PIL import Image
-from urllib import request
 from configparser import ConfigParser
 from hashlib import blake2b
 from string import Template
-from SPARQLWrapper import SPARQLWrapper, JSON
+from urllib.parse import urlparse, urlencode, parse_qsl, urlunparse
 from tqdm import tqdm
 
+from lib.cache import USER_AGENT
+from lib.utils import RateLimiter
+
+# Number of seconds after which a failed thumbnail is retried. The delay doubles with every failed attempt.
+RETRY_BACKOFF = 60 * 60
+MAX_RETRY_BACKOFF = 30 * 24 * 60 * 60
+
+# Matches IIIF Image API URLs of the form {base}/{region}/{size}/{rotation}/{quality}.{format}
+IIIF_IMAGE_URL_PATTERN = re.compile(r'^(?P<base>.+)/(?P<region>[^/]+)/(?P<size>[^/]+)/(?P<rotation>!?\d+(\.\d+)?)/(?P<quality>default|color|gray|grey|bitonal|native)\.(?P<format>jpg|jpeg|png|gif|tif|webp)$')
+
 def performCaching(options):
     propsFile = options['propsFile']
     outputDir = options['outputDir']
@@ -46,69 +68,393 @@ def performCaching(options):
     filterCondition = options['filterCondition'] if 'filterCondition' in options else None
     
     queries = getThumbnailQueries(propsFile, filterCondition=filterCondition)
-    thumbnails = queryThumbnails(endpoint=endpoint, queries=queries)
 
-    print("Processing %d thumbnails" % len(thumbnails))
-    
-    downloadAll(data=thumbnails,
-                prefix=thumbnailPrefix,
-                directory=outputDir)
-    verifiedThumbnails = verifyThumbnails(data=thumbnails, directory=outputDir, prefix=thumbnailPrefix)
-
-    print("Downloaded %d out of %d thumbnails" % (len(verifiedThumbnails), len(thumbnails)))
-
-    r = ingestToTriplestore(endpoint=endpoint,
-                        prefix=thumbnailPrefix,
-                        data=verifiedThumbnails, 
-                        graph=namedGraph,
-                        location=thumbnailLocation, 
-                        predicate=thumbnailPredicate
-    )
-    print(r.text)
-
-def downloadAsThumbnail(*, url, directory, prefix, targetWidth=400):
+    store = ThumbnailStateStore(options['stateFile'])
+
+    # The thumbnails are written to a temporary file while they are streamed to the downloader,
+    # so that downloads start before the query has finished and the results are not kept in memory
+    with tempfile.TemporaryFile('w+', encoding='utf-8') as spool:
+        def collect(rows):
+            for row in rows:
+                spool.write("%s\t%s\n" % (row['subject'], row['thumbnail']))
+                yield row
+
+        def readSpool():
+            spool.seek(0)
+            for line in spool:
+                subject, thumbnail = line.rstrip('\n').split('\t')
+                yield {'subject': subject, 'thumbnail': thumbnail}
+
+        downloadAll(data=collect(queryThumbnails(endpoint=endpoint, queries=queries, pageSize=options['pageSize'])),
+                    prefix=thumbnailPrefix,
+                    directory=outputDir,
+                    store=store,
+                    maxDownloads=options['maxDownloads'],
+                    maxProcesses=options['maxProcesses'],
+                    requestsPerSecond=options['requestsPerSecond'],
+                    serverSideResize=options['serverSideResize'])
+        spool.flush()
+        numThumbnails = sum(1 for _ in readSpool())
+        print("Processed %d thumbnails" % numThumbnails)
+        numVerified = sum(1 for _ in verifyThumbnails(data=readSpool(), directory=outputDir, prefix=thumbnailPrefix))
+
+        print("Downloaded %d out of %d thumbnails" % (numVerified, numThumbnails))
+
+        if options['forceIngest']:
+            store.clearIngested(graph=namedGraph)
+        summary = ingestToTriplestore(endpoint=endpoint,
+                            prefix=thumbnailPrefix,
+                            data=verifyThumbnails(data=readSpool(), directory=outputDir, prefix=thumbnailPrefix),
+                            graph=namedGraph,
+                            location=thumbnailLocation, 
+                            predicate=thumbnailPredicate,
+                            store=store,
+                            chunkSize=options['ingestChunkSize']
+        )
+    print("Ingested %d thumbnails in %d requests, removed %d outdated thumbnails, %d thumbnails were already ingested" % (
+        summary['ingested'], summary['requests'], summary['removed'], summary['skipped']))
+
+class ThumbnailStateStore:
     """
-    Downloads the thumbnail from a given URL into a direcory.
-    Thumbnails are resized to a specified maximum width.
-    The filename is generated from the URL (hashed) and prefixed with the given prefix.
-    :param url: The URL of the thumbnail
-    :param directory: The directory to store the thumbnail
-    :param prefix: The prefix to use for the filename
+    Persistent store for the state of the thumbnails, backed by SQLite.
+    For every source URL and output directory it keeps the filename of the thumbnail, whether it
+    could be created, the number of failed attempts, the last error and the size of the source and the thumbnail.
+    Failed thumbnails are only retried after a delay that doubles with every failed attempt.
+
+    :param filename: Path to the SQLite file
+    """
+
+    def __init__(self, filename):
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS thumbnails (
+                directory TEXT NOT NULL,
+                url TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                lastError TEXT,
+                lastAttempt REAL,
+                sourceSize INTEGER,
+                outputSize INTEGER,
+                PRIMARY KEY (directory, url)
+            )""")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS ingested (
+                graph TEXT NOT NULL,
+                predicate TEXT NOT NULL,
+                location TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                url TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                PRIMARY KEY (graph, predicate, location, subject, url)
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS ingestedFilename ON ingested (graph, predicate, location, filename)")
+        self.connection.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS current (
+                subject TEXT NOT NULL,
+                url TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                PRIMARY KEY (subject, url)
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS temp.currentFilename ON current (filename)")
+        self.connection.commit()
+
+    def getState(self, directory, url):
+        """
+        Return the state of the thumbnail of the given URL and directory, or None if it is unknown.
+        """
+        cursor = self.connection.execute("SELECT url, filename, status, attempts, lastError, lastAttempt, sourceSize, outputSize FROM thumbnails WHERE directory = ? AND url = ?", (directory, url))
+        row = cursor.fetchone()
+        keys = ['url', 'filename', 'status', 'attempts', 'lastError', 'lastAttempt', 'sourceSize', 'outputSize']
+        return dict(zip(keys, row)) if row else None
+
+    def isDue(self, state, now=None):
+        """
+        Return whether a failed thumbnail should be retried.
+        """
+        if state['status'] != 'failed':
+            return True
+        now = now if now else time.time()
+        backoff = min(RETRY_BACKOFF * 2 ** max(state['attempts'] - 1, 0), MAX_RETRY_BACKOFF)
+        return now - (state['lastAttempt'] or 0) >= backoff
+
+    def setSuccess(self, *, directory, url, filename, sourceSize=None, outputSize=None):
+        self.connection.execute("""
+            INSERT INTO thumbnails (directory, url, filename, status, attempts, lastError, lastAttempt, sourceSize, outputSize)
+            VALUES (?, ?, ?, 'ok', 0, NULL, ?, ?, ?)
+            ON CONFLICT (directory, url) DO UPDATE SET filename = excluded.filename, status = 'ok', attempts = 0, lastError = NULL,
+                lastAttempt = excluded.lastAttempt, sourceSize = COALESCE(excluded.sourceSize, sourceSize), outputSize = COALESCE(excluded.outputSize, outputSize)
+            """, (directory, url, filename, time.time(), sourceSize, outputSize))
+
+    def setFailure(self, *, directory, url, filename, error):
+        self.connection.execute("""
+            INSERT INTO thumbnails (directory, url, filename, status, attempts, lastError, lastAttempt)
+            VALUES (?, ?, ?, 'failed', 1, ?, ?)
+            ON CONFLICT (directory, url) DO UPDATE SET filename = excluded.filename, status = 'failed', attempts = attempts + 1,
+                lastError = excluded.lastError, lastAttempt = excluded.lastAttempt
+            """, (directory, url, filename, str(error), time.time()))
+
+    def setCurrent(self, rows):
+        """
+        Store the (subject, url, filename) tuples of the current thumbnails in a temporary table,
+        against which the ingested thumbnails are compared. The rows are consumed as a stream.
+        """
+        self.connection.execute("DELETE FROM current")
+        self.connection.executemany("INSERT OR IGNORE INTO current (subject, url, filename) VALUES (?, ?, ?)", rows)
+        self.connection.commit()
+
+    def countCurrent(self):
+        return self.connection.execute("SELECT COUNT(*) FROM current").fetchone()[0]
+
+    def getIngestedSample(self, *, graph, predicate, location):
+        """
+        Return one (subject, url, filename) tuple that has been ingested to the given graph, or None.
+        """
+        cursor = self.connection.execute("SELECT subject, url, filename FROM ingested WHERE graph = ? AND predicate = ? AND location = ? ORDER BY subject, url LIMIT 1", (graph, predicate, location))
+        return cursor.fetchone()
+
+    def getNotIngested(self, *, graph, predicate, location, limit=None):
+        """
+        Return the current (subject, url, filename) tuples that have not been ingested to the given graph.
+        """
+        cursor = self.connection.execute("""
+            SELECT subject, url, filename FROM current c WHERE NOT EXISTS (
+                SELECT 1 FROM ingested i WHERE i.graph = ? AND i.predicate = ? AND i.location = ?
+                    AND i.subject = c.subject AND i.url = c.url AND i.filename = c.filename)
+            ORDER BY subject, url LIMIT ?
+            """, (graph, predicate, location, limit if limit else -1))
+        return cursor.fetchall()
+
+    def countNotIngested(self, *, graph, predicate, location):
+        cursor = self.connection.execute("""
+            SELECT COUNT(*) FROM current c WHERE NOT EXISTS (
+                SELECT 1 FROM ingested i WHERE i.graph = ? AND i.predicate = ? AND i.location = ?
+                    AND i.subject = c.subject AND i.url = c.url AND i.filename = c.filename)
+            """, (graph, predicate, location))
+        return cursor.fetchone()[0]
+
+    def getOutdated(self, *, graph, predicate, location):
+        """
+        Return the ingested thumbnails of current subjects that are no longer current, as (subject, url, filename, inUse)
+        tuples. inUse is 1 if the file is still linked to a current thumbnail or to a subject that is not current.
+        """
+        cursor = self.connection.execute("""
+            SELECT i.subject, i.url, i.filename,
+                EXISTS (SELECT 1 FROM current c WHERE c.filename = i.filename)
+                OR EXISTS (SELECT 1 FROM ingested j WHERE j.graph = i.graph AND j.predicate = i.predicate AND j.location = i.location
+                    AND j.filename = i.filename AND j.subject NOT IN (SELECT subject FROM current))
+            FROM ingested i
+            WHERE i.graph = ? AND i.predicate = ? AND i.location = ?
+                AND i.subject IN (SELECT subject FROM current)
+                AND NOT EXISTS (SELECT 1 FROM current c WHERE c.subject = i.subject AND c.url = i.url AND c.filename = i.filename)
+            """, (graph, predicate, location))
+        return cursor.fetchall()
+
+    def addIngested(self, rows, *, graph, predicate, location):
+        self.connection.executemany("INSERT OR REPLACE INTO ingested (graph, predicate, location, subject, url, filename) VALUES (?, ?, ?, ?, ?, ?)",
+            [(graph, predicate, location) + tuple(row) for row in rows])
+        self.connection.commit()
+
+    def removeIngested(self, rows, *, graph, predicate, location):
+        self.connection.executemany("DELETE FROM ingested WHERE graph = ? AND predicate = ? AND location = ? AND subject = ? AND url = ?",
+            [(graph, predicate, location, row[0], row[1]) for row in rows])
+        self.connection.commit()
+
+    def clearIngested(self, *, graph):
+        self.connection.execute("DELETE FROM ingested WHERE graph = ?", (graph,))
+        self.connection.commit()
+
+    def commit(self):
+        self.connection.commit()
+
+def downloadImage(*, url, rateLimiter=None, targetWidth=400, serverSideResize=True):
+    """
+    Downloads the image at the given URL and returns its content.
+    This is run in the thread pool of the downloads, the content is then resized in the process pool.
+    If the image is served by Wikimedia Commons or a IIIF image server, a version scaled down
+    by the server is requested first. The original is only downloaded if this fails.
+    :param url: The URL of the image
+    :param rateLimiter: The rate limiter to use for the request (optional)
     :param targetWidth: The width to resize the thumbnail to
+    :param serverSideResize: Whether to request a version that is already scaled down by the server
+    :return: The content of the image
     """
-    filepath = os.path.join(directory, generateFilename(url, prefix))
-    if not os.path.exists(filepath):
-        time.sleep(1) # 1 second delay to avoid rate limiting
+    def fetch(imageUrl):
+        if rateLimiter:
+            rateLimiter.wait(imageUrl)
+        response = requests.get(imageUrl, headers={"User-Agent": USER_AGENT}, timeout=60)
+        if response.status_code != 200:
+            raise Exception("HTTP Error %d" % response.status_code)
+        if not response.headers.get('Content-Type', 'image/').startswith('image/'):
+            raise Exception("Unexpected content type %s" % response.headers['Content-Type'])
+        return response.content
+
+    scaledUrl = getScaledImageUrl(url, targetWidth) if serverSideResize else None
+    if scaledUrl and scaledUrl != url:
         try:
-            request.urlretrieve(url, filepath)
+            return fetch(scaledUrl)
         except Exception as e:
-            print("Error downloading image from url", url , e)
-            return
-        try:
-            img = Image.open(filepath, 'r')
-            (width, height) = (img.width, img.height)
-            if width > targetWidth:
-                img = img.resize((targetWidth, int(height/width*targetWidth)))
+            print("Could not retrieve scaled image, falling back to original", scaledUrl, e)
+    return fetch(url)
+
+def getScaledImageUrl(url, width):
+    """
+    Returns the URL of a version of the image that is scaled down to the given width by the server.
+    Supported are Special:FilePath URLs of Wikimedia Commons and IIIF Image API URLs.
+    For other URLs, None is returned.
+
+    >>> getScaledImageUrl("http://commons.wikimedia.org/wiki/Special:FilePath/Johannes%20Itten.jpg", 400)
+    'http://commons.wikimedia.org/wiki/Special:FilePath/Johannes%20Itten.jpg?width=400'
+    >>> getScaledImageUrl("https://www.e-manuscripta.ch/zuzcmi/i3f/v20/3602949/full/full/0/default.jpg", 400)
+    'https://www.e-manuscripta.ch/zuzcmi/i3f/v20/3602949/full/400,/0/default.jpg'
+    >>> getScaledImageUrl("https://www.e-manuscripta.ch/zuzcmi/i3f/v20/3602949/800,500,1200,1600/200,/0/default.jpg", 400)
+    'https://www.e-manuscripta.ch/zuzcmi/i3f/v20/3602949/800,500,1200,1600/200,/0/default.jpg'
+    >>> getScaledImageUrl("https://example.org/image.jpg", 400) is None
+    True
+
+    :param url: The URL of the image
+    :param width: The width of the scaled image
+    """
+    parsed = urlparse(url)
+    if parsed.netloc.endswith("wikimedia.org") and "/Special:FilePath/" in parsed.path:
+        query = [d for d in parse_qsl(parsed.query) if d[0] != 'width'] + [('width', str(width))]
+        return urlunparse(parsed._replace(query=urlencode(query)))
+
+    match = IIIF_IMAGE_URL_PATTERN.match(url)
+    if match:
+        size = match.group('size')
+        sizeMatch = re.match(r'^(\d+),(\d*)$', size)
+        if size in ['full', 'max'] or (sizeMatch and int(sizeMatch.group(1)) > width):
+            return "%s/%s/%d,/%s/%s.%s" % (match.group('base'), match.group('region'), width, match.group('rotation'), match.group('quality'), match.group('format'))
+        return url
+    return None
+
+def resizeImage(*, content, filepath, targetWidth=400):
+    """
+    Resizes the given image to a specified maximum width and stores it as JPEG.
+    This is run in the process pool. JPEG images are decoded at a reduced scale (draft mode),
+    so that large originals do not have to be decoded at full resolution.
+    :param content: The content of the image
+    :param filepath: The path to store the thumbnail
+    :param targetWidth: The width to resize the thumbnail to
+    :return: The size of the downloaded image and the thumbnail in bytes
+    """
+    try:
+        with Image.open(io.BytesIO(content)) as img:
+            if img.width > targetWidth:
+                targetSize = (targetWidth, int(img.height/img.width*targetWidth))
+                img.draft('RGB', targetSize)
+                img.thumbnail((targetWidth, img.height))
             if img.mode != 'RGB':
                 img = img.convert('RGB')
             img.save(filepath, 'jpeg', quality=75, optimize=True)
-        except Exception as e:
-            print("Error processing image", e)
+    except Exception:
+        if os.path.exists(filepath):
             os.remove(filepath)
-            return       
-            
-    return filepath
+        raise
+    return len(content), os.path.getsize(filepath)
 
-def downloadAll(*,data,directory,prefix):
+def downloadAll(*,data,directory,prefix,store=None,targetWidth=400,maxDownloads=4,maxProcesses=None,requestsPerSecond=2,serverSideResize=True):
     """
-    Given a list of dictionaries with keys 'subject' and 'thumbnail',
+    Given an iterable of dictionaries with keys 'subject' and 'thumbnail',
     download all thumbnails to the given directory with the given prefix for the filenames.
-    :param data: The list of dictionaries
+    Images are downloaded concurrently in a thread pool, which is where the requests are rate limited,
+    and the downloaded content is handed over to a process pool, which resizes it.
+    The rows are consumed as they are needed, so that the number of images that are being
+    downloaded or resized at any time, and thereby the memory used, is bounded.
+    If a state store is given, the outcome of every thumbnail is recorded and thumbnails that
+    failed before are skipped until their retry delay has passed.
+    :param data: The list (or iterable) of dictionaries
     :param directory: The directory to store the thumbnails
     :param prefix: The prefix to use for the filenames
+    :param store: The ThumbnailStateStore to use (optional)
+    :param targetWidth: The width to resize the thumbnails to
+    :param maxDownloads: The number of concurrent downloads
+    :param maxProcesses: The number of processes used for resizing
+    :param requestsPerSecond: The maximum number of requests per second and host
+    :param serverSideResize: Whether to request images that are already scaled down by the server
     """
-    for row in tqdm(data):
-        downloadAsThumbnail(url=row['thumbnail'], directory=directory, prefix=prefix)
+    existingFiles = set(os.listdir(directory))
+    now = time.time()
+
+    rateLimiter = RateLimiter(requestsPerSecond=requestsPerSecond)
+    # Images that are being downloaded or resized, or are waiting for either
+    maxPending = 2 * (maxDownloads + (maxProcesses or os.cpu_count() or 1))
+    sourceBytes = 0
+    outputBytes = 0
+    numImages = 0
+    numDeferred = 0
+    numSubmitted = 0
+    seen = set()
+    startTime = time.time()
+    rows = iter(data)
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=maxDownloads) as downloader, ProcessPoolExecutor(max_workers=maxProcesses) as resizer, tqdm(desc="Processing") as progress:
+        pending = {}
+        while not exhausted or pending:
+            # Start downloads until the number of pending images reaches the limit
+            while not exhausted and len(pending) < maxPending:
+                row = next(rows, None)
+                if row is None:
+                    exhausted = True
+                    break
+                url = row['thumbnail']
+                if url in seen:
+                    continue
+                seen.add(url)
+                filename = generateFilename(url, prefix)
+                state = store.getState(directory, url) if store else None
+                if filename in existingFiles:
+                    # Record thumbnails that are present but unknown to the store, e.g. from runs without a store
+                    if store and (state or {}).get('status') != 'ok':
+                        store.setSuccess(directory=directory, url=url, filename=filename)
+                    continue
+                if state and not store.isDue(state, now):
+                    numDeferred += 1
+                    continue
+                pending[downloader.submit(downloadImage, url=url, rateLimiter=rateLimiter,
+                                          targetWidth=targetWidth, serverSideResize=serverSideResize)] = (url, 'download')
+                numSubmitted += 1
+
+            if not pending:
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                url, stage = pending.pop(future)
+                filename = generateFilename(url, prefix)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print("Error %s image from url" % ("downloading" if stage == 'download' else "processing"), url, e)
+                    if store:
+                        store.setFailure(directory=directory, url=url, filename=filename, error=e)
+                    progress.update(1)
+                    continue
+                if stage == 'download':
+                    pending[resizer.submit(resizeImage, content=result, filepath=os.path.join(directory, filename), targetWidth=targetWidth)] = (url, 'resize')
+                    continue
+                source, output = result
+                if store:
+                    store.setSuccess(directory=directory, url=url, filename=filename, sourceSize=source, outputSize=output)
+                sourceBytes += source
+                outputBytes += output
+                numImages += 1
+                progress.update(1)
+
+    if numDeferred:
+        print("Skipped %d thumbnails that failed recently" % numDeferred)
+
+    if store:
+        store.commit()
+
+    if not numSubmitted:
+        return
+    elapsed = max(time.time() - startTime, 0.001)
+    print("Processed %d images in %.1fs (%.1f images/s), reduced %.1f MB to %.1f MB (%.1f MB saved)" % (
+        numImages, elapsed, numImages / elapsed, sourceBytes / 1e6, outputBytes / 1e6, (sourceBytes - outputBytes) / 1e6))
 
 def generateFilename(url, prefix):
     """
@@ -124,32 +470,20 @@ def generateFilename(url, prefix):
     
     return prefix + filenameHash(url)
 
-def generateTTLdata(data, filenamePrefix, location, predicate):
+def generateNTriples(*, subject, thumbnail, filename, location, predicate):
     """
-    Generate the TTL data for a given row of data.
-    Data is a dictionary with keys 'subject' and 'thumbnail'.
-    The function outputs a statements that links the subject to a file in the given location.
-    The filename is generated from the URL (hashed) and prefixed with the given prefix.
-    The location is the web location where the file is stored.
-    :param data: The dictionary consisting of 'subject' and 'thumbnail' (the URL)
-    :param filenamePrefix: The prefix to use for the filename
+    Generate the N-Triples statements for a thumbnail.
+    The statements link the subject to a file in the given location and the file to the original image.
+    :param subject: The subject the thumbnail belongs to
+    :param thumbnail: The URL of the original image
+    :param filename: The filename of the thumbnail
     :param location: The web location where the file is stored
     :param predicate: The predicate to use for the statement
     """
-    ttlTemplate = Template("""
-        <$subject> <$predicate> <$location/$filename> .
-        <$location/$filename> a <http://www.cidoc-crm.org/cidoc-crm/E36_Visual_Item> .
-        <$location/$filename> <http://www.ics.forth.gr/isl/CRMdig/L54_is_same-as> <$wdImage> .
-    """)
-    if not location.startswith("http"):
-        location = "https://" + location
-    return ttlTemplate.substitute(
-        subject=data['subject'],
-        filename=generateFilename(data['thumbnail'], filenamePrefix),
-        wdImage=data['thumbnail'],
-        predicate=predicate,
-        location=location
-    )
+    fileUri = "<%s/%s>" % (location, filename)
+    yield "<%s> <%s> %s .\n" % (subject, predicate, fileUri)
+    yield "%s <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://www.cidoc-crm.org/cidoc-crm/E36_Visual_Item> .\n" % fileUri
+    yield "%s <http://www.ics.forth.gr/isl/CRMdig/L54_is_same-as> <%s> .\n" % (fileUri, thumbnail)
 
 def getThumbnailQueries(propsFile,*, filterCondition=None):
     """
@@ -180,35 +514,110 @@ def getThumbnailQueries(propsFile,*, filterCondition=None):
     return queries
         
 
-def ingestToTriplestore(*, endpoint, data, graph, prefix, location, predicate):
+def ingestToTriplestore(*, endpoint, data, graph, prefix, location, predicate, store=None, chunkSize=5000):
     """
-    Generates TTL data for all the given image thumbnails and ingests it to the triple store
+    Generates N-Triples for the given image thumbnails and ingests them to the triple store in chunks.
+    If a state store is given, thumbnails that have already been ingested are skipped. The thumbnails
+    are compared with the ingested ones in the store, so that they do not have to be kept in memory. The
+    store is validated by checking that one of the recorded statements is present in the graph, if it
+    is not (e.g. because the graph has been dropped or reloaded) all thumbnails are ingested again. For
+    subjects whose thumbnails have changed since they were ingested, the statements about the previous
+    thumbnails are deleted, except for the statements about files that are still in use by other subjects.
     :param endpoint: The SPARQL endpoint to use
-    :param data: The list of dictionaries with keys 'subject' and 'thumbnail'
+    :param data: The iterable of dictionaries with keys 'subject' and 'thumbnail'
     :param graph: The named graph to ingest the data to
     :param prefix: The prefix to use for the filenames
     :param location: The web location where the files are stored
     :param predicate: The predicate to use for the statements
+    :param store: The ThumbnailStateStore in which the ingested thumbnails are tracked (optional)
+    :param chunkSize: The maximum number of thumbnails per request
+    :return: A dictionary with the number of ingested, skipped and removed thumbnails and requests
     """
-    output = ''
-    for row in data:
-        output += generateTTLdata(row, prefix, location, predicate)
-    r = requests.post(
-        url=endpoint, 
-        data=output,
-        params={"context-uri": graph},
-        headers={"Content-Type": "application/x-turtle"})
-    return r
+    if not location.startswith("http"):
+        location = "https://" + location
+    rows = ((row['subject'], row['thumbnail'], generateFilename(row['thumbnail'], prefix)) for row in data)
+    summary = {"ingested": 0, "skipped": 0, "removed": 0, "requests": 0}
+
+    def ingestChunk(chunk):
+        body = ''.join(line for subject, thumbnail, filename in chunk
+                       for line in generateNTriples(subject=subject, thumbnail=thumbnail, filename=filename, location=location, predicate=predicate))
+        r = requests.post(
+            url=endpoint, 
+            data=body.encode('utf-8'),
+            params={"context-uri": graph},
+            headers={"Content-Type": "text/plain"})
+        r.raise_for_status()
+        if store:
+            store.addIngested(chunk, graph=graph, predicate=predicate, location=location)
+        summary['ingested'] += len(chunk)
+        summary['requests'] += 1
+
+    if not store:
+        chunk = []
+        for row in tqdm(rows, desc="Ingesting"):
+            chunk.append(row)
+            if len(chunk) == chunkSize:
+                ingestChunk(chunk)
+                chunk = []
+        if chunk:
+            ingestChunk(chunk)
+        return summary
+
+    store.setCurrent(rows)
+    sample = store.getIngestedSample(graph=graph, predicate=predicate, location=location)
+    if sample:
+        subject, _, filename = sample
+        if not askSparql(endpoint=endpoint, query="ASK { GRAPH <%s> { <%s> <%s> <%s/%s> } }" % (graph, subject, predicate, location, filename)):
+            print("The thumbnails recorded as ingested are missing from the graph %s, ingesting all thumbnails" % graph)
+            store.clearIngested(graph=graph)
+
+    outdated = store.getOutdated(graph=graph, predicate=predicate, location=location)
+    for i in range(0, len(outdated), chunkSize):
+        chunk = outdated[i:i + chunkSize]
+        statements = ''
+        for subject, thumbnail, filename, inUse in chunk:
+            # Files that are still linked to a subject keep their type and link to the original image
+            triples = list(generateNTriples(subject=subject, thumbnail=thumbnail, filename=filename, location=location, predicate=predicate))
+            statements += ''.join(triples[:1] if inUse else triples)
+        r = requests.post(url=endpoint, data={"update": "DELETE DATA { GRAPH <%s> { %s } }" % (graph, statements)})
+        r.raise_for_status()
+        store.removeIngested(chunk, graph=graph, predicate=predicate, location=location)
+        summary['removed'] += len(chunk)
+        summary['requests'] += 1
+
+    numToIngest = store.countNotIngested(graph=graph, predicate=predicate, location=location)
+    summary['skipped'] = store.countCurrent() - numToIngest
+    with tqdm(total=numToIngest, desc="Ingesting") as progress:
+        # Ingested thumbnails are recorded in the store, hence every query returns the next chunk
+        chunk = store.getNotIngested(graph=graph, predicate=predicate, location=location, limit=chunkSize)
+        while chunk:
+            ingestChunk(chunk)
+            progress.update(len(chunk))
+            chunk = store.getNotIngested(graph=graph, predicate=predicate, location=location, limit=chunkSize)
+    return summary
     
-def queryThumbnails(*,endpoint, queries, limit=None):
+def askSparql(*, endpoint, query):
+    """
+    Execute a SPARQL ASK query and return its result.
+    :param endpoint: The SPARQL endpoint to use
+    :param query: The SPARQL query
+    :return: True if the query pattern has a solution
+    """
+    r = requests.post(endpoint, data={"query": query}, headers={"Accept": "application/sparql-results+json"})
+    r.raise_for_status()
+    return r.json()['boolean']
+
+def queryThumbnails(*,endpoint, queries, limit=None, pageSize=10000):
     """
-    Query the endpoint for the thumbnails based on the given thumbnail queries
+    Query the endpoint for the thumbnails based on the given thumbnail queries.
+    The query is executed page by page and the results are streamed, so that the
+    thumbnails are yielded before the whole result has been retrieved.
     :param endpoint: The SPARQL endpoint to use
     :param queries: The list of thumbnail queries
     :param limit: The maximum number of results to return (optional)
+    :param pageSize: The number of results to retrieve per request
+    :return: A generator of dictionaries with keys 'subject' and 'thumbnail'
     """
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setReturnFormat(JSON)
     # TODO: Read Prefixes from namespaces.prop file
     queryTemplate = Template("""
         PREFIX crm: <http://www.cidoc-crm.org/cidoc-crm/>
@@ -221,6 +630,7 @@ def queryThumbnails(*,endpoint, queries, limit=None):
         SELECT $select WHERE {
             $queryParts
         }
+        ORDER BY $select
     """)
     select = ['?subject']
     queryParts = []
@@ -229,48 +639,80 @@ def queryThumbnails(*,endpoint, queries, limit=None):
         queryParts.append(query.replace("?value", variable))
         select.append(variable)
     query = queryTemplate.substitute(select=' '.join(select), queryParts=' UNION '.join(queryParts))
-    if limit:
-        query += " LIMIT %d" % limit
-    sparql.setQuery(query)
-    ret = sparqlResultToDict(sparql.queryAndConvert())
-    thumbnails = []
-    for row in ret:
-        for i in range(len(queries)):
-            variable = "p%d" % i
-            if variable in row:
-                thumbnails.append({
-                    'subject': row['subject'],
-                    'thumbnail': row[variable]
-                })
+
+    offset = 0
+    while limit is None or offset < limit:
+        numResults = pageSize if limit is None else min(pageSize, limit - offset)
+        numRows = 0
+        for row in streamSparqlResults(endpoint=endpoint, query=query + " LIMIT %d OFFSET %d" % (numResults, offset)):
+            numRows += 1
+            for i in range(len(queries)):
+                variable = "p%d" % i
+                if row.get(variable):
+                    yield {
+                        'subject': row['subject'],
+                        'thumbnail': row[variable]
+                    }
+        if numRows < numResults:
+            break
+        offset += numRows
+
+def streamSparqlResults(*, endpoint, query):
+    """
+    Execute a SPARQL SELECT query and stream the results as tab-separated values.
+    IRIs are returned without angle brackets and literals without quotes, datatype and language tag.
+    Unbound variables are returned as None.
+    :param endpoint: The SPARQL endpoint to use
+    :param query: The SPARQL query
+    :return: A generator of dictionaries of variable names and values
+    """
+    with requests.post(endpoint, data={"query": query}, headers={"Accept": "text/tab-separated-values"}, stream=True) as r:
+        r.raise_for_status()
+        lines = r.iter_lines(decode_unicode=False)
+        header = next(lines, None)
+        if header is None:
+            return
+        variables = [d.lstrip('?$') for d in header.decode('utf-8').split('\t')]
+        for line in lines:
+            if not line:
                 continue
-    return thumbnails
+            values = line.decode('utf-8').split('\t')
+            yield {variable: parseTsvTerm(value) for variable, value in zip(variables, values)}
 
-def sparqlResultToDict(results):
+def parseTsvTerm(term):
     """
-    Convert a SPARQL query result to a list of dictionaries
-    :param results: The SPARQL query result returned from SPARQLWrapper
+    Convert an RDF term of a SPARQL TSV result to its value.
+
+    >>> parseTsvTerm('<http://www.wikidata.org/entity/Q123>')
+    'http://www.wikidata.org/entity/Q123'
+    >>> parseTsvTerm('"Johannes \\"Itten\\""@de')
+    'Johannes "Itten"'
+    >>> parseTsvTerm('') is None
+    True
+
+    :param term: The term as serialised in the TSV result
     """
-    rows = []
-    for result in results["results"]["bindings"]:
-        row = {}
-        for key in list(result.keys()):
-            row[key] = result[key]["value"]
-        rows.append(row)
-    return rows
+    if term == '':
+        return None
+    if term.startswith('<') and term.endswith('>'):
+        return term[1:-1]
+    if term.startswith('"'):
+        value = term[1:term.rindex('"')]
+        return re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n', 'r': '\r'}.get(m.group(1), m.group(1)), value)
+    return term
 
 def verifyThumbnails(*, data, directory, prefix):
     """
-    Verifies that all the thumbnails are present in the given directory
-    :param data: The list of dictionaries with keys 'subject' and 'thumbnail'
+    Verifies that all the thumbnails are present in the given directory and yields those that are.
+    The directory is listed once instead of checking every file individually.
+    :param data: The iterable of dictionaries with keys 'subject' and 'thumbnail'
     :param directory: The directory where the files are stored
     :param prefix: The prefix to use for the filenames
     """
-    verifiedData = []
+    existingFiles = set(os.listdir(directory))
     for row in data:
-        filename = generateFilename(row['thumbnail'], prefix)
-        if os.path.isfile(os.path.join(directory, filename)):
-            verifiedData.append(row)
-    return verifiedData
+        if generateFilename(row['thumbnail'], prefix) in existingFiles:
+            yield row
 
 if __name__ == "__main__":
     options = {}
@@ -304,4 +746,13 @@ if __name__ == "__main__":
     if not 'thumbnailPredicate' in options:
         options['thumbnailPredicate'] = "http://schema.org/thumbnail"
 
+    options['maxDownloads'] = int(options['maxDownloads']) if 'maxDownloads' in options else 4
+    options['maxProcesses'] = int(options['maxProcesses']) if 'maxProcesses' in options else None
+    options['requestsPerSecond'] = float(options['requestsPerSecond']) if 'requestsPerSecond' in options else 2
+    options['ingestChunkSize'] = int(options['ingestChunkSize']) if 'ingestChunkSize' in options else 5000
+    options['forceIngest'] = 'forceIngest' in options and options['forceIngest'].lower() == 'true'
+    if not 'stateFile' in options:
+        options['stateFile'] = "/data/cache/thumbnails.sqlite"
+    options['serverSideResize'] = not ('serverSideResize' in options and options['serverSideResize'].lower() == 'false')
+
     performCaching(options) 
\ No newline at end of file
@@ -0,0 +1,184 @@
+"""
+Detects the subjects whose triples changed since the last run, e.g. after a new mapping of the main data
+or an update of the external data.
+It is used to limit the materialisation of the network relations to the changed entities
+(see the --changedSubjects option of materialiseRelations.py).
+
+A hash of the triples of every subject is stored in a SQLite file. Subjects with a different hash,
+new subjects and subjects that are no longer present are written to the output file, one IRI per line.
+Subjects that link to a changed subject (e.g. a collection linking to its production event) are added
+as well, up to the number of hops given. So are the resources a changed subject links to, before and after
+the change (e.g. the subject and object of an attribute assignment), which are stored along with the hashes.
+
+The output file lists the subjects pending materialisation. If it already exists, the subjects are added
+to it, so that changes are not lost if the materialisation fails. It should be removed once the
+materialisation succeeded.
+
+Usage:
+
+python detectChangedSubjects.py --inputs <glob pattern> --stateFile <SQLite file> --outputFile <text file>
+
+Parameters:
+    --inputs        Comma-separated list of glob patterns of the RDF files (optional, default: /data/ttl/main/*.ttl,/data/ttl/additional/*.ttl,/data/ttl/additional/*.trig)
+    --stateFile     The SQLite file in which the hashes of the subjects are stored (optional, default: /data/cache/subjects.sqlite)
+    --outputFile    The file to which the changed subjects are written (optional, default: /data/tmp/changed-subjects.txt)
+    --hops          The number of hops over which subjects linking to changed subjects are added (optional, default: 2)
+    --snapshotOnly  If set to true, only the hashes are stored and no changes are written, e.g. after a full materialisation (optional, default: false)
+"""
+
+import os
+import sqlite3
+import sys
+
+from glob import glob
+from hashlib import blake2b
+
+from lib.tripleStore import TripleStore
+
+RDF_TYPE = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#type'
+
+def performDetection(options):
+    store = TripleStore()
+    for pattern in options['inputs'].split(','):
+        filenames = sorted(glob(pattern.strip()))
+        if not filenames:
+            print("Warning: No files found for %s" % pattern)
+        for filename in filenames:
+            store.loadFile(filename)
+    print("Loaded %d triples" % store.size)
+
+    hashes = hashSubjects(store)
+    links = linkSubjects(store)
+
+    if os.path.dirname(options['stateFile']):
+        os.makedirs(os.path.dirname(options['stateFile']), exist_ok=True)
+    connection = sqlite3.connect(options['stateFile'])
+    connection.execute("CREATE TABLE IF NOT EXISTS subjects (subject TEXT PRIMARY KEY, hash TEXT NOT NULL, links TEXT)")
+    if 'links' not in [d[1] for d in connection.execute("PRAGMA table_info(subjects)")]:
+        connection.execute("ALTER TABLE subjects ADD COLUMN links TEXT")
+    previous = {}
+    previousLinks = {}
+    for subject, subjectHash, subjectLinks in connection.execute("SELECT subject, hash, links FROM subjects"):
+        previous[subject] = subjectHash
+        previousLinks[subject] = subjectLinks.split("\n") if subjectLinks else []
+
+    if not options['snapshotOnly']:
+        if not previous:
+            print("No previous state found, run a full materialisation first")
+        else:
+            changed = set(d for d in hashes if previous.get(d) != hashes[d])
+            removed = set(d for d in previous if d not in hashes)
+            expanded = expandSubjects(store, changed | removed, hops=options['hops'], links=links, previousLinks=previousLinks)
+            print("%d subjects changed, %d removed, %d added through links" % (len(changed), len(removed), len(expanded - changed - removed)))
+            writeSubjects(options['outputFile'], expanded)
+
+    with connection:
+        connection.execute("DELETE FROM subjects")
+        connection.executemany("INSERT INTO subjects (subject, hash, links) VALUES (?, ?, ?)", ((d, hashes[d], "\n".join(links.get(d, []))) for d in hashes))
+    connection.close()
+
+def hashSubjects(store):
+    """
+    Compute a hash of the triples of every subject with an IRI.
+    Blank node labels are ignored, as they differ between parses.
+    :param store: The TripleStore containing the data
+    :return: Dictionary of subject IRIs and hashes
+    """
+    hashes = {}
+    for subject, predicates in store.spo.items():
+        term = store.terms[subject]
+        if not term.startswith('<'):
+            continue
+        lines = sorted(
+            store.terms[p] + ' ' + ('_:' if store.terms[o].startswith('_:') else store.terms[o])
+            for p, objects in predicates.items() for o in objects
+        )
+        hashes[term[1:-1]] = blake2b("\n".join(lines).encode('utf-8'), digest_size=16).hexdigest()
+    return hashes
+
+def linkSubjects(store):
+    """
+    Collect the IRIs every subject with an IRI links to, except its types.
+    :param store: The TripleStore containing the data
+    :return: Dictionary of subject IRIs and sorted lists of the IRIs they link to
+    """
+    rdfType = store.termIds.get('<%s>' % RDF_TYPE)
+    links = {}
+    for subject, predicates in store.spo.items():
+        term = store.terms[subject]
+        if not term.startswith('<'):
+            continue
+        objects = set(store.terms[o][1:-1] for p, objects in predicates.items() if p != rdfType for o in objects if store.terms[o].startswith('<'))
+        if objects:
+            links[term[1:-1]] = sorted(objects)
+    return links
+
+def expandSubjects(store, subjects, *, hops=2, links=None, previousLinks=None):
+    """
+    Add the subjects that link to the given subjects, over the given number of hops,
+    and the IRIs the given subjects link to, in the data and in the previous state.
+    :param store: The TripleStore containing the data
+    :param subjects: Set of subject IRIs
+    :param hops: The number of hops
+    :param links: Dictionary of subject IRIs and the IRIs they link to (optional, see linkSubjects)
+    :param previousLinks: Dictionary of subject IRIs and the IRIs they linked to in the previous state (optional)
+    :return: Set of subject IRIs
+    """
+    expanded = set(subjects)
+    frontier = set(subjects)
+    for _ in range(hops):
+        linking = set()
+        for iri in frontier:
+            termId = store.termIds.get('<%s>' % iri)
+            if termId is None:
+                continue
+            for s in store.osp.get(termId, {}):
+                term = store.terms[s]
+                if term.startswith('<') and term[1:-1] not in expanded:
+                    linking.add(term[1:-1])
+        expanded |= linking
+        frontier = linking
+
+    links = linkSubjects(store) if links is None else links
+    for iri in subjects:
+        expanded.update(links.get(iri, []))
+        expanded.update((previousLinks or {}).get(iri, []))
+    return expanded
+
+def writeSubjects(outputFile, subjects):
+    """
+    Add the subjects to the list of subjects pending materialisation
+    """
+    if os.path.isfile(outputFile):
+        with open(outputFile, 'r') as f:
+            subjects = subjects | set(d.strip() for d in f if d.strip())
+    if os.path.dirname(outputFile):
+        os.makedirs(os.path.dirname(outputFile), exist_ok=True)
+    tmpFilename = outputFile + ".tmp"
+    with open(tmpFilename, 'w') as f:
+        for subject in sorted(subjects):
+            f.write(subject + "\n")
+    os.replace(tmpFilename, outputFile)
+    print("%d subjects pending materialisation in %s" % (len(subjects), outputFile))
+
+if __name__ == "__main__":
+    options = {}
+
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            if not sys.argv[i + 2].startswith("--"):
+                options[arg[2:]] = sys.argv[i + 2]
+            else:
+                print("Malformed arguments")
+                sys.exit(1)
+
+    if not 'inputs' in options:
+        options['inputs'] = '/data/ttl/main/*.ttl,/data/ttl/additional/*.ttl,/data/ttl/additional/*.trig'
+    if not 'stateFile' in options:
+        options['stateFile'] = '/data/cache/subjects.sqlite'
+    if not 'outputFile' in options:
+        options['outputFile'] = '/data/tmp/changed-subjects.txt'
+    options['hops'] = int(options['hops']) if 'hops' in options else 2
+    options['snapshotOnly'] = 'snapshotOnly' in options and options['snapshotOnly'].lower() == 'true'
+
+    performDetection(options)
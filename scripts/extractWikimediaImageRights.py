@@ -1,18 +1,185 @@
+"""
+Retrieves the rights metadata of the Wikimedia Commons images linked via wdt:P18 in the Wikidata data
+and converts it to CIDOC CRM.
+
+The metadata of every image is stored in a SQLite cache together with the generated triples.
+Only metadata of images that are not yet cached is retrieved, and triples are only generated again
+for images whose metadata has changed.
+
+Usage:
+
+python extractWikimediaImageRights.py --inputFile <inputFile> --outputFile <outputFile>
+
+Parameters:
+    --inputFile             The Turtle or N-Triples file containing the Wikidata data (optional, default: /data/ttl/additional/wd.ttl)
+    --outputFile            The Turtle file to write the rights data to (optional, default: /data/ttl/additional/wdRights.ttl)
+    --cacheFile             The SQLite file in which the image metadata is cached (optional, default: /data/cache/imageRights.sqlite)
+    --legacyCacheDirectory  Directory of wm-license-*.json files of previous versions of this script to import into the cache (optional)
+    --refresh               If set to true, the metadata of all images is retrieved again (optional, default: false)
+"""
+
 import json
 import re
 import requests
 import os
+import sqlite3
+import sys
 import time
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from hashlib import blake2b
-from rdflib import Graph
 from string import Template
 from tqdm import tqdm
+from urllib.parse import unquote
+
+from lib.cache import getHttpCache
+
+apiEndpoint = 'https://commons.wikimedia.org/w/api.php'
+filePathPrefix = 'http://commons.wikimedia.org/wiki/Special:FilePath/'
+
+# Matches the wdt:P18 predicate, either as full IRI or prefixed, followed by one or more IRIs, which may span several lines
+P18_PATTERN = re.compile(r'(?:<http://www\.wikidata\.org/prop/direct/P18>|(?<![\w:])wdt:P18)\s+(<[^>]+>(?:\s*,\s*<[^>]+>)*)')
+# Matches the end of a line on which the objects of wdt:P18 continue on the next line
+P18_CONTINUATION_PATTERN = re.compile(r'(?:P18>?|,)\s*$')
+
+imageTtlNamespaces = """
+@prefix crm: <http://www.cidoc-crm.org/cidoc-crm/>.
+@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>.
+"""
+imageTtlTemplate = Template('''
+    <$image> rdfs:label """$imageLabel""" ;
+        crm:P104_is_subject_to <$image/right> .
+    
+    <$image/right> a crm:E30_Right ;
+        crm:P105_right_held_by <$rightsHolder> ;
+        crm:P2_has_type <$license> .
+        
+    <$license> rdfs:label """$usageTerms""" .
+        
+    <$rightsHolder> a crm:E39_Actor ;
+        rdfs:label """$rightsHolderLabel""" .
+''')
+
+def performExtraction(options):
+    images = list(dict.fromkeys(scanImages(options['inputFile'])))
+    print('Found ' + str(len(images)) + ' images')
+
+    store = ImageRightsStore(options['cacheFile'])
+    cached = store.getEntries()
+
+    # Import metadata cached by previous versions of this script
+    if options['legacyCacheDirectory']:
+        for image in [d for d in images if d not in cached]:
+            filename = os.path.join(options['legacyCacheDirectory'], generateFilename(image))
+            if os.path.isfile(filename):
+                with open(filename, 'r') as f:
+                    store.setMetadata(image, json.load(f))
+        store.commit()
+        cached = store.getEntries()
+
+    # Retrieve image metadata from Wikimedia Commons
+    imagesToRetrieve = images if options['refresh'] else [d for d in images if d not in cached]
+    print('Retrieving metadata for ' + str(len(imagesToRetrieve)) + ' images')
+    numChanged = 0
+    for image, data in retrieveImageMetadata(imagesToRetrieve, refresh=options['refresh']).items():
+        if store.setMetadata(image, data):
+            numChanged += 1
+    store.commit()
+    print(str(numChanged) + ' images have new or changed metadata')
+
+    # Generate triples for images whose metadata has changed
+    entries = store.getEntries()
+    outdated = [d for d in images if d in entries and entries[d]['ttl'] is None]
+    for image in outdated:
+        store.setTtl(image, generateTtl(image, json.loads(entries[image]['metadata'])))
+    store.commit()
+    print('Generated triples for ' + str(len(outdated)) + ' images')
+
+    # Write output
+    entries = store.getEntries()
+    tmpFile = options['outputFile'] + '.tmp'
+    with open(tmpFile, 'w', encoding='utf-8') as f:
+        f.write(imageTtlNamespaces)
+        for image in images:
+            if image in entries and entries[image]['ttl']:
+                f.write(entries[image]['ttl'])
+    os.replace(tmpFile, options['outputFile'])
+
+class ImageRightsStore:
+    """
+    SQLite cache of the image metadata and the triples generated from it.
+    When the metadata of an image changes, its triples are discarded so that they are generated again.
+
+    :param filename: Path to the SQLite file
+    """
+
+    def __init__(self, filename):
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                image TEXT PRIMARY KEY,
+                metadata TEXT NOT NULL,
+                hash TEXT NOT NULL,
+                retrieved REAL NOT NULL,
+                ttl TEXT
+            )""")
+        self.connection.commit()
+
+    def getEntries(self):
+        """
+        Return the cached entries, indexed by image URI.
+        """
+        cursor = self.connection.execute("SELECT image, metadata, hash, ttl FROM images")
+        return {row[0]: {'metadata': row[1], 'hash': row[2], 'ttl': row[3]} for row in cursor}
+
+    def setMetadata(self, image, metadata):
+        """
+        Store the metadata of an image.
+        :return: True if the metadata is new or has changed
+        """
+        serialised = json.dumps(metadata, sort_keys=True)
+        h = blake2b(serialised.encode(), digest_size=20).hexdigest()
+        row = self.connection.execute("SELECT hash FROM images WHERE image = ?", (image,)).fetchone()
+        if row and row[0] == h:
+            self.connection.execute("UPDATE images SET retrieved = ? WHERE image = ?", (time.time(), image))
+            return False
+        self.connection.execute("INSERT OR REPLACE INTO images (image, metadata, hash, retrieved, ttl) VALUES (?, ?, ?, ?, NULL)",
+            (image, serialised, h, time.time()))
+        return True
 
-inputFile = '../data/ttl/additional/wd.ttl'
-outputFile = '../data/ttl/additional/wdRights.ttl'
+    def setTtl(self, image, ttl):
+        self.connection.execute("UPDATE images SET ttl = ? WHERE image = ?", (ttl, image))
 
-cacheDirectory = '../data/tmp/imageRights/'
+    def commit(self):
+        self.connection.commit()
+
+def scanImages(inputFile):
+    """
+    Stream the given Turtle or N-Triples file and yield the objects of all wdt:P18 statements.
+    The file is read line by line. If a line with the predicate ends with the predicate or with a comma,
+    the objects continue on the following lines, which are added until the object list ends.
+    :param inputFile: Path to the file
+    """
+    statement = ''
+    with open(inputFile, 'r', encoding='utf-8') as f:
+        for line in f:
+            if statement:
+                statement += line
+            elif 'P18' in line:
+                statement = line
+            else:
+                continue
+            if P18_CONTINUATION_PATTERN.search(statement):
+                continue
+            for match in P18_PATTERN.finditer(statement):
+                for image in re.findall(r'<([^>]+)>', match.group(1)):
+                    yield image
+            statement = ''
+        for match in P18_PATTERN.finditer(statement):
+            for image in re.findall(r'<([^>]+)>', match.group(1)):
+                yield image
 
 def cleanString(inputString):
     inputString = re.sub(r'(<.*?>)|(\n)', '', inputString).replace('"', '\\"').replace(u'\xa0', u' ')
@@ -22,6 +189,7 @@ def generateFilename(url, prefix='wm-license-'):
     """
     Generate a filename from a URL and a prefix.
     The filename is generated from the URL (hashed) and prefixed with the given prefix.
+    Used for reading the metadata cached by previous versions of this script.
     :param url: The URL
     :param prefix: The prefix to use for the filename
     """
@@ -32,74 +200,112 @@ def generateFilename(url, prefix='wm-license-'):
     
     return prefix + filenameHash(url)
 
-# Read input graph
-g = Graph()
-g.parse(inputFile, format="ttl")
+def retrieveImageMetadata(images, *, batchSize=50, maxInFlight=2, maxAttempts=5, maxlag=5, refresh=False):
+    """
+    Retrieve the extmetadata of the given Wikimedia Commons images through the shared HTTP cache.
+    Up to batchSize titles are requested at once, the normalised and redirected titles returned
+    by the API are mapped back to the image URIs. If the result is split into several parts, the
+    continuation is followed. If the API reports that the replication lag is too high (maxlag) or
+    the request fails with a timeout or connection error, it is retried after a delay.
+    If refresh is set, cached responses are revalidated with the API instead of being served as fresh.
+    :param images: List of image URIs (Special:FilePath URLs)
+    :param batchSize: The number of titles per request (at most 50)
+    :param maxInFlight: The number of concurrent requests
+    :param maxAttempts: The number of attempts per request
+    :param maxlag: The maxlag parameter passed to the API
+    :param refresh: If True, cached responses are revalidated regardless of the cache policy
+    :return: Dictionary of image URIs and their extmetadata
+    """
+    titles = {}
+    for image in images:
+        titles.setdefault("File:" + unquote(image.replace(filePathPrefix, "")).replace("_", " "), []).append(image)
 
-# Extract all image URIs
-imagesQuery = """
-PREFIX wdt: <http://www.wikidata.org/prop/direct/>
-SELECT DISTINCT ?image WHERE {
-    ?s wdt:P18 ?image .
-}
-"""
-results = g.query(imagesQuery)
-images = []
-for row in results:
-    images.append(str(row['image']))
-
-print('Found ' + str(len(images)) + ' images')
-
-# Create cache directory if it does not exist yet
-if not os.path.exists(cacheDirectory):
-    os.makedirs(cacheDirectory)
-
-# Retrieve image metadata from Wikimedia Commons
-imageData = {}
-for image in tqdm(images):
-    if image not in imageData:
-        # Check if image is already cached
-        filename = generateFilename(image)
-        if os.path.isfile(cacheDirectory + filename):
-            with open(cacheDirectory + filename, 'r') as f:
-                imageData[image] = json.load(f)
-        else:
-            # Retrieve image metadata
-            title = image.replace("http://commons.wikimedia.org/wiki/Special:FilePath/", "File:")
-            url = "https://en.wikipedia.org/w/api.php?action=query&prop=imageinfo&iiprop=extmetadata&&format=json&titles=" + title
-            r = requests.get(url)
+    def request(params):
+        ttl = 0 if refresh else None
+        for attempt in range(1, maxAttempts + 1):
             try:
-                imageDataRaw = r.json()
-                page = list(imageDataRaw['query']['pages'].keys())[0]
-                imageData[image] = r.json()['query']['pages'][page]['imageinfo'][0]['extmetadata']
-                # Cache image data
-                with open(cacheDirectory + filename, 'w') as f:
-                    json.dump(imageData[image], f)
-            except Exception as e:
-                print("Could not read metadata", image, url)
-            time.sleep(0.5)
+                r = getHttpCache().get(apiEndpoint, params=params, timeout=60, ttl=ttl)
+                data = r.json() if r.status_code == 200 else {}
+                if r.status_code == 200 and data.get('error', {}).get('code') != 'maxlag':
+                    return data
+                error = data.get('error', {}).get('info', r.status_code)
+                delay = int(r.headers.get('Retry-After', 5))
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                error = e
+                delay = 2 ** attempt
+            if attempt == maxAttempts:
+                raise Exception("Request failed after %d attempts: %s" % (maxAttempts, error))
+            # Do not serve a cached maxlag response again
+            ttl = 0
+            time.sleep(delay)
 
-# Convert image metadata to CIDOC/RDF
-imageTtlNamespaces = """
-@prefix crm: <http://www.cidoc-crm.org/cidoc-crm/>.
-@prefix rdfs: <http://www.w3.org/2000/01/rdf-schema#>.
-"""
-imageTtlTemplate = Template('''
-    <$image> rdfs:label """$imageLabel""" ;
-        crm:P104_is_subject_to <$image/right> .
-    
-    <$image/right> a crm:E30_Right ;
-        crm:P105_right_held_by <$rightsHolder> ;
-        crm:P2_has_type <$license> .
-        
-    <$license> rdfs:label """$usageTerms""" .
-        
-    <$rightsHolder> a crm:E39_Actor ;
-        rdfs:label """$rightsHolderLabel""" .
-''')
+    def retrieveBatch(batch):
+        params = {
+            "action": "query",
+            "prop": "imageinfo",
+            "iiprop": "extmetadata",
+            "format": "json",
+            "redirects": 1,
+            "maxlag": maxlag,
+            "titles": "|".join(batch)
+        }
+        query = {'normalized': [], 'redirects': [], 'pages': {}}
+        continuation = {}
+        while True:
+            data = request(dict(params, **continuation))
+            if 'error' in data:
+                raise Exception(data['error'].get('info', data['error']))
+            for key in ['normalized', 'redirects']:
+                query[key] += data.get('query', {}).get(key, [])
+            for pageId, page in data.get('query', {}).get('pages', {}).items():
+                merged = query['pages'].setdefault(pageId, {})
+                for key, value in page.items():
+                    if key == 'imageinfo':
+                        merged.setdefault('imageinfo', []).extend(value)
+                    else:
+                        merged[key] = value
+            if 'continue' not in data:
+                break
+            continuation = data['continue']
+
+        # Follow the normalisation and redirects of the titles
+        mapping = {d: d for d in batch}
+        for key in ['normalized', 'redirects']:
+            renamed = {d['from']: d['to'] for d in query[key]}
+            mapping = {k: renamed.get(v, v) for k, v in mapping.items()}
+        pages = {d['title']: d for d in query['pages'].values()}
+
+        metadata = {}
+        for title, pageTitle in mapping.items():
+            page = pages.get(pageTitle)
+            if page and 'imageinfo' in page:
+                metadata[title] = page['imageinfo'][0]['extmetadata']
+            else:
+                print("Could not read metadata", title)
+        return metadata
+
+    imageData = {}
+    batches = [list(titles.keys())[i:i + batchSize] for i in range(0, len(titles), batchSize)]
+    with ThreadPoolExecutor(max_workers=maxInFlight) as executor:
+        futures = [executor.submit(retrieveBatch, batch) for batch in batches]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                metadata = future.result()
+            except Exception as e:
+                print("Could not retrieve metadata", e)
+                continue
+            for title, data in metadata.items():
+                for image in titles[title]:
+                    imageData[image] = data
+    return imageData
 
-imageTtlOutput = imageTtlNamespaces
-for imageUri, data in imageData.items():
+def generateTtl(imageUri, data):
+    """
+    Convert the extmetadata of an image to CIDOC CRM triples in Turtle.
+    Returns an empty string if the metadata does not contain any license information.
+    :param imageUri: The URI of the image
+    :param data: The extmetadata of the image
+    """
     if 'Artist' in data:
         artistSearch = re.search(r'<a\s+(?:[^>]*?\s+)?href=(["\'])(.*?)\1', data['Artist']['value'])
         if artistSearch:
@@ -123,9 +329,8 @@ for imageUri, data in imageData.items():
 
     artistLabel = cleanString(artistLabel)
         
-    imageLabel = cleanString(data['ImageDescription']['value']) if 'ImageDescription' in data else '',
+    imageLabel = cleanString(data['ImageDescription']['value']) if 'ImageDescription' in data else ''
 
-    
     if 'LicenseUrl' in data:
         license = data['LicenseUrl']['value'].replace(" ", "%20")
         licenseKey = 'LicenseUrl'
@@ -135,8 +340,11 @@ for imageUri, data in imageData.items():
     elif 'Permission' in data:
         license ='https://resource.jila.zb.uzh.ch/license/' + data['Permission']['value'].replace(" ", "%20")
         licenseKey = 'Permission'
-        
-    imageTtlOutput += imageTtlTemplate.substitute(
+    else:
+        print("No license information found", imageUri)
+        return ''
+
+    return imageTtlTemplate.substitute(
         image=imageUri,
         imageLabel=imageLabel,
         rightsHolder=artist,
@@ -146,6 +354,29 @@ for imageUri, data in imageData.items():
         usageTerms=data['UsageTerms']['value'] if 'UsageTerms' in data else data[licenseKey]['value']
     )
 
-# Write output
-with open(outputFile, 'w', encoding='utf-8') as f:
-    f.write(imageTtlOutput)
\ No newline at end of file
+if __name__ == "__main__":
+    options = {}
+
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            if not sys.argv[i + 2].startswith("--"):
+                options[arg[2:]] = sys.argv[i + 2]
+            else:
+                print("Malformed arguments")
+                sys.exit(1)
+
+    if not 'inputFile' in options:
+        options['inputFile'] = '/data/ttl/additional/wd.ttl'
+    if not 'outputFile' in options:
+        options['outputFile'] = '/data/ttl/additional/wdRights.ttl'
+    if not 'cacheFile' in options:
+        options['cacheFile'] = '/data/cache/imageRights.sqlite'
+    if not 'legacyCacheDirectory' in options:
+        options['legacyCacheDirectory'] = None
+    options['refresh'] = 'refresh' in options and options['refresh'].lower() == 'true'
+
+    if not os.path.isfile(options['inputFile']):
+        print("The input file %s does not exist" % options['inputFile'])
+        sys.exit(1)
+
+    performExtraction(options)
@@ -0,0 +1,381 @@
+"""
+Shared on-disk cache for HTTP responses of the external sources queried by the pipeline.
+
+Response bodies are stored content-addressed (by their hash) in an objects folder, so that identical
+responses are only stored once. For every requested URL a small JSON index entry keeps the ETag and
+Last-Modified headers, which are used to revalidate the cached response with a conditional request.
+Re-running a retrieval step therefore mostly results in 304 responses instead of full downloads.
+
+How long a cached response is considered fresh (i.e. served without contacting the server) can be
+configured per host. In offline mode only cached responses are served and a CacheMissError is raised
+for everything else.
+
+Entries that have not been checked for a given time, entries exceeding a maximum total size and
+objects no longer referenced by any entry are removed with HttpCache.prune.
+
+The default cache is configured through the following environment variables:
+    HTTP_CACHE_FOLDER     The folder where the cache is stored (default: /data/cache/http)
+    HTTP_CACHE_OFFLINE    If set to true, only cached responses are served
+    HTTP_CACHE_TTL        Comma-separated list of <host>=<seconds> pairs overriding the default TTL policies
+
+Usage:
+
+    from lib.cache import getHttpCache
+    cache = getHttpCache()
+    response = cache.get("https://lobid.org/gnd/118646567.ttl")
+    if response.status_code == 200:
+        print(response.text)
+"""
+
+import json
+import os
+import requests
+import tempfile
+import threading
+import time
+from email.utils import formatdate
+from hashlib import blake2b
+from urllib.parse import urlparse
+
+USER_AGENT = "itten-pipeline/1.0 (https://github.com/swiss-art-research-net/itten-pipeline)"
+
+DAY = 24 * 60 * 60
+
+# Number of seconds a cached response is served without revalidation, per host.
+# Hosts that are not listed are always revalidated.
+TTL_POLICIES = {
+    "doi.org": 365 * DAY,
+    "id.loc.gov": 90 * DAY,
+    "vocab.getty.edu": 30 * DAY,
+    "www.e-manuscripta.ch": 7 * DAY,
+    "lobid.org": 7 * DAY,
+    "query.wikidata.org": 7 * DAY,
+    "commons.wikimedia.org": 30 * DAY,
+    "upload.wikimedia.org": 30 * DAY,
+    "en.wikipedia.org": 7 * DAY
+}
+
+class CacheMissError(Exception):
+    """
+    Raised in offline mode if a requested URL is not present in the cache.
+    """
+    pass
+
+class CachedResponse:
+    """
+    Minimal response object returned by the cache, modelled after requests.Response.
+    The body is read lazily from the content-addressed object file.
+    """
+
+    def __init__(self, *, url, status_code, headers, path=None, content=None, fromCache=False):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.path = path
+        self.fromCache = fromCache
+        self._content = content
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 300
+
+    @property
+    def content(self):
+        if self._content is None and self.path:
+            with open(self.path, 'rb') as f:
+                self._content = f.read()
+        return self._content if self._content is not None else b''
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+class HttpCache:
+    """
+    Content-addressed HTTP cache with conditional revalidation.
+
+    :param cacheFolder: The folder where the cache is stored
+    :param ttlPolicies: Dictionary of hosts and the number of seconds responses are considered fresh
+    :param defaultTtl: The number of seconds responses of hosts without a policy are considered fresh
+    :param offline: If True, only cached responses are served
+    :param session: An optional requests session to use for the requests
+    """
+
+    def __init__(self, *, cacheFolder, ttlPolicies=None, defaultTtl=0, offline=False, session=None):
+        self.cacheFolder = cacheFolder
+        self.ttlPolicies = dict(TTL_POLICIES)
+        if ttlPolicies:
+            self.ttlPolicies.update(ttlPolicies)
+        self.defaultTtl = defaultTtl
+        self.offline = offline
+        self.session = session if session else requests.Session()
+        if self.session.headers.get('User-Agent', '').startswith('python-requests'):
+            self.session.headers['User-Agent'] = USER_AGENT
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(cacheFolder, 'index'), exist_ok=True)
+        os.makedirs(os.path.join(cacheFolder, 'objects'), exist_ok=True)
+
+    def get(self, url, *, params=None, headers=None, timeout=60, ttl=None):
+        """
+        Retrieve the given URL, serving it from the cache where possible.
+        Fresh responses are returned without contacting the server, stale ones are revalidated
+        using If-None-Match / If-Modified-Since. If the server cannot be reached or responds with
+        a server error (5xx), a stale response is served if available. Only successful responses are stored.
+
+        :param url: The URL to retrieve
+        :param params: Optional dictionary of query parameters
+        :param headers: Optional dictionary of request headers
+        :param timeout: Timeout of the request in seconds
+        :param ttl: Optional number of seconds overriding the TTL policy for this request
+        :return: A CachedResponse
+        """
+        headers = dict(headers) if headers else {}
+        fullUrl = requests.Request('GET', url, params=params).prepare().url
+        key = self._key(fullUrl, headers.get('Accept', ''))
+        entry = self._readEntry(key)
+
+        if entry and not os.path.isfile(self._objectPath(entry['object'])):
+            entry = None
+
+        if entry:
+            if ttl is None:
+                ttl = self._ttlForUrl(fullUrl)
+            if self.offline or time.time() - entry['checked'] < ttl:
+                return self._responseFromEntry(entry)
+        elif self.offline:
+            raise CacheMissError("Not cached: %s" % fullUrl)
+
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('lastModified'):
+                headers['If-Modified-Since'] = entry['lastModified']
+            elif not entry.get('etag'):
+                headers['If-Modified-Since'] = formatdate(entry['fetched'], usegmt=True)
+
+        try:
+            response = self.session.get(fullUrl, headers=headers, timeout=timeout, stream=True)
+        except requests.exceptions.RequestException:
+            if entry:
+                return self._responseFromEntry(entry)
+            raise
+
+        with response:
+            if response.status_code == 304 and entry:
+                entry['checked'] = time.time()
+                if response.headers.get('ETag'):
+                    entry['etag'] = response.headers['ETag']
+                self._writeEntry(key, entry)
+                return self._responseFromEntry(entry)
+
+            if response.status_code >= 500 and entry:
+                return self._responseFromEntry(entry)
+
+            if response.status_code != 200:
+                return CachedResponse(url=response.url,
+                                      status_code=response.status_code,
+                                      headers=dict(response.headers),
+                                      content=response.content)
+
+            objectHash = self._storeObject(response)
+
+        now = time.time()
+        entry = {
+            "url": fullUrl,
+            "finalUrl": response.url,
+            "object": objectHash,
+            "etag": response.headers.get('ETag'),
+            "lastModified": response.headers.get('Last-Modified'),
+            "contentType": response.headers.get('Content-Type'),
+            "fetched": now,
+            "checked": now
+        }
+        self._writeEntry(key, entry)
+        return CachedResponse(url=response.url,
+                              status_code=200,
+                              headers=dict(response.headers),
+                              path=self._objectPath(objectHash))
+
+    def isCached(self, url, *, params=None, accept=''):
+        """
+        Check whether a response for the given URL is present in the cache.
+
+        :param url: The URL to check
+        :param params: Optional dictionary of query parameters
+        :param accept: The Accept header the response was requested with
+        :return: True if a response is cached
+        """
+        fullUrl = requests.Request('GET', url, params=params).prepare().url
+        entry = self._readEntry(self._key(fullUrl, accept))
+        return entry is not None and os.path.isfile(self._objectPath(entry['object']))
+
+    def prune(self, *, maxAge=None, maxSize=None, tmpMaxAge=DAY):
+        """
+        Remove index entries that have not been checked within maxAge seconds and, if the objects
+        referenced by the remaining entries exceed maxSize bytes, the least recently checked entries
+        until they fit. Objects that are not referenced by any remaining entry are deleted, as are
+        temporary files left behind by interrupted downloads.
+
+        :param maxAge: Optional maximum number of seconds since an entry was last checked
+        :param maxSize: Optional maximum total size of the referenced objects in bytes
+        :param tmpMaxAge: Number of seconds after which temporary files are considered abandoned
+        :return: A dictionary with the number of removed entries and objects and the number of bytes freed
+        """
+        now = time.time()
+        removedEntries = 0
+        entries = []
+        for root, dirs, files in os.walk(os.path.join(self.cacheFolder, 'index')):
+            for name in files:
+                filepath = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    if now - os.path.getmtime(filepath) > tmpMaxAge:
+                        os.remove(filepath)
+                    continue
+                try:
+                    with open(filepath, 'r') as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    entry = None
+                if not entry or (maxAge is not None and now - entry.get('checked', 0) > maxAge):
+                    os.remove(filepath)
+                    removedEntries += 1
+                    continue
+                entries.append((entry.get('checked', 0), filepath, entry['object']))
+
+        objectSizes = {}
+        objectPaths = {}
+        for root, dirs, files in os.walk(os.path.join(self.cacheFolder, 'objects')):
+            for name in files:
+                filepath = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    if now - os.path.getmtime(filepath) > tmpMaxAge:
+                        os.remove(filepath)
+                    continue
+                objectSizes[name] = os.path.getsize(filepath)
+                objectPaths[name] = filepath
+
+        references = {}
+        for checked, filepath, objectHash in entries:
+            references[objectHash] = references.get(objectHash, 0) + 1
+
+        if maxSize is not None:
+            totalSize = sum(objectSizes.get(d, 0) for d in references)
+            # Drop the least recently checked entries first, an object is freed once its last entry is gone
+            for checked, filepath, objectHash in sorted(entries):
+                if totalSize <= maxSize:
+                    break
+                os.remove(filepath)
+                removedEntries += 1
+                references[objectHash] -= 1
+                if references[objectHash] == 0:
+                    del references[objectHash]
+                    totalSize -= objectSizes.get(objectHash, 0)
+
+        removedObjects = 0
+        freedBytes = 0
+        with self._lock:
+            for objectHash, size in objectSizes.items():
+                if objectHash not in references:
+                    os.remove(objectPaths[objectHash])
+                    removedObjects += 1
+                    freedBytes += size
+        return {
+            "removedEntries": removedEntries,
+            "removedObjects": removedObjects,
+            "freedBytes": freedBytes
+        }
+
+    def _key(self, url, accept):
+        h = blake2b(digest_size=20)
+        h.update(("%s\n%s" % (url, accept)).encode())
+        return h.hexdigest()
+
+    def _indexPath(self, key):
+        return os.path.join(self.cacheFolder, 'index', key[:2], key + '.json')
+
+    def _objectPath(self, objectHash):
+        return os.path.join(self.cacheFolder, 'objects', objectHash[:2], objectHash)
+
+    def _readEntry(self, key):
+        try:
+            with open(self._indexPath(key), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _writeEntry(self, key, entry):
+        path = self._indexPath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmpPath, path)
+
+    def _storeObject(self, response):
+        """
+        Stream the response body to a temporary file while hashing it,
+        then move it to its content-addressed location.
+        """
+        h = blake2b(digest_size=20)
+        objectsFolder = os.path.join(self.cacheFolder, 'objects')
+        fd, tmpPath = tempfile.mkstemp(dir=objectsFolder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    h.update(chunk)
+                    f.write(chunk)
+            objectHash = h.hexdigest()
+            path = self._objectPath(objectHash)
+            with self._lock:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if os.path.isfile(path):
+                    os.remove(tmpPath)
+                else:
+                    os.replace(tmpPath, path)
+        except BaseException:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+        return objectHash
+
+    def _responseFromEntry(self, entry):
+        headers = {}
+        if entry.get('contentType'):
+            headers['Content-Type'] = entry['contentType']
+        if entry.get('etag'):
+            headers['ETag'] = entry['etag']
+        if entry.get('lastModified'):
+            headers['Last-Modified'] = entry['lastModified']
+        return CachedResponse(url=entry.get('finalUrl', entry['url']),
+                              status_code=200,
+                              headers=headers,
+                              path=self._objectPath(entry['object']),
+                              fromCache=True)
+
+    def _ttlForUrl(self, url):
+        parsed = urlparse(url)
+        return self.ttlPolicies.get(parsed.netloc, self.defaultTtl)
+
+_defaultCache = None
+_defaultCacheLock = threading.Lock()
+
+def getHttpCache():
+    """
+    Return the shared HTTP cache configured through the HTTP_CACHE_* environment variables.
+    """
+    global _defaultCache
+    with _defaultCacheLock:
+        if _defaultCache is None:
+            ttlPolicies = {}
+            for policy in [d for d in os.environ.get('HTTP_CACHE_TTL', '').split(',') if '=' in d]:
+                host, seconds = policy.split('=', 1)
+                ttlPolicies[host.strip()] = int(seconds)
+            _defaultCache = HttpCache(
+                cacheFolder=os.environ.get('HTTP_CACHE_FOLDER', '/data/cache/http'),
+                ttlPolicies=ttlPolicies,
+                offline=os.environ.get('HTTP_CACHE_OFFLINE', '').lower() in ['1', 'true', 'yes']
+            )
+    return _defaultCache
@@ -0,0 +1,291 @@
+"""
+Local SPARQL 1.1 endpoint backed by an in-memory rdflib Dataset, used as a stand-in for Blazegraph
+when benchmarking and testing the pipeline's queries without a running triple store.
+
+The endpoint implements the parts of the Blazegraph REST API that the pipeline uses:
+- SPARQL queries via GET or POST (form parameter 'query' or a body of type application/sparql-query),
+  answered as JSON, XML, CSV or TSV results for SELECT and ASK, and as N-Triples, Turtle or RDF/XML for
+  CONSTRUCT and DESCRIBE, depending on the Accept header
+- SPARQL updates via POST (form parameter 'update' or a body of type application/sparql-update).
+  As in Blazegraph, the response reports the mutationCount, the number of removed plus the number of
+  added statements. Both numbers are counted separately by the store and are also available as
+  SparqlEndpoint.lastMutations, so that updates that rewrite statements (DELETE/INSERT) can be checked
+- Loading RDF data via POST with the RDF content type, into the named graph given by the
+  'context-uri' parameter, as done by the ingest-data-from-file task
+
+As in Blazegraph's quads mode, the default graph is the union of all named graphs.
+Requests are executed one at a time.
+
+Usage:
+
+    from lib.sparqlEndpoint import SparqlEndpoint
+    endpoint = SparqlEndpoint()
+    url = endpoint.start()
+    ...
+    endpoint.stop()
+"""
+
+import csv
+import io
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pyparsing import ParseException
+from urllib.parse import parse_qs, urlparse
+
+from rdflib import Dataset, URIRef, Literal, BNode
+from rdflib.graph import DATASET_DEFAULT_GRAPH_ID
+from rdflib.plugins.stores.memory import Memory
+
+# Formats of the RDF content types accepted when loading data
+RDF_CONTENT_TYPES = {
+    'text/turtle': 'turtle',
+    'application/x-turtle': 'turtle',
+    'application/rdf+xml': 'xml',
+    'application/n-triples': 'nt',
+    'text/plain': 'nt',
+    'application/n-quads': 'nquads',
+    'text/x-nquads': 'nquads',
+    'application/trig': 'trig',
+    'application/x-trig': 'trig',
+    'application/ld+json': 'json-ld'
+}
+QUAD_FORMATS = ['nquads', 'trig']
+
+class CountingMemory(Memory):
+    """
+    In-memory store that counts the statements actually added to and removed from its graphs.
+    Statements that already exist are not counted when they are added again.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.added = 0
+        self.removed = 0
+
+    def countContext(self, context):
+        if context is None:
+            return sum(Memory.__len__(self, c) for c in self.contexts())
+        return Memory.__len__(self, context)
+
+    def add(self, triple, context, quoted=False):
+        before = self.countContext(context)
+        super().add(triple, context, quoted=quoted)
+        self.added += self.countContext(context) - before
+
+    def remove(self, triple_pattern, context=None):
+        before = self.countContext(context)
+        super().remove(triple_pattern, context=context)
+        self.removed += before - self.countContext(context)
+
+class SparqlEndpoint:
+    """
+    SPARQL endpoint serving an rdflib Dataset over HTTP in a background thread.
+    """
+
+    def __init__(self, dataset=None, *, host='127.0.0.1', port=0):
+        self.dataset = dataset if dataset is not None else Dataset(store=CountingMemory(), default_union=True)
+        self.lock = threading.Lock()
+        self.host = host
+        self.port = port
+        self.server = None
+        self.thread = None
+        self.lastMutations = None
+
+    def start(self):
+        """
+        Start serving requests.
+        :return: The URL of the endpoint
+        """
+        self.server = ThreadingHTTPServer((self.host, self.port), SparqlRequestHandler)
+        self.server.daemon_threads = True
+        self.server.endpoint = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    @property
+    def url(self):
+        return "http://%s:%d/sparql" % self.server.server_address[:2]
+
+    def countStatements(self):
+        return sum(len(graph) for graph in self.dataset.graphs())
+
+    def load(self, data, rdfFormat, *, graph=None):
+        """
+        Load RDF data into the dataset.
+        :param data: The serialised data
+        :param rdfFormat: The rdflib format of the data
+        :param graph: IRI of the named graph for triples without graph (optional, the default graph otherwise)
+        :return: The number of statements added
+        """
+        with self.lock:
+            before = self.countStatements()
+            if rdfFormat in QUAD_FORMATS:
+                self.dataset.parse(data=data, format=rdfFormat, publicID=graph)
+            else:
+                target = self.dataset.graph(URIRef(graph) if graph else DATASET_DEFAULT_GRAPH_ID)
+                target.parse(data=data, format=rdfFormat)
+            return self.countStatements() - before
+
+    def query(self, query):
+        with self.lock:
+            result = self.dataset.query(query)
+            # Evaluate the lazy result while holding the lock
+            if result.type == 'SELECT':
+                result.bindings
+            return result
+
+    def update(self, update):
+        """
+        Execute a SPARQL update.
+        If the dataset does not use a CountingMemory store, only the change in the number of statements is known.
+        :return: A tuple of the number of removed and the number of added statements
+        """
+        with self.lock:
+            store = self.dataset.store
+            if isinstance(store, CountingMemory):
+                store.added = store.removed = 0
+                self.dataset.update(update)
+                self.lastMutations = (store.removed, store.added)
+            else:
+                before = self.countStatements()
+                self.dataset.update(update)
+                change = self.countStatements() - before
+                self.lastMutations = (max(-change, 0), max(change, 0))
+            return self.lastMutations
+
+class SparqlRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        if 'query' in params:
+            self.handleQuery(params['query'][0])
+        else:
+            self.respond(200, 'text/plain', "SPARQL endpoint with %d statements\n" % self.server.endpoint.countStatements())
+
+    def do_POST(self):
+        params = parse_qs(urlparse(self.path).query)
+        contentType = (self.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+
+        if contentType == 'application/x-www-form-urlencoded':
+            params.update(parse_qs(body, keep_blank_values=True))
+        elif contentType == 'application/sparql-query':
+            params['query'] = [body]
+        elif contentType == 'application/sparql-update':
+            params['update'] = [body]
+        elif contentType in RDF_CONTENT_TYPES:
+            self.handleLoad(body, RDF_CONTENT_TYPES[contentType], params.get('context-uri', [None])[0])
+            return
+
+        if 'query' in params:
+            self.handleQuery(params['query'][0])
+        elif 'update' in params:
+            self.handleUpdate(params['update'][0])
+        else:
+            self.respond(400, 'text/plain', "Missing query or update parameter\n")
+
+    def handleQuery(self, query):
+        try:
+            result = self.server.endpoint.query(query)
+        except ParseException as e:
+            self.respond(400, 'text/plain', "Malformed query: %s\n" % e)
+            return
+        except Exception as e:
+            self.respond(500, 'text/plain', "Query failed: %s\n" % e)
+            return
+        accept = self.headers.get('Accept') or ''
+        if result.type in ['CONSTRUCT', 'DESCRIBE']:
+            if 'text/turtle' in accept:
+                self.respond(200, 'text/turtle', result.serialize(format='turtle'))
+            elif 'application/rdf+xml' in accept:
+                self.respond(200, 'application/rdf+xml', result.serialize(format='xml'))
+            else:
+                self.respond(200, 'application/n-triples', result.serialize(format='nt'))
+        elif 'text/tab-separated-values' in accept:
+            self.respond(200, 'text/tab-separated-values', serialiseTsv(result))
+        elif 'text/csv' in accept:
+            self.respond(200, 'text/csv', serialiseCsv(result))
+        elif 'application/sparql-results+xml' in accept or ('xml' in accept and 'json' not in accept):
+            self.respond(200, 'application/sparql-results+xml', result.serialize(format='xml'))
+        else:
+            self.respond(200, 'application/sparql-results+json', result.serialize(format='json'))
+
+    def handleUpdate(self, update):
+        startTime = time.time()
+        try:
+            removed, added = self.server.endpoint.update(update)
+        except ParseException as e:
+            self.respond(400, 'text/plain', "Malformed update: %s\n" % e)
+            return
+        except Exception as e:
+            self.respond(500, 'text/plain', "Update failed: %s\n" % e)
+            return
+        elapsed = int((time.time() - startTime) * 1000)
+        self.respond(200, 'text/html', "<html><body><p>totalElapsed=%dms, elapsed=%dms</p><hr><p>COMMIT: totalElapsed=%dms, commitTime=%d, mutationCount=%d</p></body></html>" % (
+            elapsed, elapsed, elapsed, int(time.time() * 1000), removed + added))
+
+    def handleLoad(self, data, rdfFormat, graph):
+        startTime = time.time()
+        try:
+            modified = self.server.endpoint.load(data, rdfFormat, graph=graph)
+        except Exception as e:
+            self.respond(400, 'text/plain', "Loading the data failed: %s\n" % e)
+            return
+        self.respond(200, 'application/xml', '<?xml version="1.0"?><data modified="%d" milliseconds="%d"/>' % (modified, int((time.time() - startTime) * 1000)))
+
+    def respond(self, status, contentType, body):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serialiseTsv(result):
+    """
+    Serialise a SELECT or ASK result as SPARQL TSV, with terms in N-Triples syntax
+    """
+    if result.type == 'ASK':
+        return "?_askResult\n%s\n" % ('true' if result.askAnswer else 'false')
+    lines = ["\t".join("?%s" % d for d in result.vars)]
+    for row in result.bindings:
+        lines.append("\t".join(serialiseTerm(row.get(d)) for d in result.vars))
+    return "\n".join(lines) + "\n"
+
+def serialiseCsv(result):
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator='\n')
+    if result.type == 'ASK':
+        writer.writerows([['_askResult'], ['true' if result.askAnswer else 'false']])
+        return output.getvalue()
+    writer.writerow([str(d) for d in result.vars])
+    for row in result.bindings:
+        writer.writerow([str(row[d]) if row.get(d) is not None else '' for d in result.vars])
+    return output.getvalue()
+
+def serialiseTerm(term):
+    if term is None:
+        return ''
+    if isinstance(term, BNode):
+        return '_:%s' % term
+    if isinstance(term, Literal):
+        value = '"%s"' % str(term).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+        if term.language:
+            return value + '@' + term.language
+        if term.datatype:
+            return value + '^^<%s>' % term.datatype
+        return value
+    return '<%s>' % term
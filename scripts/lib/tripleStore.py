@@ -0,0 +1,575 @@
+"""
+In-memory triple store with integer-encoded terms and SPO/POS/OSP indexes, and an evaluator for
+the subset of SPARQL used in the pipeline's queries.
+
+Queries are parsed and translated to SPARQL algebra by rdflib, the algebra is then evaluated
+directly against the indexes. Supported are basic graph patterns, property paths (sequence, inverse,
+alternative, *, + and ?), joins, OPTIONAL, UNION, FILTER (including EXISTS and NOT EXISTS), BIND,
+VALUES, GRAPH with a fixed IRI and the projection of SELECT queries. Filter expressions are limited
+to (in)equality, logical operators, BOUND, sameTerm and COALESCE. Unsupported constructs raise a
+NotImplementedError.
+
+As in Blazegraph's quads mode, the default graph is the union of all named graphs.
+
+Terms are stored in their N-Triples serialisation. N-Triples and N-Quads files are read line by line,
+all other formats are parsed by rdflib and converted to N-Triples first.
+
+Usage:
+
+    from lib.tripleStore import TripleStore
+    store = TripleStore()
+    store.loadFile("/data/ttl/main/data.ttl", graph="https://resource.jila.zb.uzh.ch/graph/main")
+    for row in store.select("SELECT ?s WHERE { ?s a <http://www.cidoc-crm.org/cidoc-crm/E21_Person> }"):
+        print(row['s'])
+"""
+
+import gzip
+import re
+
+from rdflib import Dataset, Graph, URIRef, Literal, BNode, Variable
+from rdflib.paths import AlternativePath, InvPath, MulPath, NegatedPath, SequencePath
+from rdflib.plugins.sparql import prepareQuery
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.util import guess_format, SUFFIX_FORMAT_MAP
+
+NT_TERM = r'(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[A-Za-z0-9-]+|\^\^<[^>]*>)?)'
+NT_LINE_PATTERN = re.compile(r'^\s*' + NT_TERM + r'\s*' + NT_TERM + r'\s*' + NT_TERM + r'(?:\s*' + NT_TERM + r')?\s*\.\s*$')
+
+class TripleStore:
+    """
+    In-memory quad store. Every term is mapped to an integer, the triples are indexed
+    by subject, predicate and object (SPO, POS and OSP). For every named graph the set
+    of its triples is kept to evaluate GRAPH patterns.
+    """
+
+    def __init__(self):
+        self.termIds = {}
+        self.terms = []
+        self.spo = {}
+        self.pos = {}
+        self.osp = {}
+        self.graphs = {}
+        self.predicateCounts = {}
+        self.size = 0
+        self._fileCount = 0
+
+    def encode(self, term):
+        """
+        Return the id of a term given in N-Triples syntax, adding it to the dictionary if needed.
+        """
+        termId = self.termIds.get(term)
+        if termId is None:
+            termId = len(self.terms)
+            self.termIds[term] = termId
+            self.terms.append(term)
+        return termId
+
+    def decode(self, termId):
+        return self.terms[termId]
+
+    def encodeNode(self, node):
+        """
+        Return the id of an rdflib term.
+        """
+        if isinstance(node, URIRef):
+            return self.encode('<%s>' % node)
+        if isinstance(node, Literal):
+            return self.encode(_literalToNt(node))
+        if isinstance(node, BNode):
+            return self.encode('_:%s' % node)
+        raise ValueError("Cannot encode %r" % node)
+
+    def add(self, s, p, o, graph=None):
+        """
+        Add a triple of term ids, optionally to a named graph (given as term id).
+        Returns True if the triple was not yet present in any graph.
+        """
+        if graph is not None:
+            self.graphs.setdefault(graph, set()).add((s, p, o))
+        objects = self.spo.setdefault(s, {}).setdefault(p, set())
+        if o in objects:
+            return False
+        objects.add(o)
+        self.pos.setdefault(p, {}).setdefault(o, set()).add(s)
+        self.osp.setdefault(o, {}).setdefault(s, set()).add(p)
+        self.predicateCounts[p] = self.predicateCounts.get(p, 0) + 1
+        self.size += 1
+        return True
+
+    def remove(self, s, p, o, graph=None):
+        """
+        Remove a triple from a named graph. The triple is removed from the indexes
+        once it is no longer contained in any graph.
+        """
+        if graph is not None and graph in self.graphs:
+            self.graphs[graph].discard((s, p, o))
+            if any((s, p, o) in d for d in self.graphs.values()):
+                return
+        objects = self.spo.get(s, {}).get(p)
+        if not objects or o not in objects:
+            return
+        objects.discard(o)
+        if not objects:
+            del self.spo[s][p]
+        subjects = self.pos[p][o]
+        subjects.discard(s)
+        if not subjects:
+            del self.pos[p][o]
+        predicates = self.osp[o][s]
+        predicates.discard(p)
+        if not predicates:
+            del self.osp[o][s]
+        self.predicateCounts[p] -= 1
+        self.size -= 1
+
+    def contains(self, s, p, o, graph=None):
+        if graph is not None:
+            return (s, p, o) in self.graphs.get(graph, ())
+        return o in self.spo.get(s, {}).get(p, ())
+
+    def match(self, s=None, p=None, o=None, graph=None):
+        """
+        Yield the triples matching the given term ids, None acts as wildcard.
+        """
+        if s is not None:
+            predicates = self.spo.get(s)
+            if not predicates:
+                return
+            if p is not None:
+                objects = predicates.get(p, ())
+                if o is not None:
+                    candidates = [(s, p, o)] if o in objects else []
+                else:
+                    candidates = ((s, p, d) for d in objects)
+            elif o is not None:
+                candidates = ((s, d, o) for d in self.osp.get(o, {}).get(s, ()))
+            else:
+                candidates = ((s, pred, obj) for pred, objects in predicates.items() for obj in objects)
+        elif p is not None:
+            objects = self.pos.get(p)
+            if not objects:
+                return
+            if o is not None:
+                candidates = ((d, p, o) for d in objects.get(o, ()))
+            else:
+                candidates = ((subj, p, obj) for obj, subjects in objects.items() for subj in subjects)
+        elif o is not None:
+            candidates = ((subj, pred, o) for subj, predicates in self.osp.get(o, {}).items() for pred in predicates)
+        else:
+            candidates = ((subj, pred, obj) for subj, predicates in self.spo.items() for pred, objects in predicates.items() for obj in objects)
+
+        if graph is None:
+            yield from candidates
+        else:
+            triples = self.graphs.get(graph, ())
+            for triple in candidates:
+                if triple in triples:
+                    yield triple
+
+    def estimate(self, s=None, p=None, o=None):
+        """
+        Estimate the number of triples matching the given term ids.
+        """
+        if s is not None and p is not None:
+            return len(self.spo.get(s, {}).get(p, ()))
+        if p is not None and o is not None:
+            return len(self.pos.get(p, {}).get(o, ()))
+        if s is not None and o is not None:
+            return len(self.osp.get(o, {}).get(s, ()))
+        if s is not None:
+            return 10 * len(self.spo.get(s, ()))
+        if o is not None:
+            return 10 * len(self.osp.get(o, ()))
+        if p is not None:
+            return self.predicateCounts.get(p, 0)
+        return self.size
+
+    def loadFile(self, filename, *, graph=None):
+        """
+        Load an RDF file. N-Triples (.nt) and N-Quads (.nq) are read line by line,
+        other formats are parsed with rdflib. Gzip compressed files (.gz) are supported.
+        Triples are added to the given named graph, quads to their own graph (or the given graph if they have none).
+        Blank node labels are made unique per file.
+        :param filename: Path to the file
+        :param graph: IRI of the named graph to add the triples to (optional)
+        :return: The number of statements read
+        """
+        self._fileCount += 1
+        bnodePrefix = "_:f%d_" % self._fileCount
+        graphId = self.encode('<%s>' % graph) if graph else None
+        baseName = filename[:-3] if filename.endswith('.gz') else filename
+        opener = gzip.open if filename.endswith('.gz') else open
+
+        if baseName.endswith('.nt') or baseName.endswith('.nq'):
+            with opener(filename, 'rt', encoding='utf-8') as f:
+                return self.loadLines(f, graph=graphId, bnodePrefix=bnodePrefix)
+
+        rdfFormat = guess_format(baseName, dict(SUFFIX_FORMAT_MAP, rdfs='xml')) or 'turtle'
+        with opener(filename, 'rb') as f:
+            if rdfFormat in ['trig', 'nquads', 'trix']:
+                data = Dataset()
+                data.parse(f, format=rdfFormat)
+                lines = data.serialize(format='nquads')
+            else:
+                data = Graph()
+                data.parse(f, format=rdfFormat)
+                lines = data.serialize(format='nt')
+        if isinstance(lines, bytes):
+            lines = lines.decode('utf-8')
+        return self.loadLines(lines.splitlines(), graph=graphId, bnodePrefix=bnodePrefix)
+
+    def loadLines(self, lines, *, graph=None, bnodePrefix='_:'):
+        """
+        Load N-Triples or N-Quads lines.
+        :param lines: Iterable of lines
+        :param graph: Id of the named graph for triples without graph
+        :param bnodePrefix: Prefix replacing the _: of blank node labels
+        :return: The number of statements read
+        """
+        count = 0
+        for line in lines:
+            if not line.strip() or line.lstrip().startswith('#'):
+                continue
+            match = NT_LINE_PATTERN.match(line)
+            if not match:
+                raise ValueError("Invalid N-Triples line: %s" % line.strip())
+            terms = [bnodePrefix + d[2:] if d and d.startswith('_:') else d for d in match.groups()]
+            lineGraph = self.encode(terms[3]) if terms[3] else graph
+            self.add(self.encode(terms[0]), self.encode(terms[1]), self.encode(terms[2]), lineGraph)
+            count += 1
+        return count
+
+    def writeGraph(self, f, graph, *, quads=False):
+        """
+        Write the triples of a named graph as N-Triples or N-Quads to a file object
+        :param f: The file object
+        :param graph: IRI of the named graph
+        :param quads: If True, N-Quads are written
+        """
+        graphId = self.termIds.get('<%s>' % graph)
+        suffix = (' <%s> .\n' % graph) if quads else ' .\n'
+        for s, p, o in sorted(self.graphs.get(graphId, ())):
+            f.write(self.terms[s] + ' ' + self.terms[p] + ' ' + self.terms[o] + suffix)
+
+    def select(self, query, *, initNs=None):
+        """
+        Evaluate a SPARQL SELECT query.
+        :param query: The query string
+        :param initNs: Dictionary of prefixes and namespaces (optional)
+        :return: Generator of dictionaries of variable names and N-Triples terms
+        """
+        for solution in self.selectIds(query, initNs=initNs):
+            yield {str(k): self.terms[v] for k, v in solution.items()}
+
+    def selectIds(self, query, *, initNs=None):
+        """
+        Evaluate a SPARQL SELECT query and yield the solutions as dictionaries of rdflib Variables and term ids.
+        """
+        algebra = prepareQuery(query, initNs=initNs or {}).algebra
+        if algebra.name != 'SelectQuery':
+            raise NotImplementedError("Only SELECT queries are supported")
+        return QueryEvaluator(self).evaluate(algebra.p, [{}], None)
+
+class QueryEvaluator:
+    """
+    Evaluates SPARQL algebra against a TripleStore. Solutions are passed from one pattern
+    to the next (sideways information passing), so that joins are evaluated as index lookups.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def evaluate(self, node, solutions, graph):
+        method = getattr(self, '_eval' + node.name, None)
+        if method is None:
+            raise NotImplementedError("Unsupported SPARQL construct: %s" % node.name)
+        return method(node, solutions, graph)
+
+    def _evalProject(self, node, solutions, graph):
+        variables = node.PV
+        for solution in self.evaluate(node.p, solutions, graph):
+            yield {v: solution[v] for v in variables if v in solution}
+
+    def _evalDistinct(self, node, solutions, graph):
+        seen = set()
+        for solution in self.evaluate(node.p, solutions, graph):
+            key = frozenset(solution.items())
+            if key not in seen:
+                seen.add(key)
+                yield solution
+
+    _evalReduced = _evalDistinct
+
+    def _evalSlice(self, node, solutions, graph):
+        start = node.start or 0
+        for i, solution in enumerate(self.evaluate(node.p, solutions, graph)):
+            if i < start:
+                continue
+            if node.length is not None and i >= start + node.length:
+                return
+            yield solution
+
+    def _evalJoin(self, node, solutions, graph):
+        return self.evaluate(node.p2, self.evaluate(node.p1, solutions, graph), graph)
+
+    def _evalLeftJoin(self, node, solutions, graph):
+        for solution in self.evaluate(node.p1, solutions, graph):
+            matched = False
+            for extended in self.evaluate(node.p2, [solution], graph):
+                if self.isTrue(node.expr, extended, graph):
+                    matched = True
+                    yield extended
+            if not matched:
+                yield solution
+
+    def _evalUnion(self, node, solutions, graph):
+        for solution in solutions:
+            yield from self.evaluate(node.p1, [solution], graph)
+            yield from self.evaluate(node.p2, [solution], graph)
+
+    def _evalFilter(self, node, solutions, graph):
+        for solution in self.evaluate(node.p, solutions, graph):
+            if self.isTrue(node.expr, solution, graph):
+                yield solution
+
+    def _evalExtend(self, node, solutions, graph):
+        for solution in self.evaluate(node.p, solutions, graph):
+            value = self.evalExpression(node.expr, solution, graph)
+            if value is None or isinstance(value, bool):
+                yield solution
+            elif node.var in solution:
+                if solution[node.var] == value:
+                    yield solution
+            else:
+                extended = dict(solution)
+                extended[node.var] = value
+                yield extended
+
+    def _evalToMultiSet(self, node, solutions, graph):
+        return self.evaluate(node.p, solutions, graph)
+
+    def _evalvalues(self, node, solutions, graph):
+        rows = [{k: self.store.encodeNode(v) for k, v in row.items() if v is not None} for row in node.res]
+        for solution in solutions:
+            for row in rows:
+                if all(solution.get(k, v) == v for k, v in row.items()):
+                    extended = dict(solution)
+                    extended.update(row)
+                    yield extended
+
+    def _evalGraph(self, node, solutions, graph):
+        term = node.term
+        for solution in solutions:
+            if isinstance(term, Variable):
+                if term not in solution:
+                    raise NotImplementedError("GRAPH with an unbound variable is not supported")
+                graphId = solution[term]
+            else:
+                graphId = self.store.encodeNode(term)
+            yield from self.evaluate(node.p, [solution], graphId)
+
+    def _evalBGP(self, node, solutions, graph):
+        triples = list(node.triples)
+        for solution in solutions:
+            yield from self._evalTriples(triples, solution, graph)
+
+    def _evalTriples(self, triples, solution, graph):
+        if not triples:
+            yield solution
+            return
+        # Evaluate the most selective pattern first, given the current bindings
+        index = min(range(len(triples)), key=lambda i: self._estimate(triples[i], solution))
+        s, p, o = triples[index]
+        rest = triples[:index] + triples[index + 1:]
+        sId = self._resolve(s, solution)
+        oId = self._resolve(o, solution)
+        if isinstance(p, (URIRef, Variable)):
+            pId = self._resolve(p, solution)
+            matches = ((ms, mp, mo) for ms, mp, mo in self.store.match(sId, pId, oId, graph))
+            for ms, mp, mo in matches:
+                extended = self._bind(solution, ((s, ms), (p, mp), (o, mo)))
+                if extended is not None:
+                    yield from self._evalTriples(rest, extended, graph)
+        else:
+            for ms, mo in set(self.evalPath(p, sId, oId, graph)):
+                extended = self._bind(solution, ((s, ms), (o, mo)))
+                if extended is not None:
+                    yield from self._evalTriples(rest, extended, graph)
+
+    def _resolve(self, term, solution):
+        if isinstance(term, Variable):
+            return solution.get(term)
+        if isinstance(term, BNode):
+            # Blank nodes in patterns act as variables
+            return solution.get(Variable('_bnode_' + str(term)))
+        return self.store.encodeNode(term)
+
+    def _bind(self, solution, pairs):
+        extended = None
+        for term, value in pairs:
+            if isinstance(term, BNode):
+                term = Variable('_bnode_' + str(term))
+            if not isinstance(term, Variable):
+                continue
+            current = (extended or solution).get(term)
+            if current is None:
+                if extended is None:
+                    extended = dict(solution)
+                extended[term] = value
+            elif current != value:
+                return None
+        return extended if extended is not None else solution
+
+    def _estimate(self, triple, solution):
+        s, p, o = triple
+        sId = self._resolve(s, solution)
+        oId = self._resolve(o, solution)
+        if isinstance(p, (URIRef, Variable)):
+            return self.store.estimate(sId, self._resolve(p, solution), oId)
+        if sId is not None or oId is not None:
+            return 100
+        return self.store.size * 10
+
+    def evalPath(self, path, s, o, graph):
+        """
+        Yield the (subject, object) pairs connected by a property path.
+        """
+        if isinstance(path, URIRef):
+            p = self.store.encodeNode(path)
+            for ms, _, mo in self.store.match(s, p, o, graph):
+                yield ms, mo
+        elif isinstance(path, InvPath):
+            for ms, mo in self.evalPath(path.arg, o, s, graph):
+                yield mo, ms
+        elif isinstance(path, SequencePath):
+            yield from self._evalSequence(list(path.args), s, o, graph)
+        elif isinstance(path, AlternativePath):
+            for arg in path.args:
+                yield from self.evalPath(arg, s, o, graph)
+        elif isinstance(path, MulPath):
+            yield from self._evalMulPath(path, s, o, graph)
+        elif isinstance(path, NegatedPath):
+            raise NotImplementedError("Negated property paths are not supported")
+        else:
+            raise NotImplementedError("Unsupported property path: %r" % path)
+
+    def _evalSequence(self, args, s, o, graph):
+        if len(args) == 1:
+            yield from self.evalPath(args[0], s, o, graph)
+            return
+        if s is None and o is not None:
+            # Evaluate from the bound end
+            for middle, mo in set(self.evalPath(args[-1], None, o, graph)):
+                for ms, _ in self._evalSequence(args[:-1], None, middle, graph):
+                    yield ms, mo
+        else:
+            for ms, middle in set(self.evalPath(args[0], s, None, graph)):
+                for _, mo in self._evalSequence(args[1:], middle, o, graph):
+                    yield ms, mo
+
+    def _evalMulPath(self, path, s, o, graph):
+        zeroLength = path.mod in ['*', '?']
+        maxSteps = 1 if path.mod == '?' else None
+
+        def reachable(start, forward):
+            visited = set()
+            frontier = [start]
+            steps = 0
+            while frontier and (maxSteps is None or steps < maxSteps):
+                steps += 1
+                nextFrontier = []
+                for node in frontier:
+                    pairs = self.evalPath(path.path, node, None, graph) if forward else self.evalPath(path.path, None, node, graph)
+                    for ms, mo in pairs:
+                        target = mo if forward else ms
+                        if target not in visited:
+                            visited.add(target)
+                            nextFrontier.append(target)
+                frontier = nextFrontier
+            if zeroLength:
+                visited.add(start)
+            return visited
+
+        if s is not None:
+            targets = reachable(s, True)
+            if o is not None:
+                if o in targets:
+                    yield s, o
+            else:
+                for target in targets:
+                    yield s, target
+        elif o is not None:
+            for source in reachable(o, False):
+                yield source, o
+        else:
+            nodes = set(self.store.spo.keys()) | set(self.store.osp.keys())
+            for node in nodes:
+                for target in reachable(node, True):
+                    yield node, target
+
+    def isTrue(self, expr, solution, graph):
+        return self.evalExpression(expr, solution, graph) is True
+
+    def evalExpression(self, expr, solution, graph):
+        """
+        Evaluate an expression. Returns a term id, a boolean or None (for unbound values and errors).
+        """
+        if isinstance(expr, Variable):
+            return solution.get(expr)
+        if isinstance(expr, (URIRef, Literal)):
+            return self.store.encodeNode(expr)
+        if not isinstance(expr, CompValue):
+            raise NotImplementedError("Unsupported expression: %r" % expr)
+
+        name = expr.name
+        if name == 'TrueFilter':
+            return True
+        if name == 'RelationalExpression':
+            if expr.op not in ['=', '!=']:
+                raise NotImplementedError("Unsupported operator: %s" % expr.op)
+            left = self.evalExpression(expr.expr, solution, graph)
+            right = self.evalExpression(expr.other, solution, graph)
+            if left is None or right is None:
+                return None
+            return (left == right) if expr.op == '=' else (left != right)
+        if name == 'ConditionalAndExpression':
+            values = [self.evalExpression(d, solution, graph) for d in [expr.expr] + list(expr.other or [])]
+            if any(d is False for d in values):
+                return False
+            return True if all(d is True for d in values) else None
+        if name == 'ConditionalOrExpression':
+            values = [self.evalExpression(d, solution, graph) for d in [expr.expr] + list(expr.other or [])]
+            if any(d is True for d in values):
+                return True
+            return False if all(d is False for d in values) else None
+        if name == 'UnaryNot':
+            value = self.evalExpression(expr.expr, solution, graph)
+            return (not value) if isinstance(value, bool) else None
+        if name == 'Builtin_BOUND':
+            return expr.arg in solution
+        if name == 'Builtin_sameTerm':
+            left = self.evalExpression(expr.arg1, solution, graph)
+            right = self.evalExpression(expr.arg2, solution, graph)
+            return None if left is None or right is None else left == right
+        if name == 'Builtin_COALESCE':
+            for arg in expr.arg:
+                value = self.evalExpression(arg, solution, graph)
+                if value is not None:
+                    return value
+            return None
+        if name == 'Builtin_EXISTS':
+            return any(True for _ in self.evaluate(expr.graph, [solution], graph))
+        if name == 'Builtin_NOTEXISTS':
+            return not any(True for _ in self.evaluate(expr.graph, [solution], graph))
+        raise NotImplementedError("Unsupported expression: %s" % name)
+
+def _literalToNt(literal):
+    """
+    Serialise an rdflib Literal in N-Triples syntax, as produced by rdflib's N-Triples serialiser.
+    """
+    g = Graph()
+    g.add((URIRef('urn:x'), URIRef('urn:x'), literal))
+    line = g.serialize(format='nt')
+    if isinstance(line, bytes):
+        line = line.decode('utf-8')
+    return NT_LINE_PATTERN.match(line.strip()).group(3)
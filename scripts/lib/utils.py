@@ -1,23 +1,81 @@
 import chardet
 import csv
+import gzip
 import json
+import os
 import re
-import requests
 import sys
+import threading
+import time
 from bs4 import BeautifulSoup
+from lxml import etree
+from concurrent.futures import ThreadPoolExecutor
 from os import listdir
-from os.path import join
+from os.path import join, isfile, getsize
+from tqdm import tqdm
+from urllib.parse import urlparse
+
+from lib.cache import getHttpCache
+
+# Nodes of the OAI METS records that are not used in the mapping
+OAI_PATHS_TO_REMOVE = [
+    ".//{http://www.loc.gov/METS/}metsHdr",
+    ".//{http://www.loc.gov/METS/}fileSec",
+    ".//{http://www.loc.gov/METS/}structMap",
+    ".//{http://www.loc.gov/METS/}structLink"
+]
+
+class RateLimiter:
+    """
+    Thread-safe rate limiter that spaces out requests to the same host.
+    Call wait() with the URL before every request.
+
+    :param requestsPerSecond: The maximum number of requests per second and host
+    """
+
+    def __init__(self, *, requestsPerSecond):
+        self.interval = 1.0 / requestsPerSecond if requestsPerSecond else 0
+        self._nextSlot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._nextSlot.get(host, now))
+            self._nextSlot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
 
 class RetrieveVLIDfromDOI:
     # Class to retrieve VLIDs based on DOI
     # Uses a Map file to retrieve corresponding VLID from DOI
-    # If VLID is not present, scrapes it from e-manuscripta
-    
+    # If VLID is not present, resolves the DOI and extracts the VLID from the e-manuscripta URL it redirects to,
+    # falling back to scanning the beginning of the landing page for the link to the IIIF manifest.
+    # DOIs that cannot be resolved are stored in a separate file and only retried after a while.
+
     vlidMap = {}
     vlidMapFile = ''
-    
-    def __init__(self, *, vlidMapFile):
+    unresolvedMapFile = ''
+
+    # Number of days after which unresolvable DOIs are retried
+    UNRESOLVED_RETRY_DAYS = 30
+    # Maximum number of bytes of the landing page that are scanned for the IIIF manifest link
+    MAX_SCAN_BYTES = 512 * 1024
+
+    # Only the title information and the IIIF manifest are identified by the VLID of the record.
+    # The other views and the IIIF images are identified by the ID of a page or a file and are resolved through the landing page
+    VLID_URL_PATTERN = re.compile(r'/(?:titleinfo/(\d+)(?:[/?#]|$)|i3f/v20/(\d+)/manifest)')
+    VLID_MANIFEST_PATTERN = re.compile(rb'/i3f/v20/(\d+)/manifest')
+
+    def __init__(self, *, vlidMapFile, unresolvedMapFile=None):
         self.vlidMapFile = vlidMapFile
+        self.unresolvedMapFile = unresolvedMapFile if unresolvedMapFile else re.sub(r'(\.csv)?$', '_unresolved.csv', vlidMapFile, count=1)
+        self.vlidMap = {}
+        self.unresolvedMap = {}
+        self._lock = threading.Lock()
         try:
             with open(vlidMapFile,'r') as f:
                 reader = csv.DictReader(f)
@@ -25,38 +83,122 @@ class RetrieveVLIDfromDOI:
                     self.vlidMap[row['doi']] = row['vlid']
         except:
             self.vlidMap = {}
+        try:
+            with open(self.unresolvedMapFile,'r') as f:
+                reader = csv.DictReader(f)
+                for row in reader:
+                    self.unresolvedMap[row['doi']] = float(row['checked'])
+        except:
+            self.unresolvedMap = {}
 
     def getVlidForDoi(self, doi):
         if doi in self.vlidMap:
             return self.vlidMap[doi]
+        if self._isKnownUnresolved(doi):
+            return None
         return self._retrieveVlidForDoi(doi)
-    
+
+    def resolveDois(self, dois, *, maxWorkers=8):
+        """
+        Resolve the VLIDs of the given DOIs concurrently.
+        DOIs that are already mapped or recently failed to resolve are skipped.
+        Newly resolved DOIs are appended to the map file immediately.
+
+        :param dois: list of DOIs
+        :param maxWorkers: number of concurrent requests
+        """
+        toResolve = sorted(set([d for d in dois if d not in self.vlidMap and not self._isKnownUnresolved(d)]))
+        if not toResolve:
+            return
+        print("Resolving VLIDs for %d DOIs" % len(toResolve))
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            list(tqdm(executor.map(self._retrieveVlidForDoi, toResolve), total=len(toResolve)))
+
     def writeVlidMap(self):
         with open(self.vlidMapFile,'w') as f:
             writer = csv.DictWriter(f, fieldnames=['doi','vlid'])
             writer.writeheader()
             for doi, vlid in sorted(self.vlidMap.items()):
                 writer.writerow({'doi': doi, 'vlid': vlid})
-    
+        if self.unresolvedMap:
+            with open(self.unresolvedMapFile,'w') as f:
+                writer = csv.DictWriter(f, fieldnames=['doi','checked'])
+                writer.writeheader()
+                for doi, checked in sorted(self.unresolvedMap.items()):
+                    writer.writerow({'doi': doi, 'checked': checked})
+
+    def _isKnownUnresolved(self, doi):
+        return doi in self.unresolvedMap and time.time() - self.unresolvedMap[doi] < self.UNRESOLVED_RETRY_DAYS * 24 * 60 * 60
+
     def _retrieveVlidForDoi(self, doi):
-        # Parse HTML returned from e-manuscripta to get VLID
-        rawHtml = requests.get(doi).text
-        soup = BeautifulSoup(rawHtml, 'html.parser')
+        cache = getHttpCache()
+        if cache.offline:
+            return None
         try:
-            link = soup.find('a', {"target": "iiif-manifest"}).get('href')
-        except:
-            print("No link found for DOI %s" % doi)
+            vlid = self._resolveVlid(cache.session, doi)
+        except Exception as e:
+            # Network errors and transient HTTP errors are not cached as unresolvable
+            print("Could not retrieve DOI %s: %s" % (doi, e))
             return None
-        idSearch = re.search(r'/i3f/v20/(\d*)/manifest', link)
-        if idSearch:
-            vlid = idSearch.group(1)
+        if vlid:
             self._updateVlidMap(doi=doi, vlid=vlid)
-            return vlid
         else:
-            return None
-        
+            print("No link found for DOI %s" % doi)
+            self._updateUnresolvedMap(doi=doi)
+        return vlid
+
+    def _resolveVlid(self, session, doi):
+        """
+        Follow the redirects of the DOI and try to extract the VLID from the URLs and headers.
+        If this is not possible, the landing page is streamed and scanned for the link to the IIIF manifest.
+        None is only returned if the DOI or landing page does not exist (HTTP 404/410) or the landing page
+        contains no link. Other error statuses, such as 429 or 5xx, raise an exception, as they may be transient.
+        """
+        with session.get(doi, stream=True, timeout=30) as response:
+            urls = [r.headers.get('Location', '') for r in response.history] + [response.url, response.headers.get('Link', '')]
+            for url in urls:
+                idSearch = self.VLID_URL_PATTERN.search(url)
+                if idSearch:
+                    return idSearch.group(1) or idSearch.group(2)
+            if response.status_code in [404, 410]:
+                return None
+            if response.status_code != 200:
+                raise Exception("HTTP Error %d" % response.status_code)
+            scanned = 0
+            tail = b''
+            for chunk in response.iter_content(chunk_size=16 * 1024):
+                data = tail + chunk
+                idSearch = self.VLID_MANIFEST_PATTERN.search(data)
+                if idSearch:
+                    return idSearch.group(1).decode()
+                # Keep the end of the chunk in case the link is split across chunks
+                tail = data[-64:]
+                scanned += len(chunk)
+                if scanned > self.MAX_SCAN_BYTES:
+                    break
+        return None
+
     def _updateVlidMap(self, *, doi, vlid):
-        self.vlidMap[doi] = vlid
+        with self._lock:
+            self.vlidMap[doi] = vlid
+            self.unresolvedMap.pop(doi, None)
+            # Append to the map file so that resolved DOIs are kept if the run is interrupted
+            writeHeader = not isfile(self.vlidMapFile) or getsize(self.vlidMapFile) == 0
+            with open(self.vlidMapFile, 'a') as f:
+                writer = csv.DictWriter(f, fieldnames=['doi','vlid'])
+                if writeHeader:
+                    writer.writeheader()
+                writer.writerow({'doi': doi, 'vlid': vlid})
+
+    def _updateUnresolvedMap(self, *, doi):
+        with self._lock:
+            self.unresolvedMap[doi] = time.time()
+            writeHeader = not isfile(self.unresolvedMapFile) or getsize(self.unresolvedMapFile) == 0
+            with open(self.unresolvedMapFile, 'a') as f:
+                writer = csv.DictWriter(f, fieldnames=['doi','checked'])
+                if writeHeader:
+                    writer.writeheader()
+                writer.writerow({'doi': doi, 'checked': self.unresolvedMap[doi]})
 
 
 def readRecords(directory, *, detectEncoding=False, encoding='utf-8'):
@@ -103,3 +245,52 @@ def readRecords(directory, *, detectEncoding=False, encoding='utf-8'):
     records = list({v['GUID']:v for v in records}.values())
             
     return records
+
+
+def reduceOaiRecord(tree):
+    """
+    Reduce an OAI METS record to the parts used in the mapping.
+    The nodes listed in OAI_PATHS_TO_REMOVE are removed and the namespaces are removed from all tags.
+    The tree is modified in place. Reducing an already reduced record has no effect.
+
+    :param tree: the record as lxml ElementTree or Element
+    :return: the reduced record
+    """
+    nodesToRemove = [item for sublist in [tree.findall(d) for d in OAI_PATHS_TO_REMOVE] for item in sublist]
+
+    for unneeded in nodesToRemove:
+        unneeded.getparent().remove(unneeded)
+
+    # Remove namespaces
+    for elem in tree.iter():
+        if isinstance(elem.tag, str):
+            elem.tag = etree.QName(elem).localname
+    etree.cleanup_namespaces(tree)
+
+    return tree
+
+def readOaiRecord(filename):
+    """
+    Read an OAI record from a file. Gzip compressed files (ending in .gz) are decompressed.
+
+    :param filename: path to the XML file
+    :return: the record as lxml ElementTree
+    """
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rb') as f:
+            return etree.parse(f)
+    return etree.parse(filename)
+
+def writeReducedOaiRecord(tree, filename):
+    """
+    Reduce an OAI record and write it gzip compressed to the given file.
+    The file is replaced atomically.
+
+    :param tree: the record as lxml ElementTree or Element
+    :param filename: path to the output file (should end in .xml.gz)
+    """
+    reduced = reduceOaiRecord(tree)
+    tmpFilename = filename + ".tmp"
+    with gzip.open(tmpFilename, 'wb') as f:
+        f.write(etree.tostring(reduced))
+    os.replace(tmpFilename, filename)
@@ -0,0 +1,486 @@
+"""
+Checks the SPARQL queries of the pipeline for patterns that are known to be slow in Blazegraph
+and estimates their cost from predicate statistics of the local data.
+
+The statements of the update files in the queries folder and the relation queries generated from
+the relation definitions (see materialiseRelations.py) are parsed with rdflib and checked for:
+- regex-str: REGEX(STR(?x), ...), where STRSTARTS or CONTAINS would do
+- unbounded-path: property paths with * or +, such as rdfs:subClassOf*
+- graph-variable: GRAPH patterns with an unbound graph variable, which match across all graphs
+- large-not-exists: FILTER NOT EXISTS over patterns matching more than --largeSetThreshold triples
+
+The cost of a query is the estimated number of intermediate results, based on the number of triples,
+distinct subjects and distinct objects per predicate and the number of instances per class in the
+RDF files given via --statistics. The statistics are cached as long as the files are unchanged.
+
+A query fails the check if its cost exceeds the budget, unless it is listed in the baseline file
+with a similar cost. Use --updateBaseline true to accept the current costs. The statements of the update
+files are identified by their label and a hash of their text, so that adding or removing a statement does
+not change the identifiers of the others. Baseline entries that no longer match a query are reported.
+
+Usage:
+
+python lintSparqlQueries.py --queries <glob pattern> --definitions <YAML file> --statistics <glob patterns>
+
+Parameters:
+    --queries               Comma-separated list of glob patterns of SPARQL update files (optional, default: /scripts/queries/*.sparql)
+    --definitions           Comma-separated list of relation definition files (optional, default: /scripts/definitions/network.yml)
+    --schemas               Comma-separated list of RDFS schemas used for the subclass closure of the relation queries (optional)
+    --statistics            Comma-separated list of glob patterns of the RDF files to gather statistics from (optional)
+    --statisticsCacheFile   The JSON file in which the statistics are cached (optional)
+    --budget                The maximum estimated cost of a query (optional, default: 100000000)
+    --baseline              The JSON file with the accepted costs per query (optional, default: /scripts/queries/cost-baseline.json)
+    --tolerance             The factor by which the cost of a query may exceed its baseline (optional, default: 1.5)
+    --largeSetThreshold     The number of triples above which a NOT EXISTS pattern is flagged (optional, default: 100000)
+    --strict                If set to true, the check also fails if anti-patterns are found (optional, default: false)
+    --updateBaseline        If set to true, the current costs are written to the baseline file (optional, default: false)
+"""
+
+import json
+import os
+import re
+import sys
+import yaml
+
+from glob import glob
+from hashlib import blake2b
+from rdflib import URIRef, Literal, Variable, BNode
+from rdflib.namespace import RDF
+from rdflib.paths import AlternativePath, InvPath, MulPath, NegatedPath, SequencePath
+from rdflib.plugins.sparql import prepareUpdate
+from rdflib.plugins.sparql.parserutils import CompValue
+
+from lib.tripleStore import TripleStore
+from materialiseRelations import generateRelationQueries, loadSubclasses
+from runSparqlUpdates import splitStatements
+
+# Prefixes that Blazegraph declares by default
+DEFAULT_PREFIXES = {
+    'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
+    'rdfs': 'http://www.w3.org/2000/01/rdf-schema#',
+    'owl': 'http://www.w3.org/2002/07/owl#',
+    'xsd': 'http://www.w3.org/2001/XMLSchema#',
+    'foaf': 'http://xmlns.com/foaf/0.1/',
+    'dc': 'http://purl.org/dc/elements/1.1/'
+}
+
+# Assumed number of steps of * and + property paths
+PATH_DEPTH = 5
+# Number of triples assumed per predicate if no statistics are available
+DEFAULT_PREDICATE_COUNT = 10000
+REGEX_METACHARACTERS = re.compile(r'[*+?()\[\]{}|\\$]')
+
+def performLinting(options):
+    statistics = collectStatistics(options['statistics'], cacheFile=options['statisticsCacheFile']) if options['statistics'] else None
+    if statistics:
+        print("Using statistics of %d triples" % statistics['triples'])
+    else:
+        print("No statistics given, assuming %d triples per predicate" % DEFAULT_PREDICATE_COUNT)
+
+    queries = collectQueries(options)
+    baseline = {}
+    if os.path.isfile(options['baseline']):
+        with open(options['baseline'], 'r') as f:
+            baseline = json.load(f)
+
+    costs = {}
+    failures = []
+    findingsCount = 0
+    for queryId, query in queries:
+        try:
+            operations = prepareUpdate(query, initNs=DEFAULT_PREFIXES).algebra
+        except Exception as e:
+            print("ERROR %s: Could not parse query: %s" % (queryId, e))
+            failures.append(queryId)
+            continue
+
+        estimator = CostEstimator(statistics, largeSetThreshold=options['largeSetThreshold'])
+        for operation in operations:
+            estimator.estimateOperation(operation)
+        cost = int(estimator.cost)
+        costs[queryId] = cost
+
+        findings = list(dict.fromkeys(estimator.findings))
+        for rule, message in findings:
+            print("WARNING %s [%s]: %s" % (queryId, rule, message))
+        findingsCount += len(findings)
+
+        accepted = baseline.get(queryId)
+        if cost > options['budget'] and (accepted is None or cost > accepted * options['tolerance']):
+            print("ERROR %s: Estimated cost %d exceeds the budget of %d%s" % (queryId, cost, options['budget'], " and the baseline of %d" % accepted if accepted is not None else ''))
+            failures.append(queryId)
+
+    orphaned = sorted(d for d in baseline if d not in costs)
+    for queryId in orphaned:
+        print("WARNING %s: The baseline entry does not match any query, use --updateBaseline true to remove it" % queryId)
+
+    print("")
+    for queryId, cost in sorted(costs.items(), key=lambda d: d[1], reverse=True)[:10]:
+        print("%15d  %s" % (cost, queryId))
+    print("Checked %d queries: %d warnings, %d failures, %d orphaned baseline entries" % (len(queries), findingsCount, len(failures), len(orphaned)))
+
+    if options['updateBaseline']:
+        with open(options['baseline'], 'w') as f:
+            json.dump(costs, f, indent=4, sort_keys=True)
+        print("Wrote the costs of %d queries to %s" % (len(costs), options['baseline']))
+        return
+
+    if failures or (options['strict'] and findingsCount):
+        sys.exit(1)
+
+def collectQueries(options):
+    """
+    Collect the statements of the update files and the relation queries.
+    The statements are identified by the file, their label and a hash of their normalised text
+    (see getStatementId), the relation queries by the definition file and the relation id.
+    :return: List of tuples of query id and query
+    """
+    queries = []
+    for pattern in options['queries'].split(','):
+        for filename in sorted(glob(pattern.strip())):
+            with open(filename, 'r', encoding='utf-8') as f:
+                statements = splitStatements(f.read())
+            queryIds = set()
+            for statement in statements:
+                queryId = getStatementId(os.path.basename(filename), statement)
+                # Identical statements with the same label are numbered
+                count = 1
+                while queryId + ("" if count == 1 else " (%d)" % count) in queryIds:
+                    count += 1
+                queryId += "" if count == 1 else " (%d)" % count
+                queryIds.add(queryId)
+                queries.append((queryId, statement['query']))
+
+    subclasses = loadSubclasses(options) if options['schemas'] else None
+    for filename in options['definitions'].split(','):
+        filename = filename.strip()
+        if not filename:
+            continue
+        with open(filename, 'r') as f:
+            model = yaml.safe_load(f)
+        for relationId, query in generateRelationQueries(model, namedGraph='urn:x-lint:graph', subclasses=subclasses):
+            queries.append(("%s#%s" % (os.path.basename(filename), relationId), query))
+    return queries
+
+def getStatementId(filename, statement):
+    """
+    Return an identifier of a statement of an update file that does not depend on its position.
+    The numbering that splitStatements appends to repeated labels is removed from the label,
+    whitespace is normalised before hashing the text.
+
+    >>> getStatementId('cleanup.sparql', {'label': 'Correct labels (2)', 'query': 'DELETE WHERE {\\n  ?s ?p ?o }'})
+    'cleanup.sparql#Correct labels [915236a3]'
+    >>> getStatementId('cleanup.sparql', {'label': 'Correct labels', 'query': 'DELETE WHERE { ?s ?p ?o }'})
+    'cleanup.sparql#Correct labels [915236a3]'
+
+    :param filename: The name of the update file
+    :param statement: The statement as returned by splitStatements
+    """
+    label = re.sub(r' \(\d+\)$', '', statement['label'])
+    h = blake2b(digest_size=4)
+    h.update(re.sub(r'\s+', ' ', statement['query']).strip().encode('utf-8'))
+    return "%s#%s [%s]" % (filename, label, h.hexdigest())
+
+def collectStatistics(patterns, *, cacheFile=None):
+    """
+    Gather the number of triples, distinct subjects and distinct objects per predicate and the number
+    of instances per class from RDF files. The files are read one by one, distinct counts are summed
+    over the files and are therefore approximations if subjects are spread over several files.
+    :param patterns: Comma-separated list of glob patterns
+    :param cacheFile: The JSON file in which the statistics are cached (optional)
+    :return: Dictionary with the statistics
+    """
+    files = {}
+    for pattern in patterns.split(','):
+        for filename in sorted(glob(pattern.strip())):
+            stat = os.stat(filename)
+            files[os.path.abspath(filename)] = [stat.st_mtime_ns, stat.st_size]
+    if not files:
+        print("No files found for %s" % patterns)
+        return None
+
+    if cacheFile and os.path.isfile(cacheFile):
+        try:
+            with open(cacheFile, 'r') as f:
+                cache = json.load(f)
+            if cache['files'] == files:
+                return cache['statistics']
+        except Exception:
+            print("Ignoring invalid statistics cache file %s" % cacheFile)
+
+    statistics = {"triples": 0, "subjects": 0, "objects": 0, "predicates": {}, "types": {}}
+    rdfType = '<%s>' % RDF.type
+    for filename in files:
+        store = TripleStore()
+        store.loadFile(filename)
+        statistics['triples'] += store.size
+        statistics['subjects'] += len(store.spo)
+        statistics['objects'] += len(store.osp)
+        for p, objects in store.pos.items():
+            entry = statistics['predicates'].setdefault(store.terms[p][1:-1], [0, 0, 0])
+            entry[0] += store.predicateCounts[p]
+            entry[1] += len(set(s for subjects in objects.values() for s in subjects))
+            entry[2] += len(objects)
+            if store.terms[p] == rdfType:
+                for o, subjects in objects.items():
+                    if store.terms[o].startswith('<'):
+                        statistics['types'][store.terms[o][1:-1]] = statistics['types'].get(store.terms[o][1:-1], 0) + len(subjects)
+
+    if cacheFile:
+        if os.path.dirname(cacheFile):
+            os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+        tmpFilename = cacheFile + ".tmp"
+        with open(tmpFilename, 'w') as f:
+            json.dump({"files": files, "statistics": statistics}, f)
+        os.replace(tmpFilename, cacheFile)
+    return statistics
+
+class CostEstimator:
+    """
+    Walks the SPARQL algebra of an update, estimates the number of intermediate results
+    and collects the anti-patterns found.
+    """
+
+    def __init__(self, statistics, *, largeSetThreshold=100000):
+        self.statistics = statistics
+        self.largeSetThreshold = largeSetThreshold
+        self.cost = 0
+        self.findings = []
+
+    def estimateOperation(self, operation):
+        if operation.name in ['Modify', 'DeleteWhere']:
+            if 'where' in operation:
+                where = operation.where
+            else:
+                # DELETE WHERE uses its template as pattern
+                triples = list(operation.triples or []) if 'triples' in operation else []
+                for graphTriples in (operation.quads.values() if 'quads' in operation else []):
+                    triples += graphTriples
+                where = CompValue('BGP', triples=triples)
+            self.estimate(where, 1, set())
+
+    def estimate(self, node, rows, bound):
+        """
+        Estimate the number of results of a pattern, given the number of input rows and the bound variables.
+        Adds the intermediate results to the cost.
+        :return: Tuple of the number of results and the bound variables
+        """
+        if not isinstance(node, CompValue):
+            return rows, bound
+        name = node.name
+
+        if name in ['BGP', 'Join', 'Filter', 'Extend']:
+            return self.estimateGroup(node, rows, bound)
+        if name == 'TriplesBlock':
+            return self.estimateGroup(CompValue('BGP', triples=node.triples), rows, bound)
+        if name == 'LeftJoin':
+            leftRows, leftBound = self.estimate(node.p1, rows, bound)
+            rightRows, rightBound = self.estimate(node.p2, leftRows, leftBound)
+            return max(leftRows, rightRows), rightBound
+        if name == 'Union':
+            rows1, bound1 = self.estimate(node.p1, rows, bound)
+            rows2, bound2 = self.estimate(node.p2, rows, bound)
+            return rows1 + rows2, bound1 | bound2
+        if name == 'values':
+            variables = set(k for row in node.res for k in row.keys())
+            if variables <= bound:
+                return rows, bound
+            return rows * max(len(node.res), 1), bound | variables
+        if name == 'Graph':
+            if isinstance(node.term, Variable) and node.term not in bound:
+                self.findings.append(('graph-variable', "GRAPH ?%s matches the pattern in every graph, bind the graph or use a graph IRI" % node.term))
+                bound = bound | set([node.term])
+            return self.estimate(node.p, rows, bound)
+        if name == 'GroupGraphPatternSub':
+            for part in node.part or []:
+                rows, bound = self.estimate(part, rows, bound)
+            return rows, bound
+        if name == 'GraphGraphPattern':
+            return self.estimate(CompValue('Graph', term=node.term, p=node.graph), rows, bound)
+        if name == 'Minus':
+            rows, bound = self.estimate(node.p1, rows, bound)
+            self.estimate(node.p2, 1, set())
+            return rows, bound
+
+        # Other nodes (ToMultiSet, Project, Distinct, ...) are evaluated through their sub pattern
+        for key in ['p', 'graph']:
+            if key in node and isinstance(node[key], CompValue):
+                return self.estimate(node[key], rows, bound)
+        return rows, bound
+
+    def estimateExpression(self, expr, rows, bound):
+        """
+        Check an expression for anti-patterns and add the cost of EXISTS and NOT EXISTS patterns.
+        """
+        if not isinstance(expr, CompValue):
+            return
+        if expr.name == 'Builtin_REGEX' and isinstance(expr.text, CompValue) and expr.text.name == 'Builtin_STR':
+            pattern = str(expr.pattern) if isinstance(expr.pattern, Literal) else None
+            if pattern is not None and not REGEX_METACHARACTERS.search(pattern.lstrip('^')):
+                replacement = "STRSTARTS" if pattern.startswith('^') else "CONTAINS"
+                self.findings.append(('regex-str', "REGEX(STR(...), '%s') can probably be written as %s, which does not need the regex engine" % (pattern, replacement)))
+            else:
+                self.findings.append(('regex-str', "REGEX over STR() is evaluated for every solution, consider STRSTARTS or CONTAINS"))
+        if expr.name in ['Builtin_NOTEXISTS', 'Builtin_EXISTS']:
+            unboundRows, _ = CostEstimator(self.statistics).estimate(expr.graph, 1, set())
+            if expr.name == 'Builtin_NOTEXISTS' and unboundRows > self.largeSetThreshold:
+                self.findings.append(('large-not-exists', "FILTER NOT EXISTS over a pattern matching about %d solutions" % unboundRows))
+            self.estimate(expr.graph, rows, bound)
+        for value in expr.values():
+            if isinstance(value, CompValue):
+                self.estimateExpression(value, rows, bound)
+            elif isinstance(value, list):
+                for item in value:
+                    self.estimateExpression(item, rows, bound)
+
+    def estimateGroup(self, node, rows, bound):
+        """
+        Estimate a group of joined patterns. Like the query optimiser of Blazegraph, the most selective
+        triple pattern, VALUES clause or sub pattern given the variables bound so far is chosen
+        repeatedly. Filters and bindings are evaluated at the end of the group.
+        """
+        triples = []
+        deferred = []
+        parts = []
+        self.collectGroup(node, triples, deferred, parts)
+
+        units = [(True, d) for d in triples] + [(False, d) for d in parts]
+        bound = set(bound)
+        while units:
+            fanouts = [(self.estimateUnit(isTriple, unit, bound), i) for i, (isTriple, unit) in enumerate(units)]
+            fanout, i = min(fanouts, key=lambda d: d[0])
+            isTriple, unit = units.pop(i)
+            if isTriple:
+                rows = max(rows * fanout, 1)
+                self.cost += rows
+                bound |= set(d for d in unit if isinstance(d, (Variable, BNode)))
+            else:
+                rows, bound = self.estimate(unit, rows, bound)
+
+        for part in reversed(deferred):
+            self.estimateExpression(part.expr, rows, bound)
+            if part.name == 'Extend':
+                bound = bound | set([part.var])
+        return rows, bound
+
+    def collectGroup(self, node, triples, deferred, parts):
+        if not isinstance(node, CompValue):
+            return
+        if node.name == 'Join':
+            self.collectGroup(node.p1, triples, deferred, parts)
+            self.collectGroup(node.p2, triples, deferred, parts)
+        elif node.name == 'BGP':
+            triples += [tuple(d) for d in node.triples]
+        elif node.name in ['Filter', 'Extend']:
+            deferred.append(node)
+            self.collectGroup(node.p, triples, deferred, parts)
+        else:
+            parts.append(node)
+
+    def estimateUnit(self, isTriple, unit, bound):
+        """
+        Estimate the number of solutions per input row of a triple pattern or sub pattern
+        """
+        if isTriple:
+            return self.estimatePattern(unit, bound)
+        return CostEstimator(self.statistics).estimate(unit, 1, bound)[0]
+
+    def estimatePattern(self, triple, bound):
+        """
+        Estimate the number of solutions per input row of a triple pattern
+        """
+        s, p, o = triple
+        subjectBound = not isinstance(s, (Variable, BNode)) or s in bound
+        objectBound = not isinstance(o, (Variable, BNode)) or o in bound
+        if isinstance(p, URIRef):
+            if p == RDF.type and isinstance(o, URIRef) and not subjectBound:
+                return self.typeCount(o)
+            return self.predicateFanout(p, subjectBound, objectBound)
+        if isinstance(p, (Variable, BNode)):
+            fanout = self.predicateFanout(None, subjectBound, objectBound)
+            if p in bound and self.statistics is not None:
+                # A bound predicate matches the triples of an average predicate
+                fanout = fanout / max(len(self.statistics['predicates']), 1)
+            return fanout
+        return self.pathFanout(p, subjectBound, objectBound)
+
+    def pathFanout(self, path, subjectBound, objectBound):
+        if isinstance(path, URIRef):
+            return self.predicateFanout(path, subjectBound, objectBound)
+        if isinstance(path, InvPath):
+            return self.pathFanout(path.arg, objectBound, subjectBound)
+        if isinstance(path, SequencePath):
+            args = list(path.args)
+            if objectBound and not subjectBound:
+                args.reverse()
+                fanout = self.pathFanout(args[0], False, True)
+            else:
+                fanout = self.pathFanout(args[0], subjectBound, False)
+            for arg in args[1:]:
+                fanout *= self.pathFanout(arg, True, False) if not (objectBound and not subjectBound) else self.pathFanout(arg, False, True)
+            return fanout
+        if isinstance(path, AlternativePath):
+            return sum(self.pathFanout(arg, subjectBound, objectBound) for arg in path.args)
+        if isinstance(path, MulPath):
+            if path.mod in ['*', '+']:
+                self.findings.append(('unbounded-path', "The property path %s%s is evaluated as transitive closure%s" % (
+                    path.path.n3() if hasattr(path.path, 'n3') else path.path, path.mod,
+                    ", consider a precomputed closure" if path.path in [URIRef(DEFAULT_PREFIXES['rdfs'] + 'subClassOf'), URIRef(DEFAULT_PREFIXES['rdfs'] + 'subPropertyOf')] else '')))
+                return max(self.pathFanout(path.path, subjectBound, objectBound), 1) * PATH_DEPTH
+            return self.pathFanout(path.path, subjectBound, objectBound) + 1
+        if isinstance(path, NegatedPath):
+            return self.predicateFanout(None, subjectBound, objectBound)
+        return self.predicateFanout(None, subjectBound, objectBound)
+
+    def predicateFanout(self, predicate, subjectBound, objectBound):
+        if self.statistics is None:
+            count, subjects, objects = DEFAULT_PREDICATE_COUNT, DEFAULT_PREDICATE_COUNT, DEFAULT_PREDICATE_COUNT
+        elif predicate is None:
+            count, subjects, objects = self.statistics['triples'], self.statistics['subjects'], self.statistics['objects']
+        else:
+            count, subjects, objects = self.statistics['predicates'].get(str(predicate), [0, 0, 0])
+        if subjectBound and objectBound:
+            return min(1, count)
+        if subjectBound:
+            return count / max(subjects, 1)
+        if objectBound:
+            return count / max(objects, 1)
+        return count
+
+    def typeCount(self, typeIri):
+        if self.statistics is None:
+            return DEFAULT_PREDICATE_COUNT
+        return self.statistics['types'].get(str(typeIri), 0)
+
+if __name__ == "__main__":
+    options = {}
+
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            if not sys.argv[i + 2].startswith("--"):
+                options[arg[2:]] = sys.argv[i + 2]
+            else:
+                print("Malformed arguments")
+                sys.exit(1)
+
+    if not 'queries' in options:
+        options['queries'] = '/scripts/queries/*.sparql'
+    if not 'definitions' in options:
+        options['definitions'] = '/scripts/definitions/network.yml'
+    if not 'schemas' in options:
+        options['schemas'] = None
+    if not 'schemaCacheFile' in options:
+        options['schemaCacheFile'] = None
+    if not 'statistics' in options:
+        options['statistics'] = None
+    if not 'statisticsCacheFile' in options:
+        options['statisticsCacheFile'] = None
+    if not 'baseline' in options:
+        options['baseline'] = '/scripts/queries/cost-baseline.json'
+    options['budget'] = int(options['budget']) if 'budget' in options else 100000000
+    options['tolerance'] = float(options['tolerance']) if 'tolerance' in options else 1.5
+    options['largeSetThreshold'] = int(options['largeSetThreshold']) if 'largeSetThreshold' in options else 100000
+    options['strict'] = 'strict' in options and options['strict'].lower() == 'true'
+    options['updateBaseline'] = 'updateBaseline' in options and options['updateBaseline'].lower() == 'true'
+
+    performLinting(options)
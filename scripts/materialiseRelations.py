@@ -58,91 +58,434 @@ Arguments:
 --definitions: path to the YAML file containing the definitions
 --endpoint: the SPARQL endpoint to which the queries should be sent
 --graph: the named graph to which the relations should be inserted (optional)
+--concurrency: the number of relations that are materialised concurrently (optional, default: 1)
+--report: path to a JSON file to which the duration and number of inserted triples per relation are written (optional)
+--schemas: comma-separated list of paths or glob patterns of RDFS schemas (optional). If given, the
+    subclass closure of the schemas is computed and the domain and range of the relations are checked
+    against the concrete classes instead of through rdfs:subClassOf* property paths
+--schemaCacheFile: path to a JSON file in which the subclass closure is cached (optional)
+--changedSubjects: path to a file listing the IRIs of changed or removed subjects, one per line (optional,
+    see detectChangedSubjects.py). If given, the named graph is not rebuilt: the triples touching these
+    subjects are deleted and the relations, relink and reverse steps are executed for these subjects only.
+    The file is removed once the materialisation succeeded. Requires --graph
+--backend: 'sparql' (default) to materialise the relations in the SPARQL endpoint, or 'offline' to
+    materialise them in-process from RDF dumps and write them to a file that can be bulk loaded
+--inputs: (offline backend) comma-separated list of <graph IRI>=<glob pattern> entries of the files to load.
+    Entries without graph IRI are loaded into the default graph, N-Quads and TriG files keep their graphs
+--outputFile: (offline backend) the file to which the materialised triples are written.
+    N-Quads are written if it ends in .nq, N-Triples otherwise
 
 Usage:
 
 python materialiseRelations.py --definitions <path to YAML file> --endpoint <SPARQL endpoint> --graph <named graph>    
+python materialiseRelations.py --definitions <path to YAML file> --endpoint <SPARQL endpoint> --graph <named graph> --changedSubjects <file>
+python materialiseRelations.py --definitions <path to YAML file> --backend offline --graph <named graph> --inputs <graph>=<glob>,... --outputFile <file>
 """
 
+import json
+import os
+from glob import glob
 import re
 import sys
+import time
 import yaml
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from string import Template
-from SPARQLWrapper import SPARQLWrapper
+from SPARQLWrapper import SPARQLWrapper, JSON
+from rdflib import Graph, URIRef
+from rdflib.namespace import RDFS
+from rdflib.util import guess_format, SUFFIX_FORMAT_MAP
+
+from lib.tripleStore import TripleStore
+
+RDF_TYPE = '<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>'
+OWL_INVERSE_OF = '<http://www.w3.org/2002/07/owl#inverseOf>'
+OWL_SYMMETRIC_PROPERTY = '<http://www.w3.org/2002/07/owl#SymmetricProperty>'
+CRMDIG_SAME_AS = '<http://www.ics.forth.gr/isl/CRMdig/L54_is_same-as>'
+# Graph used for the materialised triples if no named graph is given
+LOCAL_GRAPH = 'urn:x-local:materialised'
+# Number of changed subjects bound per update in the incremental materialisation
+SCOPE_BATCH_SIZE = 500
 
 def performMaterialisation(options):
 
     definitionsFile = options['definitions']
     endpoint = options['endpoint']
     namedGraph = options['graph']
+    concurrency = options['concurrency']
 
     """
-    Perform the materialisation of the relations defined in the YAML file
+    Perform the materialisation of the relations defined in the YAML file.
+    Every relation is executed as a separate update, so that the duration and
+    number of inserted triples can be reported per relation.
     """
     with open(definitionsFile, "r") as f:
         model = yaml.safe_load(f)
 
     try:
-        updateQuery = generateUpdateQuery(model, namedGraph=namedGraph)
+        relationQueries = generateRelationQueries(model, namedGraph=namedGraph, subclasses=loadSubclasses(options))
     except Exception as e:
         print("Error: %s" % e)
         sys.exit(1)
-    
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setQuery(updateQuery)
-    sparql.setMethod('POST')
 
-    result = sparql.query()
-    if result.response.status != 200:
-        print("Error: %s" % result.response.read())
+    report = []
+    startTime = time.time()
+    try:
+        if namedGraph:
+            report.append(executeStep('drop', endpoint, "DROP SILENT GRAPH <%s>" % namedGraph))
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(executeStep, relationId, endpoint, query) for relationId, query in relationQueries]
+            for future in as_completed(futures):
+                entry = future.result()
+                print("%-50s %8.1fs %10s triples" % (entry['id'], entry['duration'], entry['inserted'] if entry['inserted'] is not None else '?'))
+                report.append(entry)
+
+        """
+        Relink relations that relate to GND or other external entities,
+        for which an internal entity exists
+        """
+        report.append(executeStep('relink', endpoint, generateRelinkQuery(namedGraph=namedGraph)))
+
+        """
+        Materialise reverse relations
+        """
+        report.append(executeStep('reverse', endpoint, generateReverseQuery(namedGraph=namedGraph)))
+    except Exception as e:
+        print("Error: %s" % e)
+        writeReport(options['report'], report, startTime)
         sys.exit(1)
-    
+
+    writeReport(options['report'], report, startTime)
+    slowest = sorted(report, key=lambda d: d['duration'], reverse=True)[:5]
+    print("Slowest steps: " + ", ".join("%s (%.1fs)" % (d['id'], d['duration']) for d in slowest))
+
+    if namedGraph:
+        print(f"Successfully materialised definitions from {definitionsFile} to {endpoint} in graph {namedGraph}")
+    else:
+        print(f"Successfully materialised definitions from {definitionsFile} to {endpoint}")
+
+def performIncrementalMaterialisation(options):
     """
-    Relink relations that relate to GND or other external entities,
-    for which an internal entity exists
+    Update the materialised relations for the changed subjects only. The triples of the named graph
+    that have a changed subject as subject or object are deleted and the relations, relink and reverse
+    steps are executed with the changed subjects bound via VALUES, in batches of SCOPE_BATCH_SIZE subjects.
+    The entities linked to the changed subjects via crmdig:L54_is_same-as are added to the scope, as the
+    relink step replaced their relations with relations of the changed subjects, which can only be
+    restored by materialising the relations of the linked entities again.
     """
-    relinkQuery = generateRelinkQuery(namedGraph=namedGraph)
-    sparql.setQuery(relinkQuery)
-    sparql.setMethod('POST')
-    
-    result = sparql.query()
-    if result.response.status != 200:
-        print("Error: %s" % result.response.read())
+    definitionsFile = options['definitions']
+    endpoint = options['endpoint']
+    namedGraph = options['graph']
+    concurrency = options['concurrency']
+
+    with open(options['changedSubjects'], 'r') as f:
+        subjects = sorted(set(d.strip() for d in f if d.strip()))
+    if not subjects:
+        print("No changed subjects to materialise")
+        os.remove(options['changedSubjects'])
+        return
+
+    with open(definitionsFile, "r") as f:
+        model = yaml.safe_load(f)
+    subclasses = None
+    try:
+        subclasses = loadSubclasses(options)
+        # Validate the definitions before anything is deleted
+        generateRelationQueries(model, namedGraph=namedGraph, subclasses=subclasses)
+    except Exception as e:
+        print("Error: %s" % e)
+        sys.exit(1)
+
+    try:
+        entities = expandSameAsEntities(endpoint, subjects)
+    except Exception as e:
+        print("Error: %s" % e)
+        sys.exit(1)
+
+    batches = [entities[i:i + SCOPE_BATCH_SIZE] for i in range(0, len(entities), SCOPE_BATCH_SIZE)]
+    print("Materialising relations of %d changed subjects (%d including linked entities) in %d batches" % (len(subjects), len(entities), len(batches)))
+
+    report = []
+    startTime = time.time()
+    try:
+        for i, batch in enumerate(batches):
+            suffix = " (batch %d)" % (i + 1) if len(batches) > 1 else ''
+            report.append(executeStep('delete' + suffix, endpoint, generateScopedDeleteQuery(namedGraph, batch)))
+
+            relationQueries = generateRelationQueries(model, namedGraph=namedGraph, subclasses=subclasses, entities=batch)
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [executor.submit(executeStep, relationId + suffix, endpoint, query) for relationId, query in relationQueries]
+                for future in as_completed(futures):
+                    entry = future.result()
+                    print("%-50s %8.1fs %10s triples" % (entry['id'], entry['duration'], entry['inserted'] if entry['inserted'] is not None else '?'))
+                    report.append(entry)
+
+            report.append(executeStep('relink' + suffix, endpoint, generateRelinkQuery(namedGraph=namedGraph, entities=batch)))
+            report.append(executeStep('reverse' + suffix, endpoint, generateReverseQuery(namedGraph=namedGraph, entities=batch)))
+    except Exception as e:
+        print("Error: %s" % e)
+        writeReport(options['report'], report, startTime)
+        sys.exit(1)
+
+    writeReport(options['report'], report, startTime)
+    os.remove(options['changedSubjects'])
+    print(f"Successfully materialised definitions from {definitionsFile} for {len(subjects)} changed subjects to {endpoint} in graph {namedGraph} in {time.time() - startTime:.1f}s")
+
+def performOfflineMaterialisation(options):
+    """
+    Perform the materialisation in-process. The input files are loaded into an in-memory
+    triple store, the relations, relink and reverse steps are evaluated against it in the
+    same order as in the SPARQL endpoint, and the materialised triples are written to a file.
+    """
+    definitionsFile = options['definitions']
+    namedGraph = options['graph'] or LOCAL_GRAPH
+    outputFile = options['outputFile']
+
+    with open(definitionsFile, "r") as f:
+        model = yaml.safe_load(f)
+
+    try:
+        relationQueries = generateRelationSelectQueries(model, subclasses=loadSubclasses(options))
+    except Exception as e:
+        print("Error: %s" % e)
+        sys.exit(1)
+
+    report = []
+    startTime = time.time()
+    store = TripleStore()
+    loadStart = time.time()
+    for graph, pattern in options['inputs']:
+        filenames = sorted(glob(pattern))
+        if not filenames:
+            print("Warning: No files found for %s" % pattern)
+        for filename in filenames:
+            try:
+                count = store.loadFile(filename, graph=graph)
+            except Exception as e:
+                print("Error while loading %s: %s" % (filename, e))
+                sys.exit(1)
+            print("Loaded %d statements from %s" % (count, filename))
+    report.append({"id": "load", "duration": round(time.time() - loadStart, 3), "inserted": store.size})
+    print("Loaded %d triples with %d terms" % (store.size, len(store.terms)))
+
+    graphId = store.encode('<%s>' % namedGraph)
+    store.graphs.pop(graphId, None)
+
+    try:
+        for relationId, query in relationQueries:
+            report.append(timeStep(relationId, lambda: materialiseRelation(store, graphId, query)))
+            entry = report[-1]
+            print("%-50s %8.1fs %10s triples" % (entry['id'], entry['duration'], entry['inserted']))
+        report.append(timeStep('relink', lambda: relinkRelations(store, graphId)))
+        report.append(timeStep('reverse', lambda: reverseRelations(store, graphId)))
+    except NotImplementedError as e:
+        print("Error: %s" % e)
+        writeReport(options['report'], report, startTime)
         sys.exit(1)
 
+    if os.path.dirname(outputFile):
+        os.makedirs(os.path.dirname(outputFile), exist_ok=True)
+    tmpFilename = outputFile + ".tmp"
+    with open(tmpFilename, 'w', encoding='utf-8') as f:
+        store.writeGraph(f, namedGraph, quads=outputFile.endswith('.nq') and namedGraph != LOCAL_GRAPH)
+    os.replace(tmpFilename, outputFile)
+
+    writeReport(options['report'], report, startTime)
+    slowest = sorted(report, key=lambda d: d['duration'], reverse=True)[:5]
+    print("Slowest steps: " + ", ".join("%s (%.1fs)" % (d['id'], d['duration']) for d in slowest))
+    print(f"Successfully materialised {len(store.graphs.get(graphId, ()))} triples from {definitionsFile} to {outputFile}")
+
+def loadSubclasses(options):
+    """
+    Compute the subclass closure of the schema files given in the options.
+    Returns None if no schemas are given, so that the property paths are used.
+    """
+    if not options['schemas']:
+        return None
+    schemaFiles = [filename for pattern in options['schemas'].split(',') for filename in glob(pattern.strip())]
+    if not schemaFiles:
+        raise Exception("No schema files found for %s" % options['schemas'])
+    return computeSubclassClosure(schemaFiles, cacheFile=options['schemaCacheFile'])
+
+def timeStep(stepId, function):
+    """
+    Execute a step of the offline materialisation and measure its duration.
+    :param stepId: The identifier of the step used in the report
+    :param function: Function returning the number of inserted triples
+    :return: A dictionary with the id, duration and number of inserted triples
+    """
+    startTime = time.time()
+    inserted = function()
+    return {
+        "id": stepId,
+        "duration": round(time.time() - startTime, 3),
+        "inserted": inserted
+    }
+
+def insertTriple(store, graphId, triple):
+    """
+    Insert a triple into the named graph of the store.
+    Triples with literals or blank nodes as predicate or literals as subject are skipped, as in a SPARQL INSERT.
+    :return: True if the triple was not yet in the graph
+    """
+    s, p, o = triple
+    if not store.terms[p].startswith('<') or store.terms[s].startswith('"'):
+        return False
+    if store.contains(s, p, o, graphId):
+        return False
+    store.add(s, p, o, graphId)
+    return True
+
+def materialiseRelation(store, graphId, query):
     """
-    Materialise reverse relations
+    Evaluate the SELECT query of a relation and insert the resulting triples.
+    The triples are inserted once the query has been evaluated, like an INSERT ... WHERE.
+    :return: The number of inserted triples
     """
-    reverseQuery = generateReverseQuery(namedGraph=namedGraph)
-    sparql.setQuery(reverseQuery)
+    triples = set()
+    variables = {}
+    for solution in store.selectIds(query):
+        values = {str(k): v for k, v in solution.items()}
+        if 'subject' not in values or 'predicate' not in values or 'object' not in values:
+            continue
+        triples.add((values['subject'], values['predicate'], values['object']))
+        for name, variable in [('subjectType', 'subject'), ('objectType', 'object')]:
+            if name in values:
+                triples.add((values[variable], store.encode(RDF_TYPE), values[name]))
+    return sum(1 for triple in triples if insertTriple(store, graphId, triple))
+
+def relinkRelations(store, graphId):
+    """
+    Relink the materialised relations from e.g. GND entities to the JILA entity that is the same
+    (see generateRelinkQuery), first the objects, then the subjects.
+    :return: The number of inserted triples
+    """
+    sameAs = store.encode(CRMDIG_SAME_AS)
+    inserted = 0
+    for position in [2, 0]:
+        deletes = set()
+        inserts = set()
+        for triple in store.graphs.get(graphId, set()):
+            for jilaEntity, _, _ in store.match(None, sameAs, triple[position]):
+                deletes.add(triple)
+                inserts.add(triple[:position] + (jilaEntity,) + triple[position + 1:])
+        for triple in deletes:
+            store.remove(*triple, graphId)
+        inserted += sum(1 for triple in inserts if insertTriple(store, graphId, triple))
+    return inserted
+
+def reverseRelations(store, graphId):
+    """
+    Materialise the inverse relations and the reverse of symmetric relations (see generateReverseQuery).
+    :return: The number of inserted triples
+    """
+    inverseOf = store.encode(OWL_INVERSE_OF)
+    rdfType = store.encode(RDF_TYPE)
+    symmetricProperty = store.encode(OWL_SYMMETRIC_PROPERTY)
+
+    inserts = set()
+    for s, p, o in store.graphs.get(graphId, set()):
+        for inversePredicate, _, _ in store.match(None, inverseOf, p):
+            inserts.add((o, inversePredicate, s))
+    inserted = sum(1 for triple in inserts if insertTriple(store, graphId, triple))
+
+    inserts = set()
+    for s, p, o in store.graphs.get(graphId, set()):
+        if store.contains(p, rdfType, symmetricProperty):
+            inserts.add((o, p, s))
+    inserted += sum(1 for triple in inserts if insertTriple(store, graphId, triple))
+    return inserted
+
+def executeStep(stepId, endpoint, query):
+    """
+    Execute a SPARQL update and measure its duration.
+    The number of inserted triples is read from the mutation count reported by Blazegraph
+    (for updates that also delete triples, it includes the deleted triples).
+    It is None if the endpoint does not report it.
+    :param stepId: The identifier of the step used in the report
+    :param endpoint: The SPARQL endpoint
+    :param query: The SPARQL update
+    :return: A dictionary with the id, duration and number of inserted triples
+    """
+    sparql = SPARQLWrapper(endpoint)
+    sparql.setQuery(query)
     sparql.setMethod('POST')
-    
-    result = sparql.query()
+
+    startTime = time.time()
+    try:
+        result = sparql.query()
+        body = result.response.read().decode('utf-8', errors='replace')
+    except Exception as e:
+        raise Exception("%s failed: %s" % (stepId, e))
     if result.response.status != 200:
-        print("Error: %s" % result.response.read())
-        sys.exit(1)
+        raise Exception("%s failed: %s" % (stepId, body))
+    duration = time.time() - startTime
+
+    mutationCount = re.search(r'mutationCount=(\d+)', body)
+    return {
+        "id": stepId,
+        "duration": round(duration, 3),
+        "inserted": int(mutationCount.group(1)) if mutationCount else None
+    }
+
+def writeReport(reportFile, report, startTime):
+    """
+    Write the report of the executed steps to a JSON file
+    :param reportFile: The path to the report file (if None, no report is written)
+    :param report: The list of executed steps
+    :param startTime: The time the materialisation started
+    """
+    if not reportFile:
+        return
+    if os.path.dirname(reportFile):
+        os.makedirs(os.path.dirname(reportFile), exist_ok=True)
+    with open(reportFile, 'w') as f:
+        json.dump({
+            "started": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(startTime)),
+            "duration": round(time.time() - startTime, 3),
+            "steps": sorted(report, key=lambda d: d['duration'], reverse=True)
+        }, f, indent=4)
+
+def generateUpdateQuery(model, namedGraph=None, subclasses=None):
+    """
+    Generate a single SPARQL update that drops the named graph (if given)
+    and materialises all relations.
+    """
+    output = generatePrefixes(model)
 
     if namedGraph:
-        print(f"Successfully materialised definitions from {definitionsFile} to {endpoint} in graph {namedGraph}")
-    else:
-        print(f"Successfully materialised definitions from {definitionsFile} to {endpoint}")
+        output += "DROP GRAPH <%s> ;" % namedGraph
 
-def generateUpdateQuery(model, namedGraph=None):
-    output = ''
+    for relationId, query in generateRelationQueries(model, namedGraph=namedGraph, includePrefixes=False, subclasses=subclasses):
+        output += query + ";"
 
+    return output
+
+def generatePrefixes(model):
+    output = ''
     for prefix in model['namespaces'].keys():
         output += "PREFIX %s: <%s>\n" % (prefix, model['namespaces'][prefix])
+    return output
+
+def generateRelationQueries(model, namedGraph=None, includePrefixes=True, subclasses=None, entities=None):
+    """
+    Generate a separate SPARQL update for every relation.
+    If the subclass closure is given (see computeSubclassClosure), the domain and range
+    are checked against the concrete classes instead of through rdfs:subClassOf* paths.
+    If entities are given, only relations with one of them as subject or object are materialised.
+    Returns a list of tuples of the relation id and the update.
+    """
+    prefixes = generatePrefixes(model) if includePrefixes else ''
+    queries = []
 
-    if namedGraph:
-        output += "DROP GRAPH <%s> ;" % namedGraph
-    
     insertClause = """
         ?subject ?predicate ?object .
     """
 
     whereClause = """
-        ?subject a/<http://www.w3.org/2000/01/rdf-schema#subClassOf>* $domain .
-        ?object a/<http://www.w3.org/2000/01/rdf-schema#subClassOf>* $range .
+        $domainConstraint
+        $rangeConstraint
     """
 
     if 'types' in model and len(model['types']) > 0:
@@ -164,9 +507,10 @@ def generateUpdateQuery(model, namedGraph=None):
     if namedGraph:
         templateString += "}"
     templateString += "} WHERE {"
+    templateString += "$scope"
     templateString += whereClause
     templateString += "\n$queryPattern\n"
-    templateString += "};"
+    templateString += "}"
 
     template = Template(templateString)
 
@@ -183,12 +527,198 @@ def generateUpdateQuery(model, namedGraph=None):
         if not '?subject' in queryPattern or not '?predicate' in queryPattern or not '?object' in queryPattern:
             raise Exception(f"The query pattern '{relation['id']}' must contain ?subject, ?predicate and ?object")
 
-        query = template.substitute(domain=relation['domain'], range=relation['range'], queryPattern=queryPattern, graph=namedGraph)
-        output += query
+        query = template.substitute(
+            domainConstraint=generateClassConstraint(model, '?subject', relation['domain'], subclasses),
+            rangeConstraint=generateClassConstraint(model, '?object', relation['range'], subclasses),
+            queryPattern=queryPattern,
+            graph=namedGraph,
+            scope=generateScopeClause(['?subject', '?object'], entities)
+        )
+        queries.append((relation['id'], prefixes + query))
 
-    return output
+    return queries
+
+def generateRelationSelectQueries(model, subclasses=None):
+    """
+    Generate a SELECT query for every relation, used by the offline backend.
+    The query pattern comes first, so that the domain and range are only checked
+    for the entities matching the pattern.
+    Returns a list of tuples of the relation id and the query.
+    """
+    prefixes = generatePrefixes(model)
+    queries = []
+
+    selectClause = "?subject ?predicate ?object"
+    whereClause = """
+        $domainConstraint
+        $rangeConstraint
+    """
+
+    if 'types' in model and len(model['types']) > 0:
+        selectClause += " ?subjectType ?objectType"
+        whereClause += """
+            ?subject a ?subjectType .
+            ?object a ?objectType .
+            VALUES(?subjectType) {""" + " ".join([f"({d})" for d in model['types']]) + """}
+            VALUES(?objectType) {""" + " ".join([f"({d})" for d in model['types']]) + """}
+        """
+
+    template = Template("SELECT " + selectClause + " WHERE {\n$queryPattern\n" + whereClause + "}")
+
+    for relation in model['relations']:
+        if not 'id' in relation or not 'queryPattern' in relation or not 'domain' in relation or not 'range' in relation:
+            raise Exception(f"Relation {relation['id'] if 'id' in relation else ''} is missing required fields")
+
+        queryPattern = relation['queryPattern'].replace('$','?')
+        if not '?subject' in queryPattern or not '?predicate' in queryPattern or not '?object' in queryPattern:
+            raise Exception(f"The query pattern '{relation['id']}' must contain ?subject, ?predicate and ?object")
+
+        query = template.substitute(
+            domainConstraint=generateClassConstraint(model, '?subject', relation['domain'], subclasses),
+            rangeConstraint=generateClassConstraint(model, '?object', relation['range'], subclasses),
+            queryPattern=queryPattern
+        )
+        queries.append((relation['id'], prefixes + query))
+
+    return queries
+
+def generateClassConstraint(model, variable, classRef, subclasses=None):
+    """
+    Generate the pattern that checks that the variable is an instance of the class or one of its subclasses.
+    Without subclass closure, an rdfs:subClassOf* property path is used. Otherwise the
+    class and its subclasses are inlined as VALUES.
+    :param model: The relation definitions (for the namespaces)
+    :param variable: The variable, e.g. ?subject
+    :param classRef: The class as prefixed name or IRI in angle brackets
+    :param subclasses: Dictionary of class IRIs and the list of their (transitive) subclasses (optional)
+    """
+    if subclasses is None:
+        return "%s a/<http://www.w3.org/2000/01/rdf-schema#subClassOf>* %s ." % (variable, classRef)
+
+    classIri = expandClassRef(model, classRef)
+    classes = sorted(set([classIri] + subclasses.get(classIri, [])))
+    classVariable = variable + "Class"
+    return "%s a %s . VALUES (%s) { %s }" % (variable, classVariable, classVariable, " ".join("(<%s>)" % d for d in classes))
+
+def expandClassRef(model, classRef):
+    """
+    Expand a prefixed name using the namespaces of the model
+    """
+    if classRef.startswith('<') and classRef.endswith('>'):
+        return classRef[1:-1]
+    prefix, localName = classRef.split(':', 1)
+    if prefix not in model['namespaces']:
+        raise Exception(f"Unknown prefix in {classRef}")
+    return model['namespaces'][prefix] + localName
+
+def computeSubclassClosure(schemaFiles, *, cacheFile=None):
+    """
+    Compute the transitive rdfs:subClassOf closure of the classes defined in the schema files.
+    The closure is cached in a JSON file, which is reused as long as the schema files are unchanged.
+    :param schemaFiles: List of paths to RDF files (RDF/XML for .rdfs and .rdf files)
+    :param cacheFile: The JSON file in which the closure is cached (optional)
+    :return: Dictionary of class IRIs and the sorted list of their subclasses
+    """
+    files = {}
+    for filename in sorted(schemaFiles):
+        stat = os.stat(filename)
+        files[os.path.abspath(filename)] = [stat.st_mtime_ns, stat.st_size]
+
+    if cacheFile and os.path.isfile(cacheFile):
+        try:
+            with open(cacheFile, 'r') as f:
+                cache = json.load(f)
+            if cache['files'] == files:
+                return cache['subclasses']
+        except Exception:
+            print("Ignoring invalid subclass cache file %s" % cacheFile)
+
+    graph = Graph()
+    for filename in files:
+        graph.parse(filename, format=guess_format(filename, dict(SUFFIX_FORMAT_MAP, rdfs='xml')))
+
+    children = {}
+    for subclass, superclass in graph.subject_objects(RDFS.subClassOf):
+        if isinstance(subclass, URIRef) and isinstance(superclass, URIRef):
+            children.setdefault(str(superclass), set()).add(str(subclass))
+
+    subclasses = {}
+    for superclass in children:
+        descendants = set()
+        queue = [superclass]
+        while queue:
+            for child in children.get(queue.pop(), ()):
+                if child not in descendants:
+                    descendants.add(child)
+                    queue.append(child)
+        descendants.discard(superclass)
+        subclasses[superclass] = sorted(descendants)
+
+    if cacheFile:
+        if os.path.dirname(cacheFile):
+            os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+        tmpFilename = cacheFile + ".tmp"
+        with open(tmpFilename, 'w') as f:
+            json.dump({"files": files, "subclasses": subclasses}, f)
+        os.replace(tmpFilename, cacheFile)
+
+    return subclasses
+
+def generateScopeClause(variables, entities=None):
+    """
+    Generate a group pattern that binds either of the variables to the given entities.
+    Returns an empty string if no entities are given.
+    :param variables: List of variables, e.g. ['?subject', '?object']
+    :param entities: List of IRIs (optional)
+    """
+    if entities is None:
+        return ''
+    values = " ".join("(<%s>)" % d for d in entities)
+    return " UNION ".join("{ VALUES (%s) { %s } }" % (variable, values) for variable in variables)
+
+def expandSameAsEntities(endpoint, entities):
+    """
+    Add the entities linked to the given entities via crmdig:L54_is_same-as, in either direction.
+    :param endpoint: The SPARQL endpoint
+    :param entities: List of IRIs
+    :return: Sorted list of IRIs
+    """
+    expanded = set(entities)
+    for i in range(0, len(entities), SCOPE_BATCH_SIZE):
+        query = Template("""
+            SELECT DISTINCT ?other WHERE {
+                $scope
+                { ?entity $sameAs ?other . } UNION { ?other $sameAs ?entity . }
+                FILTER(isIRI(?other))
+            }
+        """).substitute(scope=generateScopeClause(['?entity'], entities[i:i + SCOPE_BATCH_SIZE]), sameAs=CRMDIG_SAME_AS)
+        sparql = SPARQLWrapper(endpoint)
+        sparql.setQuery(query)
+        sparql.setMethod('POST')
+        sparql.setReturnFormat(JSON)
+        for row in sparql.queryAndConvert()['results']['bindings']:
+            expanded.add(row['other']['value'])
+    return sorted(expanded)
+
+def generateScopedDeleteQuery(namedGraph, entities):
+    """
+    Generate a SPARQL update that deletes the triples of the named graph
+    that have one of the entities as subject or object
+    """
+    return Template("""
+        DELETE {
+            GRAPH <$graph> {
+                ?subject ?predicate ?object .
+            }
+        } WHERE {
+            $scope
+            GRAPH <$graph> {
+                ?subject ?predicate ?object .
+            }
+        }
+    """).substitute(graph=namedGraph, scope=generateScopeClause(['?subject', '?object'], entities))
 
-def generateRelinkQuery(namedGraph=None):
+def generateRelinkQuery(namedGraph=None, entities=None):
     """
     If we have a entity that is present in the JILA graph, we want 
     to relink the relations from e.g. GND entities to the JILA entity.
@@ -224,6 +754,7 @@ def generateRelinkQuery(namedGraph=None):
                     ?subject ?relation ?jilaObject .
                 }
             } WHERE {
+                $objectScope
                 GRAPH <$graph> {
                     ?subject ?relation ?object .
                 }
@@ -239,15 +770,20 @@ def generateRelinkQuery(namedGraph=None):
                     ?jilaSubject ?relation ?object .
                 }
             } WHERE {
+                $subjectScope
                 GRAPH <$graph> {
                     ?subject ?relation ?object .
                 }
                 ?jilaSubject crmdig:L54_is_same-as ?subject .
             }
             """)
-        return queryTemplate.substitute(graph=namedGraph)
+        return queryTemplate.substitute(
+            graph=namedGraph,
+            objectScope=generateScopeClause(['?subject', '?object', '?jilaObject'], entities),
+            subjectScope=generateScopeClause(['?subject', '?object', '?jilaSubject'], entities)
+        )
 
-def generateReverseQuery(namedGraph=None): 
+def generateReverseQuery(namedGraph=None, entities=None):
     if not namedGraph:
         return """
             INSERT {
@@ -270,6 +806,7 @@ def generateReverseQuery(namedGraph=None):
                     ?object ?inversePredicate ?subject .
                 }
             } WHERE {
+                $scope
                 GRAPH <$graph> {
                     ?subject ?predicate ?object .
                 }
@@ -280,13 +817,14 @@ def generateReverseQuery(namedGraph=None):
                     ?object ?predicate ?subject .
                 }
             } WHERE {
+                $scope
                 GRAPH <$graph> {
                     ?subject ?predicate ?object .
                 }
                 ?predicate a owl:SymmetricProperty .
             }
         """)
-        return queryTemplate.substitute(graph=namedGraph)
+        return queryTemplate.substitute(graph=namedGraph, scope=generateScopeClause(['?subject', '?object'], entities))
 
 if __name__ == '__main__':
     options = {}
@@ -303,11 +841,56 @@ if __name__ == '__main__':
         print("Please provide a path to the relation definitions via the --definitions argument")
         sys.exit(1)
 
-    if not "endpoint" in options:
+    if not "schemas" in options:
+        options['schemas'] = None
+
+    if not "schemaCacheFile" in options:
+        options['schemaCacheFile'] = None
+
+    if not "backend" in options:
+        options['backend'] = 'sparql'
+
+    if options['backend'] not in ['sparql', 'offline']:
+        print("Unknown backend %s, use sparql or offline" % options['backend'])
+        sys.exit(1)
+
+    if options['backend'] == 'sparql' and not "endpoint" in options:
         print("Please provide a SPARQL endpoint via the --endpoint argument")
         sys.exit(1)
 
+    if options['backend'] == 'offline':
+        if not "inputs" in options or not "outputFile" in options:
+            print("Please provide the input files via the --inputs argument and the output file via the --outputFile argument")
+            sys.exit(1)
+        inputs = []
+        for entry in options['inputs'].split(','):
+            if '=' in entry and not entry.startswith('/') and not entry.startswith('.'):
+                graph, pattern = entry.rsplit('=', 1)
+            else:
+                graph, pattern = None, entry
+            inputs.append((graph.strip() if graph else None, pattern.strip()))
+        options['inputs'] = inputs
+
     if not "graph" in options:
         options['graph'] = False
 
-    performMaterialisation(options)
\ No newline at end of file
+    options['concurrency'] = int(options['concurrency']) if 'concurrency' in options else 1
+    if not "report" in options:
+        options['report'] = None
+
+    if not "changedSubjects" in options:
+        options['changedSubjects'] = None
+
+    if options['changedSubjects'] and (options['backend'] != 'sparql' or not options['graph']):
+        print("The incremental materialisation requires the sparql backend and a named graph")
+        sys.exit(1)
+
+    if options['backend'] == 'offline':
+        performOfflineMaterialisation(options)
+    elif options['changedSubjects']:
+        if not os.path.isfile(options['changedSubjects']):
+            print("No changed subjects file found at %s, nothing to materialise" % options['changedSubjects'])
+            sys.exit(0)
+        performIncrementalMaterialisation(options)
+    else:
+        performMaterialisation(options)
\ No newline at end of file
@@ -9,6 +9,7 @@ python prepareDataForMapping.py --sourceFolder=<sourceFolder> --oaiXMLFolder=<oa
 Parameters:
     --sourceFolder        The folder containing the source JSON data
     --oaiXMLFolder        The folder containing the XML data retrieved from e-manuscripta
+    --oaiReducedFolder    The folder containing the reduced and compressed XML data retrieved from e-manuscripta. Used instead of the full records where available (optional)
     --manifestsFolder     The folder containing the cached IIIF manifests
     --outputFolder        The folder to write the output XML files to
     --limit               Limit the number of records to process
@@ -18,6 +19,8 @@ Parameters:
     --vlidMapFile         The path to the file containing the mapping between VLIDs and DOIs (optional)
     --onlyWithDoi         If set to true, only records that contain a DOI are output (optional)
     --logFile             The path to a log file (optional)
+    --identifiersFile     The path to a JSON file to which the external identifiers (AAT, GND, LOC, Wikidata) contained in the records are written (optional)
+    --mappingFile         The path to the X3ML mapping, used to determine from which nodes external URIs are generated and to include identifiers that are set as constants in the mapping in the identifiers file (optional)
 """
 
 import csv
@@ -34,7 +37,7 @@ from os.path import join, isfile
 from tqdm import tqdm
 
 from edtf import parse_edtf
-from lib.utils import readRecords, RetrieveVLIDfromDOI
+from lib.utils import readRecords, readOaiRecord, reduceOaiRecord, RetrieveVLIDfromDOI
 from lib.parser import Parser
 from sariDateParser.dateParser import parse
 
@@ -70,7 +73,7 @@ def prepareData(options):
         records = [d for d in records if d['GUID'] in idsToOutput]
 
     # Retrieve OAI records for records that have VLIDs
-    oaiXmlData = retrieveOaiXMLData(records=records, oaiXMLFolder=oaiXMLFolder, vlidMapFile=vlidMapFile)
+    oaiXmlData = retrieveOaiXMLData(records=records, oaiXMLFolder=oaiXMLFolder, vlidMapFile=vlidMapFile, oaiReducedFolder=options['oaiReducedFolder'] if 'oaiReducedFolder' in options else None)
 
     # Add alignment data
     records = addAlignmentData(records, sourceFolder=sourceFolder, alignmentDataPrefix=alignmentDataPrefix, fieldsToAlign=FIELDS_TO_ALIGN)
@@ -109,6 +112,11 @@ def prepareData(options):
     # Add IIIF image data
     recordsXML = addImageDataFromManifests(recordsXML, manifestsFolder)
 
+    # Extract external identifiers so that additional data can be retrieved while the mapping is performed
+    if 'identifiersFile' in options:
+        identifiers = extractIdentifiers(recordsXML, mappingFile=options['mappingFile'] if 'mappingFile' in options else None)
+        writeIdentifiersToFile(identifiers, options['identifiersFile'])
+
     # Write to files
     writeXMLRecordsToFiles(recordsXML, outputFolder)
 
@@ -298,39 +306,19 @@ def addImageDataFromManifests(records, manifestsFolder):
 def addOaiXMLData(records, oaiData):
     """
     Add the XML data retrieved from e-manuscripta via OAI to the records.
-    All nodes are added to a new node called "oai". Some tags that are not
-    used in the mapping are removed.
+    All nodes are added to a new node called "oai". The records are expected to be
+    reduced to the parts used in the mapping (see retrieveOaiXMLData).
 
     :param records: list of CMI records
     :param oaiData: dictonary of XML data, where the key is the GUID of the record
     :return: list of CMI records with added XML data
     """
 
-    def prepareForMerge(node):
-        # Remove some nodes that will not be used in the apping
-        pathsToRemove = [
-            ".//{http://www.loc.gov/METS/}metsHdr",
-            ".//{http://www.loc.gov/METS/}fileSec",
-            ".//{http://www.loc.gov/METS/}structMap",
-            ".//{http://www.loc.gov/METS/}structLink"
-        ]
-        nodesToRemove = [item for sublist in [node.findall(d) for d in pathsToRemove] for item in sublist]
-        
-        for unneeded in nodesToRemove:
-            unneeded.getparent().remove(unneeded)
-        
-        # Remove namespaces
-        for elem in node.getiterator():
-            elem.tag = etree.QName(elem).localname
-
-        return node
-
     for record in records:
         guid = record.find('guid').text
         if guid in oaiData:
             oaiNode = etree.SubElement(record, 'oai')
-            oaiRecord = prepareForMerge(oaiData[guid])
-            for child in oaiRecord.getroot():
+            for child in oaiData[guid].getroot():
                 oaiNode.append(child)
     return records
 
@@ -484,6 +472,157 @@ def convertRecordsToXML(records, *, removeEmptyNodes=True, flattenLists=False):
         xmlRecords.append(convertCmiJSONtoXML(record))
     return xmlRecords
 
+def extractIdentifiers(records, *, mappingFile=None):
+    """
+    Extract the identifiers of external sources that are referenced in the XML records, so that the
+    corresponding data can be retrieved before the mapping has been performed.
+    If a mapping file is provided, the identifiers are taken from the paths the X3ML mapping generates
+    external URIs from (see getMappedIdentifierPaths), including the identifiers that are set as constants.
+    Otherwise, the identifiers are taken from the nodes that are usually mapped to external URIs:
+    - gnd, register_gnd-id: GND identifiers (including aligned values)
+    - aat: AAT identifiers (aligned values)
+    - wikidata_id: Wikidata identifiers
+    - register_rolle/@code: LOC relator codes
+    - nodes with a source and value child, as produced by parseIdentifiers and by parsing the internal remarks
+
+    :param records: list of XML records
+    :param mappingFile: path to the X3ML mapping (optional)
+    :return: dictionary with the sources as keys and a sorted list of identifier URIs as values
+    """
+    namespaces = {
+        "aat": "http://vocab.getty.edu/aat/",
+        "gnd": "https://d-nb.info/gnd/",
+        "loc": "http://id.loc.gov/vocabulary/relators/",
+        "wd": "http://www.wikidata.org/entity/"
+    }
+    tagsWithIdentifiers = {
+        "gnd": "gnd",
+        "register_gnd-id": "gnd",
+        "aat": "aat",
+        "wikidata_id": "wd"
+    }
+    parsedSources = {
+        "AAT": "aat",
+        "GND": "gnd",
+        "WD": "wd"
+    }
+
+    identifiers = {source: set() for source in namespaces.keys()}
+
+    def addIdentifier(source, value):
+        if value is not None and value.strip() and value.strip() != 'null':
+            identifiers[source].add(namespaces[source] + value.strip())
+
+    if mappingFile:
+        paths, constants = getMappedIdentifierPaths(mappingFile)
+        for source, value in constants:
+            addIdentifier(source, value)
+        for record in records:
+            for source, path in paths:
+                for value in record.xpath(path):
+                    addIdentifier(source, value if isinstance(value, str) else value.text)
+    else:
+        for record in records:
+            for tag, source in tagsWithIdentifiers.items():
+                for node in record.iter(tag):
+                    addIdentifier(source, node.text)
+            for node in record.iter('register_rolle'):
+                addIdentifier('loc', node.get('code'))
+            for node in record.iter():
+                sourceNode = node.find('source')
+                valueNode = node.find('value')
+                if sourceNode is not None and valueNode is not None and sourceNode.text in parsedSources:
+                    addIdentifier(parsedSources[sourceNode.text], valueNode.text)
+
+    return {source: sorted(values) for source, values in identifiers.items()}
+
+def getMappedIdentifierPaths(mappingFile):
+    """
+    Collect the paths from which the X3ML mapping generates the URIs of external sources, i.e. the
+    xpath arguments of the URIwithAatId, URIwithGndId, URIwithLocId and URIwithWikidataId generators.
+    As in X3ML, the arguments are evaluated relative to the nodes reached through the source relation of the link
+    (or the source node of the domain) the generator belongs to, which is in turn relative to the source node of the domain.
+    The conditions of the domain, the link and the entities are added as predicates to the source nodes.
+    The paths are returned relative to the record node.
+
+    :param mappingFile: path to the X3ML mapping
+    :return: list of tuples of the source and the path, and list of tuples of the source and the identifiers set as constants
+    """
+    generators = {
+        "URIwithAatId": "aat",
+        "URIwithGndId": "gnd",
+        "URIwithLocId": "loc",
+        "URIwithWikidataId": "wd"
+    }
+    recordPath = '/collection/record'
+
+    def joinPaths(*paths):
+        return '/'.join(d for d in paths if d and d != '.') or '.'
+
+    def quote(value):
+        return "'%s'" % value if '"' in value else '"%s"' % value
+
+    def conditionToXPath(condition):
+        # Conditions that cannot be expressed in XPath (e.g. narrower) are considered to be met
+        operands = [conditionToXPath(d) for d in condition if isinstance(d.tag, str)]
+        if condition.tag == 'if':
+            return operands[0] if operands else 'true()'
+        if condition.tag == 'equals':
+            return '%s = %s' % (condition.text.strip(), quote(condition.get('value', '')))
+        if condition.tag == 'exists':
+            return 'boolean(%s)' % condition.text.strip()
+        if condition.tag == 'not':
+            return 'not(%s)' % ' and '.join(operands)
+        if condition.tag in ['and', 'or']:
+            return '(%s)' % (' %s ' % condition.tag).join(operands)
+        return 'true()'
+
+    def addConditions(path, conditions):
+        if not conditions:
+            return path
+        return joinPaths(path, 'self::node()[%s]' % ' and '.join(conditionToXPath(d) for d in conditions))
+
+    def getConditions(element, stop):
+        conditions = []
+        for ancestor in element.iterancestors():
+            if ancestor is stop:
+                break
+            conditions += ancestor.findall('if')
+        return conditions
+
+    paths = []
+    constants = []
+
+    def addGenerators(element, context, conditions):
+        for generator in element.iter('instance_generator'):
+            if generator.get('name') not in generators:
+                continue
+            source = generators[generator.get('name')]
+            generatorConditions = list(dict.fromkeys(conditions + getConditions(generator, element)))
+            for arg in generator.findall('arg'):
+                if arg.text is None:
+                    continue
+                if arg.get('type') == 'constant' or (arg.get('type') == 'xpath' and arg.text.strip().isdigit()):
+                    constants.append((source, arg.text))
+                elif arg.get('type') == 'xpath':
+                    paths.append((source, joinPaths(addConditions(context, generatorConditions), arg.text.strip())))
+
+    mapping = etree.parse(mappingFile)
+    for mappingNode in mapping.iter('mapping'):
+        domain = mappingNode.find('domain')
+        domainPath = domain.findtext('source_node', '').strip()
+        if domainPath == recordPath or domainPath.startswith(recordPath + '/'):
+            domainPath = domainPath[len(recordPath) + 1:]
+        domainConditions = domain.findall('target_node/if')
+        addGenerators(domain, domainPath, [])
+        domainPath = addConditions(domainPath, domainConditions)
+        for link in mappingNode.findall('link'):
+            # The source nodes of the range are reached through the source relation, the source node of the range is not evaluated
+            relation = joinPaths(*[d.text.strip() for d in link.findall('path/source_relation/*') if d.text])
+            addGenerators(link, joinPaths(domainPath, relation), link.findall('path/target_relation/if'))
+
+    return list(dict.fromkeys(paths)), list(dict.fromkeys(constants))
+
 def parseDates(records):
     """
     Parse dates in XML records and add them in machine readable format as attributes.
@@ -690,29 +829,46 @@ def removeNullValues(records):
             node.text = None
     return records
 
-def retrieveOaiXMLData(*, records, oaiXMLFolder, vlidMapFile):
+def retrieveOaiXMLData(*, records, oaiXMLFolder, vlidMapFile, oaiReducedFolder=None):
     """
     Retrieve the XML data from e-manuscripta via OAI.
+    If a folder with reduced records is given, the reduced record is read where available.
+    Full records are reduced to the parts used in the mapping when they are read (see reduceOaiRecord).
 
     :param records: list of CMI records
     :param oaiXMLFolder: folder containing the XML data retrieved from e-manuscripta
     :param vlidMapFile: path to the file containing the mapping between VLIDs and DOIs
+    :param oaiReducedFolder: folder containing the reduced and compressed XML data (optional)
     :return: dictonary of XML data, where the key is the GUID of the record
     """
     oaiXmlData = {}
 
     # Retrieve VLIDs for records that have DOIs    
     vlidRetriever = RetrieveVLIDfromDOI(vlidMapFile=vlidMapFile)
+    vlidRetriever.resolveDois([d['doi'] for d in records if 'doi' in d])
 
     for record in tqdm([d for d in records if 'doi' in d]):
         vlid = vlidRetriever.getVlidForDoi(record['doi'])
         if vlid is not None:
             filename = join(oaiXMLFolder, vlid + ".xml")
-            if isfile(filename):
-                oaiXmlData[record['GUID']] = etree.parse(filename)
+            if oaiReducedFolder and isfile(join(oaiReducedFolder, vlid + ".xml.gz")):
+                oaiXmlData[record['GUID']] = readOaiRecord(join(oaiReducedFolder, vlid + ".xml.gz"))
+            elif isfile(filename):
+                oaiXmlData[record['GUID']] = reduceOaiRecord(etree.parse(filename))
     
     return oaiXmlData
 
+def writeIdentifiersToFile(identifiers, identifiersFile):
+    """
+    Write the extracted identifiers to a JSON file.
+
+    :param identifiers: dictionary with the sources as keys and a list of identifiers as values
+    :param identifiersFile: path to the JSON file
+    """
+    with open(identifiersFile, 'w') as f:
+        json.dump(identifiers, f, indent=2)
+    print("Extracted %s" % ", ".join(["%d %s identifiers" % (len(v), k.upper()) for k, v in identifiers.items()]))
+
 def writeXMLRecordsToFiles(records, outputFolder):
     """
     Write CMI records to XML files.
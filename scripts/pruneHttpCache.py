@@ -0,0 +1,54 @@
+"""
+Script to prune the shared HTTP cache of the external sources.
+Removes cached responses that have not been checked within the given number of days and, if the cache
+exceeds the given size, the least recently checked responses until it fits. Stored response bodies that
+are no longer referenced by any cached response are deleted.
+
+Usage:
+python pruneHttpCache.py --maxAgeDays <maxAgeDays> --maxSizeMB <maxSizeMB>
+
+cacheFolder: The folder where the cache is stored (optional, default: the HTTP_CACHE_FOLDER environment variable or /data/cache/http).
+maxAgeDays: The number of days after which responses that have not been checked are removed (optional).
+maxSizeMB: The maximum size of the cached responses in megabytes (optional).
+"""
+
+import os
+import sys
+
+from lib.cache import HttpCache, DAY
+
+def pruneHttpCache(*, cacheFolder, maxAgeDays=None, maxSizeMB=None):
+    """
+    Prune the HTTP cache in the given folder and print a summary.
+
+    :param cacheFolder: The folder where the cache is stored
+    :param maxAgeDays: Optional number of days after which responses that have not been checked are removed
+    :param maxSizeMB: Optional maximum size of the cached responses in megabytes
+    """
+    cache = HttpCache(cacheFolder=cacheFolder)
+    result = cache.prune(maxAge=maxAgeDays * DAY if maxAgeDays is not None else None,
+                         maxSize=maxSizeMB * 1024 * 1024 if maxSizeMB is not None else None)
+    print("Removed %d cached responses and %d stored objects, freed %.1f MB" % (result['removedEntries'], result['removedObjects'], result['freedBytes'] / 1024 / 1024))
+
+if __name__ == "__main__":
+    options = {}
+
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            if not sys.argv[i + 2].startswith("--"):
+                options[arg[2:]] = sys.argv[i + 2]
+            else:
+                print("Malformed arguments")
+                sys.exit(1)
+
+    if not 'cacheFolder' in options:
+        options['cacheFolder'] = os.environ.get('HTTP_CACHE_FOLDER', '/data/cache/http')
+
+    try:
+        maxAgeDays = float(options['maxAgeDays']) if options.get('maxAgeDays') else None
+        maxSizeMB = float(options['maxSizeMB']) if options.get('maxSizeMB') else None
+    except ValueError:
+        print("The --maxAgeDays and --maxSizeMB options must be numbers")
+        sys.exit(1)
+
+    pruneHttpCache(cacheFolder=options['cacheFolder'], maxAgeDays=maxAgeDays, maxSizeMB=maxSizeMB)
@@ -1,5 +1,7 @@
 """
 Script to retrieve additional data based on identifiers found in the Turtle files in the given folder.
+Alternatively, the identifiers can be read from a JSON file written by prepareDataForMapping.py, which
+allows the additional data to be retrieved while the mapping is still being performed.
 The sources that are queried and retrieved are specified in the sources parameter.
 Currently, the following sources are supported:
 - aat: Getty AAT
@@ -9,23 +11,36 @@ Currently, the following sources are supported:
 
 Usage:
 python retrieveAdditionalData.py --sourceFolder <sourceFolder> --targetFolder <targetFolder> --sources <sources>
+python retrieveAdditionalData.py --identifiersFile <identifiersFile> --targetFolder <targetFolder> --sources <sources>
 
 sourceFolder: The folder where the Turtle files are stored.
+identifiersFile: A JSON file containing the identifiers per source. If given together with sourceFolder, the identifiers
+    found in the Turtle files are reconciled against the file and identifiers that are missing from it are reported.
 targetFolder: The folder where the retrieved data will be stored.
 sources: The sources to retrieve.
+gndBulk: Whether to resolve GND identifiers in batches through the LOBID search API (optional, default: true).
+aatSnapshot: Path or URL of a bulk dump of AAT, or "sparql" to retrieve the concepts in batches from the Getty SPARQL endpoint (optional).
+locSnapshot: Path or URL of a bulk dump of the LOC relators vocabulary (optional).
 """
 
+import gzip
 import json
-import requests
+import shutil
 import sys
+import uuid
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from rdflib import Graph
-from urllib import request
+from rdflib.util import guess_format
 from os import path, walk
-from SPARQLWrapper import SPARQLWrapper, N3
-from time import sleep
+from time import sleep, time
 from tqdm import tqdm
 
+from lib.cache import getHttpCache, CacheMissError
+
 PREFIXES = """
     PREFIX gvp:  <http://vocab.getty.edu/ontology#>
     PREFIX gndo:  <https://d-nb.info/standards/elementset/gnd#>
@@ -42,27 +57,34 @@ def retrieveData(options):
             print("Error:", status['message'])
             sys.exit(1)
 
-    sourceFolder = options['sourceFolder']
+    sourceFolder = options['sourceFolder'] if 'sourceFolder' in options else None
+    identifiersFile = options['identifiersFile'] if 'identifiersFile' in options else None
     targetFolder = options['targetFolder']
     sources = options['sources']
 
-    # Extract identifiers for the specified sources from Turtle files
-    sourceIdentifiers = extractIdentifiers(sourceFolder, sources)
+    if sourceFolder:
+        # Extract identifiers for the specified sources from Turtle files
+        sourceIdentifiers = extractIdentifiers(sourceFolder, sources)
+        if identifiersFile and path.isfile(identifiersFile):
+            reconcileIdentifiers(sourceIdentifiers, readIdentifiersFile(identifiersFile, sources))
+    else:
+        # Read identifiers that have been extracted prior to the mapping
+        sourceIdentifiers = readIdentifiersFile(identifiersFile, sources)
 
     # Check if the requested identifiers are present and if yes, retrieve them
     if 'aat' in sourceIdentifiers and len(sourceIdentifiers['aat']) > 0:
         print("Retrieving AAT data")
-        status = retrieveAatData(sourceIdentifiers['aat'], targetFolder)
+        status = retrieveAatData(sourceIdentifiers['aat'], targetFolder, snapshot=options.get('aatSnapshot'))
         printStatus(status)
 
     if 'loc' in sourceIdentifiers and len(sourceIdentifiers['loc']) > 0:
         print("Retrieving LOC data")
-        status = retrieveLocData(sourceIdentifiers['loc'], targetFolder)
+        status = retrieveLocData(sourceIdentifiers['loc'], targetFolder, snapshot=options.get('locSnapshot'))
         printStatus(status)
 
     if 'gnd' in sourceIdentifiers and len(sourceIdentifiers['gnd']) > 0:
         print("Retrieving GND data")
-        status = retrieveGndData(sourceIdentifiers['gnd'], targetFolder)
+        status = retrieveGndData(sourceIdentifiers['gnd'], targetFolder, bulk=options['gndBulk'])
         printStatus(status)
 
     if 'wd' in sourceIdentifiers and len(sourceIdentifiers['wd']) > 0:
@@ -108,6 +130,36 @@ def extractIdentifiers(folder, sources):
     
     return identifiers
     
+def readIdentifiersFile(identifiersFile, sources):
+    """
+    Reads the identifiers for the given sources from a JSON file as written by prepareDataForMapping.py.
+
+    :param identifiersFile: The JSON file containing a list of identifiers per source.
+    :param sources: The kind of identifiers that are read given as a list of strings.
+    :return: A dictionary with the sources as keys and the list of distinct identifiers as value.
+    """
+    with open(identifiersFile, 'r') as f:
+        data = json.load(f)
+    return {source: data[source] if source in data else [] for source in sources}
+
+def reconcileIdentifiers(mappedIdentifiers, extractedIdentifiers):
+    """
+    Compares the identifiers found in the mapped data with the identifiers extracted prior to the mapping
+    and prints the differences. Identifiers that are only present in the mapped data have not been retrieved
+    by an earlier run based on the extracted identifiers and will be retrieved now.
+
+    :param mappedIdentifiers: The identifiers found in the mapped data, per source.
+    :param extractedIdentifiers: The identifiers extracted prior to the mapping, per source.
+    """
+    for source in mappedIdentifiers.keys():
+        mapped = set(mappedIdentifiers[source])
+        extracted = set(extractedIdentifiers.get(source, []))
+        missing = mapped - extracted
+        unused = extracted - mapped
+        print("%s: %d identifiers in mapped data, %d extracted prior to mapping, %d missing from extraction, %d not used in mapped data" % (source.upper(), len(mapped), len(extracted), len(missing), len(unused)))
+        for identifier in sorted(missing)[:10]:
+            print("    missing:", identifier)
+
 def queryIdentifiersInFile(sourceFile, queryPart):
     """
     Queries the given file for identifiers and returns a list of the identifiers found.
@@ -126,173 +178,511 @@ def queryIdentifiersInFile(sourceFile, queryPart):
             identifiers.append(str(row[0]))
     return identifiers
 
-def retrieveAatData(identifiers, targetFolder):
+def retrieveAatData(identifiers, targetFolder, *, snapshot=None, batchSize=200):
     """
     Retrieves the data for the given identifiers and writes it to a file named aat.ttl in the target folder.
     Only the data for the identifiers that are not already in the file is retrieved.
     The data is retrieved from the Getty AAT.
+
+    If a snapshot is given, the concept descriptions are extracted from it instead of being requested
+    individually. The snapshot can either be a path or URL of a bulk dump, or "sparql", in which case
+    the descriptions of all identifiers are retrieved in batches through a CONSTRUCT query from the
+    Getty SPARQL endpoint. Identifiers that are not contained in the snapshot are retrieved individually.
     :param identifiers: The list of identifiers to retrieve.
     :param targetFolder: The folder where the data is stored.
+    :param snapshot: Path or URL of a bulk dump, or "sparql" (optional).
+    :param batchSize: The number of identifiers per CONSTRUCT query if the snapshot is retrieved via SPARQL.
     :return: A dictionary with the status and a message.
     """
     # Read the output file and query for existing URIs
     targetFile = path.join(targetFolder, 'aat.ttl')
-    existingIdentifiers = queryIdentifiersInFile(targetFile, "?identifier a gvp:Concept .")
+    existingIdentifiers = set(queryIdentifiersInFile(targetFile, "?identifier a gvp:Concept ."))
     # Filter out existing identifiers
     identifiersToRetrieve = [d for d in identifiers if d not in existingIdentifiers]
-    # Retrieve ttl data from GND and append to ttl file
+    cache = getHttpCache()
+    # Retrieve ttl data from AAT and append to ttl file
     with open(targetFile, 'a') as outputFile:
-        for identifier in tqdm(identifiersToRetrieve):
+        missing = identifiersToRetrieve
+        if snapshot and len(identifiersToRetrieve):
+            if snapshot == 'sparql':
+                snapshotIndex = indexNTriples(retrieveAatSnapshotLines(identifiersToRetrieve, batchSize=batchSize))
+            else:
+                snapshotIndex = indexNTriples(readSnapshotLines(snapshot))
+            # The preferred GVP terms are included, as they are when the concepts are retrieved individually
+            found = writeFromSnapshot(snapshotIndex, identifiersToRetrieve, outputFile, followPredicates=['<http://vocab.getty.edu/ontology#prefLabelGVP>'])
+            missing = [d for d in identifiersToRetrieve if d not in found]
+            print("Extracted %d AAT identifiers from snapshot, retrieving %d individually" % (len(found), len(missing)))
+        for identifier in tqdm(missing):
             url = "%s.ttl" % identifier
             try:
-                firstRequest = requests.get(url)
-                # Follow redirect
-                if firstRequest.status_code == 200:
-                    outputFile.write(firstRequest.text + "\n")
-                elif firstRequest.status_code == 301:
-                    url = firstRequest.headers['location']
-                    secondRequest = requests.get(url)
-                    outputFile.write(secondRequest.text + "\n")
+                # Redirects are followed by the cache
+                response = cache.get(url)
+                if response.status_code == 200:
+                    outputFile.write(response.text + "\n")
+                else:
+                    print("Could not retrieve", url, response.status_code)
             except:
                 print("Could not retrieve", url)
 
-        outputFile.close()
     return {
         "status": "success",
         "message": "Retrieved %d additional AAT identifiers (%d present in total)" % (len(identifiersToRetrieve), len(identifiers))
     }
 
-def retrieveGndData(identifiers, targetFolder):
+def retrieveAatSnapshotLines(identifiers, *, batchSize=200):
+    """
+    Retrieves the descriptions of the given AAT concepts in batches from the Getty SPARQL endpoint.
+    The descriptions contain the statements about the concepts as well as their preferred GVP terms.
+    Yields the results as N-Triples lines.
+
+    :param identifiers: The list of identifiers to retrieve.
+    :param batchSize: The number of identifiers per CONSTRUCT query.
+    """
+    gettyEndpoint = "http://vocab.getty.edu/sparql"
+    queryTemplate = """
+        PREFIX gvp: <http://vocab.getty.edu/ontology#>
+        PREFIX xl: <http://www.w3.org/2008/05/skos-xl#>
+        CONSTRUCT {
+            ?concept ?p ?o .
+            ?term xl:literalForm ?literalForm .
+        } WHERE {
+            VALUES ?concept { %s }
+            {
+                ?concept ?p ?o .
+            } UNION {
+                ?concept gvp:prefLabelGVP ?term .
+                ?term xl:literalForm ?literalForm .
+            }
+        }
+    """
+    cache = getHttpCache()
+    for pos in tqdm(range(0, len(identifiers), batchSize)):
+        batch = identifiers[pos:pos + batchSize]
+        query = queryTemplate % " ".join(["<%s>" % d for d in batch])
+        try:
+            response = cache.get(gettyEndpoint, params={"query": query}, headers={"Accept": "application/n-triples"})
+        except Exception as e:
+            print("Could not retrieve batch from Getty SPARQL endpoint", e)
+            continue
+        if response.status_code != 200:
+            print("Could not retrieve batch from Getty SPARQL endpoint", response.status_code)
+            continue
+        for line in response.text.splitlines():
+            yield line
+
+def retrieveGndData(identifiers, targetFolder, *, bulk=True, batchSize=100):
     """
     Retrieves the data for the given identifiers and writes it to a file named gnd.ttl in the target folder.
     Only the data for the identifiers that are not already in the file is retrieved.
     The data is retrieved from the LOBID API.
+
+    In bulk mode, the identifiers are resolved in batches through the search API of LOBID using an
+    OR query over gndIdentifier. The results are returned as JSON Lines (one JSON-LD document per entity)
+    and converted to N-Triples per entity. Identifiers that are not found through the search API are
+    retrieved individually.
     :param identifiers: The list of identifiers to retrieve.
     :param targetFolder: The folder where the data is stored.
+    :param bulk: Whether to use the search API to retrieve the identifiers in batches.
+    :param batchSize: The number of identifiers per search request.
     :return: A dictionary with the status and a message.
     """
+
+    def retrieveSingle(identifier):
+        url = "%s.ttl" % identifier.replace("https://d-nb.info/gnd/","https://lobid.org/gnd/")
+        try:
+            response = cache.get(url)
+            if response.status_code != 200:
+                print("Could not retrieve", url, response.status_code)
+                return False
+            outputFile.write(response.text + "\n")
+            outputFile.flush()
+            return True
+        except:
+            print("Could not retrieve", url)
+            return False
+
+    def retrieveBatch(batch, context):
+        """
+        Resolve a batch of identifiers through the LOBID search API.
+        Returns the set of identifiers that were found.
+        """
+        gndIds = [d.replace("https://d-nb.info/gnd/", "") for d in batch]
+        query = "gndIdentifier:(%s)" % " OR ".join(['"%s"' % d for d in gndIds])
+        try:
+            response = cache.get("https://lobid.org/gnd/search", params={"q": query, "format": "jsonl", "size": len(batch)})
+        except Exception as e:
+            print("Could not retrieve batch from LOBID", e)
+            return set()
+        if response.status_code != 200:
+            print("Could not retrieve batch from LOBID", response.status_code)
+            return set()
+        found = set()
+        for line in response.text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                entity = json.loads(line)
+                entity['@context'] = context
+                entityGraph = Graph()
+                entityGraph.parse(data=json.dumps(entity), format='json-ld', publicID="https://lobid.org/gnd/")
+            except Exception as e:
+                print("Could not parse LOBID result", e)
+                continue
+            outputFile.write(entityGraph.serialize(format='nt') + "\n")
+            found.add(entity.get('id'))
+        outputFile.flush()
+        return found
+
     # Read the output file and query for existing URIs
     targetFile = path.join(targetFolder, 'gnd.ttl')
-    existingIdentifiers = queryIdentifiersInFile(targetFile, "?identifier a gndo:AuthorityResource .")
+    existingIdentifiers = set(queryIdentifiersInFile(targetFile, "?identifier a gndo:AuthorityResource ."))
     # Filter out existing identifiers
     identifiersToRetrieve = [d for d in identifiers if d not in existingIdentifiers]
-    # Retrieve ttl data from GND and append to ttl file
+    cache = getHttpCache()
+    numRequests = 0
+    numFailed = 0
+    # Retrieve data from GND and append to ttl file
     with open(targetFile, 'a') as outputFile:
-        for identifier in tqdm(identifiersToRetrieve):
-            url = "%s.ttl" % identifier.replace("https://d-nb.info/gnd/","https://lobid.org/gnd/")
+        missing = identifiersToRetrieve
+        if bulk and len(identifiersToRetrieve):
             try:
-                with request.urlopen(url) as r:
-                    content = r.read().decode()
-                outputFile.write(content + "\n")
-                outputFile.flush()
-            except:
-                print("Could not retrieve", url)
+                context = cache.get("https://lobid.org/gnd/context.jsonld").json()['@context']
+            except Exception as e:
+                print("Could not retrieve LOBID JSON-LD context, falling back to single requests", e)
+                context = None
+            if context:
+                missing = []
+                for pos in tqdm(range(0, len(identifiersToRetrieve), batchSize)):
+                    batch = identifiersToRetrieve[pos:pos + batchSize]
+                    found = retrieveBatch(batch, context)
+                    numRequests += 1
+                    missing += [d for d in batch if d not in found]
+                if len(missing):
+                    print("Retrieving %d GND identifiers not found in bulk individually" % len(missing))
+        for identifier in tqdm(missing):
+            numRequests += 1
+            if not retrieveSingle(identifier):
+                numFailed += 1
     return {
         "status": "success",
-        "message": "Retrieved %d additional GND identifiers (%d present in total)" % (len(identifiersToRetrieve), len(identifiers))
+        "message": "Retrieved %d additional GND identifiers in %d requests (%d present in total, %d failed)" % (len(identifiersToRetrieve) - numFailed, numRequests, len(identifiers), numFailed)
     }
 
-def retrieveLocData(identifiers, targetFolder):
+def retrieveLocData(identifiers, targetFolder, *, snapshot=None):
     """
     Retrieves the data for the given identifiers and writes it to a file named loc.ttl in the target folder.
     Only the data for the identifiers that are not already in the file is retrieved.
     The data is retrieved from the Library of Congress API.
+
+    If a snapshot is given (path or URL of a bulk dump of the relators vocabulary), the descriptions are
+    extracted from it instead. Identifiers that are not contained in the snapshot are retrieved individually.
     :param identifiers: The list of identifiers to retrieve.
     :param targetFolder: The folder where the data is stored.
+    :param snapshot: Path or URL of a bulk dump (optional).
     :return: A dictionary with the status and a message.
     """
     # Read the output file and query for existing URIs
     targetFile = path.join(targetFolder, 'loc.ttl')
-    existingIdentifiers = queryIdentifiersInFile(targetFile, "?identifier a <http://www.loc.gov/mads/rdf/v1#Authority> .")
+    existingIdentifiers = set(queryIdentifiersInFile(targetFile, "?identifier a <http://www.loc.gov/mads/rdf/v1#Authority> ."))
     # Filter out existing identifiers
     identifiersToRetrieve = [d for d in identifiers if d not in existingIdentifiers]
-    # Retrieve ttl data from GND and append to ttl file
+    cache = getHttpCache()
+    # Retrieve ttl data from LOC and append to ttl file
     with open(targetFile, 'a') as outputFile:
-        for identifier in tqdm(identifiersToRetrieve):
+        missing = identifiersToRetrieve
+        if snapshot and len(identifiersToRetrieve):
+            found = writeFromSnapshot(indexNTriples(readSnapshotLines(snapshot)), identifiersToRetrieve, outputFile)
+            missing = [d for d in identifiersToRetrieve if d not in found]
+            print("Extracted %d LOC identifiers from snapshot, retrieving %d individually" % (len(found), len(missing)))
+        for identifier in tqdm(missing):
             url = "%s.nt" % identifier
             try:
-                firstRequest = requests.get(url)
-                # Follow redirect
-                if firstRequest.status_code == 200:
-                    outputFile.write(firstRequest.text + "\n")
-                elif firstRequest.status_code == 301:
-                    url = firstRequest.headers['location']
-                    secondRequest = requests.get(url)
-                    outputFile.write(secondRequest.text + "\n")
+                # Redirects are followed by the cache
+                response = cache.get(url)
+                if response.status_code == 200:
+                    outputFile.write(response.text + "\n")
+                else:
+                    print("Could not retrieve", url, response.status_code)
             except:
                 print("Could not retrieve", url)
 
-        outputFile.close()
     return {
         "status": "success",
         "message": "Retrieved %d additional LOC identifiers (%d present in total)" % (len(identifiersToRetrieve), len(identifiers))
     }
 
-def retrieveWdData(identifiers, targetFolder):
+def retrieveWdData(identifiers, targetFolder, *, maxInFlight=2, initialBatchSize=50, minBatchSize=1, maxBatchSize=200, targetResponseTime=10, maxThrottleRetries=5):
     """
     Retrieves the data for the given identifiers and writes it to a file named wd.ttl in the target folder.
     Only the data for the identifiers that are not already in the file is retrieved.
     The data is retrieved from the Wikidata SPARQL Endpoint.
+
+    The identifiers are requested in batches whose size adapts to the response time of the endpoint:
+    fast responses grow the batch size, slow responses and throttling (HTTP 429/503) shrink it.
+    Throttled batches are retried after the delay given in the Retry-After header. Batches that
+    fail otherwise are bisected, so that a single problematic entity does not affect the rest of the batch.
+    A batch that is missing from the cache in offline mode aborts the retrieval.
+    Up to maxInFlight requests are executed concurrently and every result is appended to the output
+    as N-Triples as soon as it is received.
+
     :param identifiers: The list of identifiers to retrieve.
     :param targetFolder: The folder where the data is stored.
+    :param maxInFlight: The maximum number of concurrent requests.
+    :param initialBatchSize: The number of identifiers requested in the first batch.
+    :param minBatchSize: The minimum number of identifiers per batch.
+    :param maxBatchSize: The maximum number of identifiers per batch.
+    :param targetResponseTime: The response time in seconds the batch size is adjusted to.
+    :param maxThrottleRetries: How often a throttled batch is retried before it is given up.
     :return: A dictionary with the status and a message.
     """
 
-    def chunker(seq, size):
+    def generateQuery(batch):
+        return """
+            PREFIX wdt: <http://www.wikidata.org/prop/direct/>
+            CONSTRUCT {
+                ?entity wdt:P31 ?type ;
+                    wdt:P625 ?coordinates ;
+                    wdt:P18 ?image .
+            } WHERE {
+                {
+                    ?entity wdt:P31 ?type .
+                } UNION {
+                    ?entity wdt:P625 ?coordinates .
+                } UNION {
+                    ?entity wdt:P18 ?image .
+                }
+                VALUES (?entity) {
+                    %s
+                }
+            }
+        """ % ( "(<" + ">)\n(<".join(batch) + ">)" )
+
+    def fetchBatch(batch):
         """
-        Function to loop through list in chunks
-        Yields successive chunks from seq.
-        :param seq: The list to loop through.
-        :param size: The size of the chunks.
+        Request a batch from the endpoint and return the response along with the elapsed time.
+        Exceptions are returned as part of the result so that they can be handled in the main thread.
         """
-        return (seq[pos:pos + size] for pos in range(0, len(seq), size))
+        startTime = time()
+        try:
+            response = cache.get(wdEndpoint, params={"query": generateQuery(batch)}, headers={"Accept": "application/n-triples", "User-Agent": agent})
+            return {"batch": batch, "response": response, "elapsed": time() - startTime}
+        except Exception as e:
+            return {"batch": batch, "error": e, "elapsed": time() - startTime}
 
     # Read the output file and query for existing URIs
     targetFile = path.join(targetFolder, 'wd.ttl')
-    existingIdentifiers = queryIdentifiersInFile(targetFile, "?identifier wdt:P31 ?type .")
+    existingIdentifiers = set(queryIdentifiersInFile(targetFile, "?identifier wdt:P31 ?type ."))
 
     # Filter out existing identifiers
     identifiersToRetrieve = [d for d in identifiers if d not in existingIdentifiers]
 
     # Retrieve relevant data from Wikidata and append to ttl file
     wdEndpoint = "https://query.wikidata.org/sparql"
-    batchSizeForRetrieval = 100
     agent = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"
-    sparql = SPARQLWrapper(wdEndpoint, agent=agent)    
-    with open(targetFile, 'a') as outputFile:
-        for batch in tqdm(chunker(identifiersToRetrieve, batchSizeForRetrieval)):
-            query = """
-                PREFIX wdt: <http://www.wikidata.org/prop/direct/>
-                CONSTRUCT {
-                    ?entity wdt:P31 ?type ;
-                        wdt:P625 ?coordinates ;
-                        wdt:P18 ?image .
-                } WHERE {
-                    {
-                        ?entity wdt:P31 ?type .
-                    } UNION {
-                        ?entity wdt:P625 ?coordinates .
-                    } UNION {
-                        ?entity wdt:P18 ?image .
-                    }
-                    VALUES (?entity) {
-                        %s
+    cache = getHttpCache()
+
+    batchSize = initialBatchSize
+    remaining = deque(identifiersToRetrieve)
+    retries = deque()
+    throttleCounts = {}
+    notBefore = 0
+    failed = []
+    numRequests = 0
+
+    with open(targetFile, 'ab') as outputFile, ThreadPoolExecutor(max_workers=maxInFlight) as executor, tqdm(total=len(identifiersToRetrieve)) as progress:
+        inFlight = set()
+        while remaining or retries or inFlight:
+            # Fill the pipeline with new requests unless we have been asked to back off
+            while len(inFlight) < maxInFlight and (remaining or retries) and time() >= notBefore:
+                if retries:
+                    batch = retries.popleft()
+                else:
+                    batch = [remaining.popleft() for _ in range(min(batchSize, len(remaining)))]
+                inFlight.add(executor.submit(fetchBatch, batch))
+                numRequests += 1
+
+            if not inFlight:
+                sleep(max(0, notBefore - time()))
+                continue
+
+            done, inFlight = wait(inFlight, timeout=notBefore - time() if notBefore > time() else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                result = future.result()
+                batch = result['batch']
+                response = result.get('response')
+
+                if response is not None and response.status_code == 200:
+                    with open(response.path, 'rb') as f:
+                        shutil.copyfileobj(f, outputFile)
+                    outputFile.write(b"\n")
+                    outputFile.flush()
+                    progress.update(len(batch))
+                    if not response.fromCache:
+                        if result['elapsed'] < targetResponseTime / 2:
+                            batchSize = min(maxBatchSize, int(batchSize * 1.5) + 1)
+                        elif result['elapsed'] > targetResponseTime:
+                            batchSize = max(minBatchSize, batchSize // 2)
+                    continue
+
+                if isinstance(result.get('error'), CacheMissError):
+                    # Offline mode without a cached response: bisecting would only produce further misses
+                    for future in inFlight:
+                        future.cancel()
+                    return {
+                        "status": "error",
+                        "message": "Wikidata batch of %d identifiers starting with %s is not cached: %s" % (len(batch), batch[0], result['error'])
                     }
-                }
 
-            """ % ( "(<" + ">)\n(<".join(batch) + ">)" )
-            sparql.setQuery(query)
-            try:
-                results = sparql.query().convert()
-            except urllib.error.HTTPError as exception:
-                print(exception)
-            sleep(3)
-            outputFile.write(results.serialize(format='turtle'))
+                if response is not None and response.status_code in [429, 503]:
+                    # Throttled: wait as instructed and retry the same batch with smaller batches from now on
+                    key = tuple(batch)
+                    throttleCounts[key] = throttleCounts.get(key, 0) + 1
+                    batchSize = max(minBatchSize, batchSize // 2)
+                    notBefore = max(notBefore, time() + parseRetryAfter(response.headers.get('Retry-After'), default=5 * throttleCounts[key]))
+                    if throttleCounts[key] <= maxThrottleRetries:
+                        retries.append(batch)
+                    else:
+                        print("Giving up on throttled batch of %d identifiers" % len(batch))
+                        failed += batch
+                        progress.update(len(batch))
+                    continue
+
+                # Any other error: bisect the batch to isolate problematic identifiers
+                batchSize = max(minBatchSize, batchSize // 2)
+                if len(batch) > 1:
+                    middle = len(batch) // 2
+                    retries.appendleft(batch[middle:])
+                    retries.appendleft(batch[:middle])
+                else:
+                    error = result['error'] if 'error' in result else "HTTP %d" % response.status_code
+                    print("Could not retrieve", batch[0], error)
+                    failed += batch
+                    progress.update(len(batch))
+
     return {
         "status": "success",
-        "message": "Retrieved %d additional Wikidata identifiers (%d present in total)" % (len(identifiersToRetrieve), len(identifiers))
+        "message": "Retrieved %d additional Wikidata identifiers in %d requests (%d present in total, %d failed)" % (len(identifiersToRetrieve) - len(failed), numRequests, len(identifiers), len(failed))
     }
 
+def parseRetryAfter(value, *, default):
+    """
+    Parses the value of a Retry-After header, which can either be given in seconds or as HTTP date.
+
+    :param value: The value of the header or None.
+    :param default: The number of seconds to return if the value is missing or cannot be parsed.
+    :return: The number of seconds to wait.
+    """
+    if not value:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return default
+
+def indexNTriples(lines):
+    """
+    Indexes N-Triples statements by their subject.
+    Lines that are not N-Triples statements are skipped and their number is reported.
+
+    :param lines: An iterable of N-Triples lines.
+    :return: A dictionary with the subjects as keys and a list of (subject, predicate, object) tuples as values.
+    """
+    index = {}
+    skipped = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(None, 2)
+        if len(parts) < 3 or not parts[2].endswith('.'):
+            if not skipped:
+                print("Skipping line that is not an N-Triples statement:", line[:200])
+            skipped += 1
+            continue
+        subject, predicate, rest = parts
+        statementObject = rest[:-1].strip()
+        index.setdefault(subject.strip('<>'), []).append((subject, predicate, statementObject))
+    if skipped:
+        print("Skipped %d lines of the snapshot that are not N-Triples statements" % skipped)
+    return index
+
+def readSnapshotLines(source):
+    """
+    Reads a bulk dump from a file or URL and yields its statements as N-Triples lines.
+    Gzip compressed dumps are decompressed. Dumps that are not in N-Triples format are
+    parsed with rdflib, using the file extension to determine the format.
+
+    :param source: The path or URL of the dump.
+    """
+    if source.startswith('http://') or source.startswith('https://'):
+        response = getHttpCache().get(source)
+        if response.status_code != 200:
+            print("Could not retrieve snapshot", source, response.status_code)
+            return
+        filename = response.path
+    else:
+        filename = source
+    name = source.lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    with open(filename, 'rb') as f:
+        isGzip = f.read(2) == b'\x1f\x8b'
+    opener = gzip.open if isGzip else open
+    if name.endswith('.nt'):
+        with opener(filename, 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield line
+    else:
+        snapshotGraph = Graph()
+        with opener(filename, 'rb') as f:
+            snapshotGraph.parse(f, format=guess_format(name) or 'turtle')
+        for line in snapshotGraph.serialize(format='nt').splitlines():
+            yield line
+
+def writeFromSnapshot(index, identifiers, outputFile, *, followPredicates=None):
+    """
+    Writes the statements about the given identifiers from an indexed snapshot to the output file.
+    Statements about blank nodes that are reachable from an identifier are included, as are statements
+    about IRIs that are the object of one of the given predicates. Blank node labels are made unique
+    so that they do not clash with data previously written to the file.
+
+    :param index: A snapshot indexed by subject as returned by indexNTriples.
+    :param identifiers: The list of identifiers to extract.
+    :param outputFile: The file to write the statements to.
+    :param followPredicates: List of predicates in N-Triples syntax whose IRI objects are followed (optional).
+    :return: The set of identifiers that were found in the snapshot.
+    """
+    followPredicates = set(followPredicates) if followPredicates else set()
+    bnodePrefix = "_:s%s" % uuid.uuid4().hex[:8]
+
+    def relabel(term):
+        return bnodePrefix + term[2:] if term.startswith('_:') else term
+
+    found = set()
+    for identifier in identifiers:
+        if identifier not in index:
+            continue
+        found.add(identifier)
+        toVisit = [identifier]
+        visited = set()
+        while toVisit:
+            subject = toVisit.pop()
+            if subject in visited:
+                continue
+            visited.add(subject)
+            for s, p, o in index.get(subject, []):
+                outputFile.write("%s %s %s .\n" % (relabel(s), p, relabel(o)))
+                if o.startswith('_:'):
+                    toVisit.append(o)
+                elif p in followPredicates and o.startswith('<'):
+                    toVisit.append(o[1:-1])
+    outputFile.flush()
+    return found
+
 if __name__ == "__main__":
     options = {}
 
@@ -304,8 +694,8 @@ if __name__ == "__main__":
                 print("Malformed arguments")
                 sys.exit(1)
 
-    if not 'sourceFolder' in options:
-        print("An input directory that contains the source TTL files must be specified via the --sourceFolder option")
+    if not 'sourceFolder' in options and not 'identifiersFile' in options:
+        print("An input directory that contains the source TTL files must be specified via the --sourceFolder option, or a file containing the identifiers via the --identifiersFile option")
         sys.exit(1)
 
     if not 'targetFolder' in options:
@@ -319,6 +709,11 @@ if __name__ == "__main__":
     if 'limit' in options:
         options['limit'] = int(options['limit'])
 
+    if 'gndBulk' in options:
+        options['gndBulk'] = options['gndBulk'].lower() == 'true'
+    else:
+        options['gndBulk'] = True
+
     options['sources'] = options['sources'].split(',')
 
     # Check if list of sources only contains supported sources
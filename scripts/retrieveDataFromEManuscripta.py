@@ -1,23 +1,59 @@
 
+"""
+Retrieves the METS records of the digitised documents from e-manuscripta via OAI-PMH.
+
+Usage:
+
+python retrieveDataFromEManuscripta.py --inputFolder <inputFolder> --outputFolder <outputFolder>
+
+Parameters:
+    --inputFolder       The folder containing the source JSON data
+    --outputFolder      The folder to write the OAI XML records to
+    --vlidMapFile       The path to the file containing the mapping between DOIs and VLIDs (optional)
+    --oaiEndpoint       The OAI-PMH endpoint (optional, default: https://www.e-manuscripta.ch/zuzcmi/oai)
+    --harvestMode       Either "getRecord" to retrieve records that are not yet present individually, or "listRecords"
+                        to harvest all records modified since the last harvest through ListRecords (optional, default: getRecord).
+                        If there is neither a previous harvest nor an OAI set, the records are retrieved via GetRecord and only the date is stored
+    --oaiSet            The OAI set to restrict the ListRecords harvest to (optional)
+    --harvestStateFile  The file in which the date of the last harvest and the records deleted upstream are stored (optional, default: <outputFolder>/harvest-state.json)
+    --maxWorkers        The number of records that are retrieved concurrently via GetRecord (optional, default: 4)
+    --reducedOutputFolder  The folder to write the reduced, gzip compressed records to, which only contain the parts used
+                        in the mapping and by cacheIiifManifests.py. If set, the full records are archived gzip compressed
+                        in the archive folder instead of being written to the output folder (optional)
+    --archiveFolder     The folder to archive the full records to if reducedOutputFolder is set (optional, default: outputFolder)
+"""
+
 import csv
+import gzip
 import json
+import os
 import re
 import requests
 import sys
+import threading
+import time
 from bs4 import BeautifulSoup
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from lxml import etree
 from sickle import Sickle
+from sickle.oaiexceptions import NoRecordsMatch
 from tqdm import tqdm
 from os import listdir
 from os.path import join, isfile
 
-from lib.utils import RetrieveVLIDfromDOI, readRecords
+from lib.utils import RetrieveVLIDfromDOI, readRecords, writeReducedOaiRecord
 
 def performRetrieval(options):
     inputFolder = options['inputFolder']
     outputFolder = options['outputFolder']
     vlidMapFile = options['vlidMapFile']
     oaiEndpoint = options['oaiEndpoint']
+    reducedFolder = options['reducedOutputFolder'] if 'reducedOutputFolder' in options else None
+    archiveFolder = options['archiveFolder'] if 'archiveFolder' in options else outputFolder
+    if reducedFolder:
+        os.makedirs(reducedFolder, exist_ok=True)
+        os.makedirs(archiveFolder, exist_ok=True)
 
     # Read records from input folder
     records = readRecords(inputFolder)
@@ -29,7 +65,8 @@ def performRetrieval(options):
     # Retrieve VLIDs for records that have DOIs    
     vlidRetriever = RetrieveVLIDfromDOI(vlidMapFile=vlidMapFile)
     print("Retrieving VLIDs for %d records" % len(recordsToProcess))
-    for record in tqdm(recordsToProcess):
+    vlidRetriever.resolveDois([d['doi'] for d in recordsToProcess])
+    for record in recordsToProcess:
         record['vlid'] = vlidRetriever.getVlidForDoi(record['doi'])
 
     # Write VLID map to file
@@ -37,18 +74,205 @@ def performRetrieval(options):
 
     # Retrieve OAI records for records that have VLIDs
     sickle = Sickle(oaiEndpoint)
-    oaiRecords = {}
     ids = [d['vlid'] for d in recordsToProcess if d['vlid'] is not None]
-    print("Retrieving OAI records for %d records" % len(ids))
-    for identifier in tqdm(ids):
-        if not isfile(join(outputFolder, identifier + ".xml")):
-            oaiRecords[identifier] = (sickle.GetRecord(identifier=identifier, metadataPrefix='mets'))
 
-    # Write OAI records with CMI data and write to XML to file
-    for identifier in oaiRecords.keys():
-        root = etree.fromstring(oaiRecords[identifier].raw.encode('utf8'))
-        with open(join(outputFolder, identifier + ".xml"), 'wb') as f:
-            f.write(etree.tostring(root, pretty_print=True))
+    # Harvest records that have been modified since the last harvest
+    if options['harvestMode'] == 'listRecords':
+        harvestRecords(sickle, ids=ids, outputFolder=outputFolder, stateFile=options['harvestStateFile'], oaiSet=options['oaiSet'] if 'oaiSet' in options else None, reducedFolder=reducedFolder, archiveFolder=archiveFolder)
+
+    # Retrieve records that are not yet present individually, except those that have been deleted upstream
+    deletedIds = set(readHarvestState(options['harvestStateFile']).get('deleted', []))
+    missingIds = [d for d in ids if not isRetrieved(d, outputFolder=outputFolder, reducedFolder=reducedFolder) and d not in deletedIds]
+    if len(deletedIds & set(ids)):
+        print("Skipping %d records that have been deleted upstream" % len(deletedIds & set(ids)))
+    print("Retrieving OAI records for %d records" % len(missingIds))
+    failed = fetchRecords(missingIds, oaiEndpoint=oaiEndpoint, outputFolder=outputFolder, maxWorkers=options['maxWorkers'], reducedFolder=reducedFolder, archiveFolder=archiveFolder)
+    if len(failed):
+        print("Could not retrieve the following %d records:" % len(failed))
+        for identifier, error in failed.items():
+            print("    %s: %s" % (identifier, error))
+
+    # Write reduced records for the full records that have been retrieved before, the full records are kept
+    if reducedFolder:
+        fullRecords = [d for d in ids if isfile(join(outputFolder, d + ".xml")) and not isfile(join(reducedFolder, d + ".xml.gz"))]
+        if len(fullRecords):
+            print("Writing reduced records for %d full records" % len(fullRecords))
+            for identifier in tqdm(fullRecords):
+                writeReducedOaiRecord(etree.parse(join(outputFolder, identifier + ".xml")), join(reducedFolder, identifier + ".xml.gz"))
+
+def isRetrieved(identifier, *, outputFolder, reducedFolder=None):
+    """
+    Check whether the record with the given VLID has been retrieved, either in full or in reduced form.
+    """
+    return isfile(join(outputFolder, identifier + ".xml")) or bool(reducedFolder and isfile(join(reducedFolder, identifier + ".xml.gz")))
+
+def fetchRecords(ids, *, oaiEndpoint, outputFolder, maxWorkers=4, maxAttempts=3, reducedFolder=None, archiveFolder=None):
+    """
+    Retrieve the records with the given VLIDs concurrently using GetRecord.
+    Every record is written to disk as soon as it has been received, so that an interrupted
+    run can be resumed by only retrieving the records that are not yet present.
+    If a folder for the reduced records is given, the reduced records are written along with
+    a compressed copy of the full records in the archive folder.
+    Records that could not be retrieved are retried up to maxAttempts times.
+
+    :param ids: List of VLIDs of the records to retrieve
+    :param oaiEndpoint: The OAI-PMH endpoint
+    :param outputFolder: The folder to write the XML records to
+    :param maxWorkers: The number of concurrent requests
+    :param maxAttempts: The number of attempts per record
+    :param reducedFolder: The folder to write the reduced records to (optional)
+    :param archiveFolder: The folder to archive the full records to if reducedFolder is given (optional, default: outputFolder)
+    :return: Dictionary of the VLIDs that could not be retrieved and the last error
+    """
+    threadData = threading.local()
+
+    def fetchRecord(identifier):
+        # Sickle keeps the last response as state, hence every thread uses its own client
+        if not hasattr(threadData, 'sickle'):
+            threadData.sickle = Sickle(oaiEndpoint)
+        record = threadData.sickle.GetRecord(identifier=identifier, metadataPrefix='mets')
+        writeRecord(record, join(outputFolder, identifier + ".xml"),
+                    reducedFilename=join(reducedFolder, identifier + ".xml.gz") if reducedFolder else None,
+                    archiveFilename=join(archiveFolder or outputFolder, identifier + ".xml.gz"))
+        return len(record.raw)
+
+    failed = {}
+    toFetch = list(ids)
+    numBytes = 0
+    numRecords = 0
+    startTime = time.time()
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        for attempt in range(1, maxAttempts + 1):
+            if not toFetch:
+                break
+            if attempt > 1:
+                print("Retrying %d records (attempt %d of %d)" % (len(toFetch), attempt, maxAttempts))
+                time.sleep(2 ** attempt)
+            futures = {executor.submit(fetchRecord, identifier): identifier for identifier in toFetch}
+            toFetch = []
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                identifier = futures[future]
+                try:
+                    numBytes += future.result()
+                    numRecords += 1
+                    failed.pop(identifier, None)
+                except Exception as e:
+                    failed[identifier] = e
+                    toFetch.append(identifier)
+
+    elapsed = max(time.time() - startTime, 0.001)
+    if numRecords:
+        print("Retrieved %d records (%.1f MB) in %.1fs (%.1f records/s)" % (numRecords, numBytes / 1e6, elapsed, numRecords / elapsed))
+    return failed
+
+def harvestRecords(sickle, *, ids, outputFolder, stateFile, oaiSet=None, reducedFolder=None, archiveFolder=None):
+    """
+    Harvest the records that have been created or modified since the last harvest using ListRecords.
+    Resumption tokens are followed by Sickle. Only records with one of the given VLIDs are written,
+    records that have been deleted upstream are removed from the output folder (archived copies are kept).
+    The date of the harvest is persisted in the state file and used as from date for the next harvest,
+    along with the VLIDs of the records that have been deleted upstream.
+    If no state file exists, all records of the given set are harvested. Without a set, this would
+    walk the whole repository, hence only the date is stored and the records are left to GetRecord.
+
+    :param sickle: The Sickle client
+    :param ids: List of VLIDs of the records to keep
+    :param outputFolder: The folder to write the XML records to
+    :param stateFile: The file in which the date of the last harvest is stored
+    :param oaiSet: The OAI set to restrict the harvest to (optional)
+    :param reducedFolder: The folder to write the reduced records to (optional)
+    :param archiveFolder: The folder to archive the full records to if reducedFolder is given (optional, default: outputFolder)
+    """
+    state = readHarvestState(stateFile)
+    deletedIds = set(state.get('deleted', []))
+
+    # Day granularity is supported by all OAI-PMH repositories. As the from date is inclusive, records
+    # modified on the day of the last harvest are harvested again.
+    harvestDate = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    params = {'metadataPrefix': 'mets'}
+    if 'from' in state:
+        params['from'] = state['from']
+    if oaiSet:
+        params['set'] = oaiSet
+
+    if not 'from' in params and not oaiSet:
+        print("No previous harvest found and no OAI set specified, retrieving the records via GetRecord")
+        writeHarvestState(stateFile, {'from': harvestDate, 'deleted': sorted(deletedIds)})
+        return
+
+    print("Harvesting OAI records %s" % ("modified since " + params['from'] if 'from' in params else "(full harvest)"))
+    idsToKeep = set(ids)
+    written = 0
+    deleted = 0
+    seen = 0
+    try:
+        for record in tqdm(sickle.ListRecords(**params)):
+            seen += 1
+            vlid = record.header.identifier.rsplit(':', 1)[-1]
+            if vlid not in idsToKeep:
+                continue
+            filename = join(outputFolder, vlid + ".xml")
+            reducedFilename = join(reducedFolder, vlid + ".xml.gz") if reducedFolder else None
+            if record.header.deleted:
+                deletedIds.add(vlid)
+                if isRetrieved(vlid, outputFolder=outputFolder, reducedFolder=reducedFolder):
+                    deleted += 1
+                for existing in [filename, reducedFilename]:
+                    if existing and isfile(existing):
+                        os.remove(existing)
+                continue
+            writeRecord(record, filename, reducedFilename=reducedFilename, archiveFilename=join(archiveFolder or outputFolder, vlid + ".xml.gz"))
+            deletedIds.discard(vlid)
+            written += 1
+    except NoRecordsMatch:
+        pass
+
+    writeHarvestState(stateFile, {'from': harvestDate, 'deleted': sorted(deletedIds)})
+
+    print("Harvested %d records, of which %d were written and %d deleted" % (seen, written, deleted))
+
+def readHarvestState(stateFile):
+    """
+    Read the state of the last harvest.
+    :param stateFile: The file in which the state is stored
+    :return: Dictionary with the from date and the VLIDs of the deleted records, empty if there was no harvest yet
+    """
+    if not isfile(stateFile):
+        return {}
+    with open(stateFile, 'r') as f:
+        return json.load(f)
+
+def writeHarvestState(stateFile, state):
+    tmpFilename = stateFile + ".tmp"
+    with open(tmpFilename, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmpFilename, stateFile)
+
+def writeRecord(record, filename, *, reducedFilename=None, archiveFilename=None):
+    """
+    Write an OAI record as pretty-printed XML to the given file.
+    The file is replaced atomically. If a filename for the reduced record is given, the reduced
+    and compressed record used for the data preparation is written instead, and the full record
+    is archived gzip compressed to the archive file.
+
+    :param record: The Sickle record
+    :param filename: The file to write to
+    :param reducedFilename: The file to write the reduced record to (optional)
+    :param archiveFilename: The file to archive the full record to if reducedFilename is given
+    """
+    root = etree.fromstring(record.raw.encode('utf8'))
+    if reducedFilename:
+        tmpFilename = archiveFilename + ".tmp"
+        with gzip.open(tmpFilename, 'wb') as f:
+            f.write(etree.tostring(root))
+        os.replace(tmpFilename, archiveFilename)
+        writeReducedOaiRecord(root, reducedFilename)
+        return
+    # Write to a temporary file first so that interrupted runs do not leave incomplete records
+    tmpFilename = filename + ".tmp"
+    with open(tmpFilename, 'wb') as f:
+        f.write(etree.tostring(root, pretty_print=True))
+    os.replace(tmpFilename, filename)
 
 if __name__ == "__main__":
     options = {}
@@ -72,5 +296,16 @@ if __name__ == "__main__":
         options['vlidMapFile'] = join(options['inputFolder'], 'map_doi_vlid.csv')
     if not 'oaiEndpoint' in options:
         options['oaiEndpoint'] = 'https://www.e-manuscripta.ch/zuzcmi/oai'
+    if not 'harvestMode' in options:
+        options['harvestMode'] = 'getRecord'
+    if options['harvestMode'] not in ['getRecord', 'listRecords']:
+        print("The harvest mode must be either getRecord or listRecords")
+        sys.exit(1)
+    if 'maxWorkers' in options:
+        options['maxWorkers'] = int(options['maxWorkers'])
+    else:
+        options['maxWorkers'] = 4
+    if not 'harvestStateFile' in options:
+        options['harvestStateFile'] = join(options['outputFolder'], 'harvest-state.json')
 
     performRetrieval(options)
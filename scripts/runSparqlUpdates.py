@@ -0,0 +1,337 @@
+"""
+Runs the statements of a SPARQL update file one by one against a SPARQL endpoint.
+
+The file is split into its statements (separated by ';'), which are executed in order. The PREFIX
+declarations apply to all following statements, as in a single request. For every statement the
+duration and the number of affected triples (as reported by Blazegraph) are printed.
+Statements that time out or fail with a server error are retried.
+
+The completed statements are stored in a checkpoint file. If the run is interrupted or a statement
+fails, the next run resumes after the last completed statement, as long as the file is unchanged.
+The checkpoint file is removed once all statements have been executed. Since the checkpoint does not
+track the data, the pipeline removes it whenever graphs are reloaded (see the _clear-update-checkpoints task).
+
+Consecutive statements that are independent of each other can be marked with a '# @concurrent'
+comment line, in which case they are executed concurrently.
+
+Usage:
+
+python runSparqlUpdates.py --endpoint <SPARQL endpoint> --file <path to update file>
+
+Parameters:
+    --endpoint          The SPARQL endpoint
+    --file              The file containing the SPARQL update statements
+    --checkpointFile    The JSON file in which the completed statements are stored (optional, default: <file>.checkpoint.json)
+    --report            Path to a JSON file to which the duration and number of affected triples per statement are written (optional)
+    --timeout           Timeout in seconds for a single statement (optional, default: 3600)
+    --maxAttempts       Number of attempts per statement (optional, default: 3)
+    --concurrency       Maximum number of statements executed concurrently (optional, default: 4)
+    --restart           If set to true, the checkpoint is ignored and all statements are executed (optional, default: false)
+"""
+
+import json
+import os
+import re
+import requests
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import blake2b
+
+# HTTP status codes after which a statement is retried
+RETRY_STATUS_CODES = [500, 502, 503, 504]
+
+CONCURRENT_ANNOTATION = '@concurrent'
+IRI_PATTERN = re.compile(r'<[^<>"{}|^`\\\s]*>')
+PROLOGUE_PATTERN = re.compile(r'^\s*(?:PREFIX\s+[^\s:]*:\s*<[^>]*>|BASE\s+<[^>]*>)', re.IGNORECASE)
+
+def performUpdates(options):
+    with open(options['file'], 'r', encoding='utf-8') as f:
+        text = f.read()
+    fileHash = blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+    statements = splitStatements(text)
+    completed = set() if options['restart'] else readCheckpoint(options['checkpointFile'], fileHash)
+    if completed:
+        print("Resuming after %d of %d completed statements" % (len(completed), len(statements)))
+
+    report = []
+    startTime = time.time()
+    failed = None
+    for group in groupStatements(statements):
+        group = [d for d in group if d['index'] not in completed]
+        if not group:
+            continue
+        with ThreadPoolExecutor(max_workers=min(options['concurrency'], len(group))) as executor:
+            results = list(executor.map(lambda d: runStatement(d, options), group))
+        for statement, entry in zip(group, results):
+            report.append(entry)
+            if entry['error']:
+                print("[%d/%d] %s failed after %.1fs: %s" % (statement['index'] + 1, len(statements), statement['label'], entry['duration'], entry['error']))
+                failed = failed or entry
+            else:
+                completed.add(statement['index'])
+                print("[%d/%d] %-60s %8.1fs %10s triples" % (statement['index'] + 1, len(statements), statement['label'][:60], entry['duration'], entry['mutations'] if entry['mutations'] is not None else '?'))
+        writeCheckpoint(options['checkpointFile'], fileHash, completed)
+        if failed:
+            break
+
+    writeReport(options['report'], options['file'], report, startTime)
+
+    if failed:
+        print("Stopped at statement %d of %s, the next run resumes from there" % (failed['index'] + 1, options['file']))
+        sys.exit(1)
+
+    if os.path.isfile(options['checkpointFile']):
+        os.remove(options['checkpointFile'])
+    slowest = sorted(report, key=lambda d: d['duration'], reverse=True)[:5]
+    if slowest:
+        print("Slowest statements: " + ", ".join("%d (%.1fs)" % (d['index'] + 1, d['duration']) for d in slowest))
+    print("Successfully executed %d statements of %s in %.1fs" % (len(statements), options['file'], time.time() - startTime))
+
+def splitStatements(text):
+    """
+    Split a SPARQL update request into its statements. Each statement is prefixed with the
+    PREFIX and BASE declarations that precede it in the request.
+    The label of a statement is its first comment line. Statements without comment are labelled
+    after the previous comment, or with their beginning if there is none.
+
+    >>> statements = splitStatements('''PREFIX ex: <http://ex.org/>
+    ... # Clear graph
+    ... DROP GRAPH ex:g;
+    ... # @concurrent
+    ... INSERT DATA { ex:a ex:b "x;y" ; ex:c <http://ex.org/?a;b> };
+    ... # @concurrent
+    ... DELETE WHERE { ?s ex:b ?o }''')
+    >>> [(d['label'], d['concurrent']) for d in statements]
+    [('Clear graph', False), ('Clear graph (2)', True), ('Clear graph (3)', True)]
+    >>> statements[1]['query']
+    'PREFIX ex: <http://ex.org/>\\nINSERT DATA { ex:a ex:b "x;y" ; ex:c <http://ex.org/?a;b> }'
+    >>> [d['label'] for d in splitStatements('# Add types\\nINSERT DATA { <a> a <b> }; INSERT DATA { <c> a <b> }')]
+    ['Add types', 'Add types (2)']
+    >>> statements[2]['query']
+    'PREFIX ex: <http://ex.org/>\\nDELETE WHERE { ?s ex:b ?o }'
+    """
+    chunks = []
+    current = []
+    depth = 0
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == '#':
+            end = text.find('\n', i)
+            end = len(text) if end == -1 else end
+            current.append(text[i:end])
+            i = end
+            continue
+        if c in ['"', "'"]:
+            end = findStringEnd(text, i)
+            current.append(text[i:end])
+            i = end
+            continue
+        if c == '<':
+            match = IRI_PATTERN.match(text, i)
+            if match:
+                current.append(match.group(0))
+                i = match.end()
+                continue
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+        elif c == ';' and depth == 0:
+            chunks.append(''.join(current))
+            current = []
+            i += 1
+            continue
+        current.append(c)
+        i += 1
+    chunks.append(''.join(current))
+
+    statements = []
+    prologue = []
+    lastLabel = None
+    lastLabelCount = 0
+    for chunk in chunks:
+        comments = []
+        body = chunk
+        while True:
+            body = body.lstrip()
+            if body.startswith('#'):
+                end = body.find('\n')
+                comments.append(body[1:end if end != -1 else len(body)].strip())
+                body = body[end:] if end != -1 else ''
+                continue
+            match = PROLOGUE_PATTERN.match(body)
+            if match:
+                prologue.append(match.group(0).strip())
+                body = body[match.end():]
+                continue
+            break
+        body = body.strip()
+        if not body:
+            continue
+        labels = [d for d in comments if d and d != CONCURRENT_ANNOTATION]
+        if labels:
+            label = lastLabel = labels[0]
+            lastLabelCount = 1
+        elif lastLabel:
+            lastLabelCount += 1
+            label = "%s (%d)" % (lastLabel, lastLabelCount)
+        else:
+            label = re.sub(r'\s+', ' ', body)[:80]
+        statements.append({
+            "index": len(statements),
+            "label": label,
+            "concurrent": CONCURRENT_ANNOTATION in comments,
+            "query": "\n".join(prologue + [body])
+        })
+    return statements
+
+def findStringEnd(text, start):
+    """
+    Return the position after the string literal starting at the given position
+    """
+    quote = text[start]
+    if text.startswith(quote * 3, start):
+        end = text.find(quote * 3, start + 3)
+        return len(text) if end == -1 else end + 3
+    i = start + 1
+    while i < len(text):
+        if text[i] == '\\':
+            i += 2
+            continue
+        if text[i] == quote or text[i] == '\n':
+            return i + 1
+        i += 1
+    return i
+
+def groupStatements(statements):
+    """
+    Group consecutive statements marked as concurrent, all other statements form their own group
+    """
+    groups = []
+    for statement in statements:
+        if statement['concurrent'] and groups and groups[-1][0]['concurrent']:
+            groups[-1].append(statement)
+        else:
+            groups.append([statement])
+    return groups
+
+def runStatement(statement, options):
+    """
+    Execute a statement, retrying it after timeouts, connection and server errors.
+    :return: A dictionary with the index, label, duration, number of affected triples and error (if any)
+    """
+    startTime = time.time()
+    error = None
+    mutations = None
+    for attempt in range(1, options['maxAttempts'] + 1):
+        try:
+            mutations = executeUpdate(options['endpoint'], statement['query'], timeout=options['timeout'])
+            error = None
+            break
+        except RetryableError as e:
+            error = str(e)
+            if attempt < options['maxAttempts']:
+                print("Statement %d: %s, retrying (attempt %d of %d)" % (statement['index'] + 1, e, attempt + 1, options['maxAttempts']))
+                time.sleep(2 ** attempt)
+        except Exception as e:
+            error = str(e)
+            break
+    return {
+        "index": statement['index'],
+        "label": statement['label'],
+        "duration": round(time.time() - startTime, 3),
+        "mutations": mutations,
+        "error": error
+    }
+
+class RetryableError(Exception):
+    pass
+
+def executeUpdate(endpoint, query, *, timeout=3600):
+    """
+    Execute a SPARQL update.
+    :return: The mutation count reported by Blazegraph, or None if the endpoint does not report it
+    """
+    try:
+        response = requests.post(endpoint, data={'update': query}, timeout=timeout)
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        raise RetryableError(e)
+    if response.status_code in RETRY_STATUS_CODES:
+        raise RetryableError("HTTP Error %d" % response.status_code)
+    if response.status_code != 200:
+        raise Exception("HTTP Error %d: %s" % (response.status_code, response.text[:500]))
+    mutationCount = re.search(r'mutationCount=(\d+)', response.text)
+    return int(mutationCount.group(1)) if mutationCount else None
+
+def readCheckpoint(checkpointFile, fileHash):
+    """
+    Read the indexes of the completed statements, if the checkpoint belongs to the same version of the file
+    """
+    if not os.path.isfile(checkpointFile):
+        return set()
+    try:
+        with open(checkpointFile, 'r') as f:
+            checkpoint = json.load(f)
+    except Exception:
+        print("Ignoring invalid checkpoint file %s" % checkpointFile)
+        return set()
+    if checkpoint.get('hash') != fileHash:
+        print("The update file changed since the checkpoint was written, executing all statements")
+        return set()
+    return set(checkpoint['completed'])
+
+def writeCheckpoint(checkpointFile, fileHash, completed):
+    if os.path.dirname(checkpointFile):
+        os.makedirs(os.path.dirname(checkpointFile), exist_ok=True)
+    tmpFilename = checkpointFile + ".tmp"
+    with open(tmpFilename, 'w') as f:
+        json.dump({"hash": fileHash, "completed": sorted(completed)}, f)
+    os.replace(tmpFilename, checkpointFile)
+
+def writeReport(reportFile, updateFile, report, startTime):
+    """
+    Write the report of the executed statements to a JSON file
+    """
+    if not reportFile:
+        return
+    if os.path.dirname(reportFile):
+        os.makedirs(os.path.dirname(reportFile), exist_ok=True)
+    with open(reportFile, 'w') as f:
+        json.dump({
+            "file": updateFile,
+            "started": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(startTime)),
+            "duration": round(time.time() - startTime, 3),
+            "statements": sorted(report, key=lambda d: d['duration'], reverse=True)
+        }, f, indent=4)
+
+if __name__ == "__main__":
+    options = {}
+
+    for i, arg in enumerate(sys.argv[1:]):
+        if arg.startswith("--"):
+            if not sys.argv[i + 2].startswith("--"):
+                options[arg[2:]] = sys.argv[i + 2]
+            else:
+                print("Malformed arguments")
+                sys.exit(1)
+
+    if not 'endpoint' in options:
+        print("Please provide a SPARQL endpoint via the --endpoint argument")
+        sys.exit(1)
+    if not 'file' in options or not os.path.isfile(options['file']):
+        print("Please provide an existing update file via the --file argument")
+        sys.exit(1)
+    if not 'checkpointFile' in options:
+        options['checkpointFile'] = options['file'] + '.checkpoint.json'
+    if not 'report' in options:
+        options['report'] = None
+    options['timeout'] = int(options['timeout']) if 'timeout' in options else 3600
+    options['maxAttempts'] = int(options['maxAttempts']) if 'maxAttempts' in options else 3
+    options['concurrency'] = int(options['concurrency']) if 'concurrency' in options else 4
+    options['restart'] = 'restart' in options and options['restart'].lower() == 'true'
+
+    performUpdates(options)